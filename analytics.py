@@ -0,0 +1,366 @@
+'''
+Pose session analytics (incremental columnar store of every session and vectorized queries)
+@author bh.hwang@iae.re.kr
+'''
+
+import argparse
+import json
+import os
+import pathlib
+import re
+import shutil
+import time
+from datetime import datetime, timedelta
+import numpy as np
+from metrics import bucket_indices, bucket_values, bucket_count, REPORT_PERCENTILES
+from poselog import PoseLogReader, csv_to_rows, POSELOG_EXT, CHUNK_PATTERN, FLAG_HELD, FLAG_TRACKED
+
+# pre-defined options
+STORE_DIR_NAME = ".analytics" # under the data root (hidden from the session listing)
+STORE_VERSION = 1
+MANIFEST_FILE = "manifest.json"
+LEGACY_CAMERA = "legacy" # camera of the legacy pose.csv (or its converted pose.kpl)
+JITTER_MAX_GAP_S = 0.2 # consecutive detections further apart are not compared
+JITTER_MIN_CONF = 0.5 # keypoints below this confidence are not compared (unknown confidence is accepted)
+JITTER_MIN_IOU = 0.5 # box overlap of the same person between two detections
+JITTER_LOOKBACK = 8 # rows searched back for the previous detection of the person
+TIMING_COLUMNS = ("t_preprocess", "t_inference", "t_postprocess")
+GROUP_BY = ("session", "camera", "segment")
+
+# stored columns (one row per log row, sorted by segment and wall-clock time)
+STORE_COLUMNS = {
+    "segment":np.uint32,    # session and camera (manifest)
+    "t_wall":np.int64,      # ns since epoch
+    "person":np.int8,       # -1 : frame without detection
+    "flags":np.uint8,
+    "t_preprocess":np.float32, # ms
+    "t_inference":np.float32,
+    "t_postprocess":np.float32,
+    "jitter":np.float32,    # mean keypoint displacement (px) from the previous detection of the person, nan if none
+}
+
+_KPL_PATTERN = re.compile(rf"pose_cam_(.+)\.{POSELOG_EXT}$")
+_DISTRIBUTION_SCALE = {"jitter":100.} # histogram units (timings in us, jitter in 1/100 px)
+
+
+# keypoint logs of a session [(camera id, path)], legacy csv only if it was not converted
+def session_sources(session_path:pathlib.Path) -> list:
+    session_path = pathlib.Path(session_path)
+    sources = []
+    for path in sorted(session_path.glob(f"pose_cam_*.{POSELOG_EXT}")):
+        sources.append((_KPL_PATTERN.match(path.name).group(1), path))
+    converted = session_path / f"pose.{POSELOG_EXT}"
+    if converted.is_dir():
+        sources.append((LEGACY_CAMERA, converted))
+    elif (session_path / "pose.csv").is_file():
+        sources.append((LEGACY_CAMERA, session_path / "pose.csv"))
+    return sources
+
+
+# change signature of a log (size and modification time of the csv file or of every chunk)
+def source_signature(path:pathlib.Path) -> list:
+    files = sorted(path.glob(CHUNK_PATTERN)) if path.is_dir() else [path]
+    signature = []
+    for file in files:
+        stat = file.stat()
+        signature.append([file.name, stat.st_size, stat.st_mtime_ns])
+    return signature
+
+
+# log rows of a source (legacy csv files are parsed)
+def read_source(path:pathlib.Path) -> np.ndarray:
+    if path.is_dir():
+        return np.array(PoseLogReader(path).read())
+    return csv_to_rows(path)
+
+
+# stored columns of log rows
+def rows_to_columns(rows:np.ndarray, segment:int) -> dict:
+    rows = rows[np.argsort(rows["t_wall"], kind="stable")]
+    columns = {"segment":np.full(len(rows), segment, dtype=STORE_COLUMNS["segment"])}
+    for name in ("t_wall", "person", "flags") + TIMING_COLUMNS:
+        columns[name] = rows[name].astype(STORE_COLUMNS[name])
+    columns["jitter"] = keypoint_jitter(rows)
+    return columns
+
+
+# mean displacement (px) of the valid keypoints from the previous detection of the same person
+# (closest one with the same slot and an overlapping box a few rows back, as the legacy csv interleaves the rows of every camera)
+def keypoint_jitter(rows:np.ndarray) -> np.ndarray:
+    jitter = np.full(len(rows), np.nan, dtype=np.float32)
+    detected = np.flatnonzero((rows["person"] >= 0) & (rows["flags"] & FLAG_HELD == 0)) # held keypoints do not move
+    if len(detected) < 2:
+        return jitter
+    order = detected[np.lexsort((rows["t_wall"][detected], rows["person"][detected]))]
+    person, t_wall, bbox = rows["person"][order], rows["t_wall"][order], rows["bbox"][order]
+    keypoints, conf = rows["keypoints"][order], rows["keypoint_conf"][order]
+    valid = np.all(np.isfinite(keypoints), axis=-1) & np.any(keypoints != 0, axis=-1) & ~(conf < JITTER_MIN_CONF) # (0,0) : not found
+
+    result = np.full(len(order), np.nan, dtype=np.float32)
+    for shift in range(1, min(JITTER_LOOKBACK, len(order)-1)+1):
+        current, previous = slice(shift, None), slice(None, -shift)
+        gap = t_wall[current]-t_wall[previous]
+        both = valid[current] & valid[previous]
+        count = both.sum(axis=-1)
+        paired = ((person[current] == person[previous]) & (gap > 0) & (gap <= JITTER_MAX_GAP_S*1e9) &
+                  (count > 0) & (_iou(bbox[current], bbox[previous]) >= JITTER_MIN_IOU))
+        distance = np.where(both, np.linalg.norm(keypoints[current]-keypoints[previous], axis=-1), 0.).sum(axis=-1)
+        candidate = np.where(paired, distance/np.maximum(count, 1), np.nan)
+        result[current] = np.fmin(result[current], candidate) # closest of the matching detections
+    jitter[order] = result
+    return jitter
+
+
+# intersection over union of boxes (xyxy), nan boxes are not overlapping
+def _iou(a:np.ndarray, b:np.ndarray) -> np.ndarray:
+    width = np.clip(np.minimum(a[:, 2], b[:, 2])-np.maximum(a[:, 0], b[:, 0]), 0, None)
+    height = np.clip(np.minimum(a[:, 3], b[:, 3])-np.maximum(a[:, 1], b[:, 1]), 0, None)
+    inter = width*height
+    union = (a[:, 2]-a[:, 0])*(a[:, 3]-a[:, 1]) + (b[:, 2]-b[:, 0])*(b[:, 3]-b[:, 1]) - inter
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return np.nan_to_num(inter/union, nan=0.)
+
+
+'''
+cached columnar store of every session under the data root (only new or changed sessions are read again)
+'''
+class PoseStore:
+    def __init__(self, data_root:pathlib.Path, store_path:pathlib.Path=None):
+        self.data_root = pathlib.Path(data_root)
+        self.path = pathlib.Path(store_path) if store_path is not None else self.data_root / STORE_DIR_NAME
+        self.segments = [] # manifest entries {"id", "session", "camera", "source", "signature", "rows"}
+        self.columns = {}
+        self.load()
+
+    # memory-mapped columns of the stored segments
+    def load(self):
+        manifest = self.path / MANIFEST_FILE
+        self.segments, self.columns = [], {}
+        if not manifest.exists():
+            return
+        info = json.loads(manifest.read_text())
+        if info.get("version") != STORE_VERSION:
+            print(f"[Warning] analytics store version {info.get('version')} is rebuilt")
+            return
+        self.segments = info["segments"]
+        self.columns = {name:np.load(self.path / f"{name}.npy", mmap_mode="r") for name in STORE_COLUMNS}
+
+    # ingest new and changed sessions, drop removed ones, returns counts of the segments
+    def update(self, force:bool=False) -> dict:
+        t_start = time.perf_counter()
+        known = {(s["session"], s["camera"]):s for s in self.segments}
+        found = {}
+        sessions = sorted(p for p in self.data_root.iterdir() if p.is_dir() and not p.name.startswith(".")) if self.data_root.is_dir() else []
+        for session_path in sessions:
+            for camera_id, path in session_sources(session_path):
+                found[(session_path.name, camera_id)] = (path, source_signature(path))
+
+        keep = [s for key, s in known.items() if key in found and not force and s["signature"] == found[key][1]]
+        kept = {(s["session"], s["camera"]) for s in keep}
+        changed = [key for key in found if key not in kept]
+        removed = [key for key in known if key not in found]
+        counts = {"ingested":len(changed), "removed":len(removed), "unchanged":len(keep)}
+        if not changed and not removed:
+            return counts
+
+        # unchanged segments are taken from the store as they are
+        parts = []
+        if keep:
+            mask = np.isin(self.columns["segment"], [s["id"] for s in keep])
+            parts.append({name:np.asarray(column[mask]) for name, column in self.columns.items()})
+        next_id = max((s["id"] for s in self.segments), default=-1)+1
+        segments = list(keep)
+        for session, camera_id in sorted(changed):
+            path, signature = found[(session, camera_id)]
+            try:
+                rows = read_source(path)
+            except Exception as e:
+                print(f"[Warning] {session} camera {camera_id} is not ingested : {e}")
+                continue
+            parts.append(rows_to_columns(rows, next_id))
+            segments.append({"id":next_id, "session":session, "camera":camera_id,
+                             "source":str(path.relative_to(self.data_root)), "signature":signature, "rows":len(rows)})
+            next_id += 1
+
+        columns = {name:np.concatenate([part[name] for part in parts]) if parts else np.zeros(0, dtype=dtype)
+                   for name, dtype in STORE_COLUMNS.items()}
+        order = np.lexsort((columns["t_wall"], columns["segment"]))
+        self._save({name:column[order] for name, column in columns.items()}, sorted(segments, key=lambda s:s["id"]))
+        print(f"[Info] analytics store updated in {time.perf_counter()-t_start:.2f} s ({counts['ingested']} ingested, "
+              f"{counts['removed']} removed, {counts['unchanged']} unchanged)")
+        return counts
+
+    # replace the store directory with new columns and manifest
+    def _save(self, columns:dict, segments:list):
+        self.columns = {} # release memory maps of the files being replaced
+        staging = self.path.with_name(self.path.name+".tmp")
+        shutil.rmtree(staging, ignore_errors=True)
+        staging.mkdir(parents=True)
+        for name, column in columns.items():
+            np.save(staging / f"{name}.npy", column)
+        (staging / MANIFEST_FILE).write_text(json.dumps({"version":STORE_VERSION, "segments":segments}))
+        previous = self.path.with_name(self.path.name+".old")
+        if self.path.exists():
+            os.replace(self.path, previous)
+        os.replace(staging, self.path)
+        shutil.rmtree(previous, ignore_errors=True)
+        self.load()
+
+    # per group statistics {group:{frames, detection_ratio, jitter_px, <timing>_ms}} in wall-clock range [t_begin, t_end)
+    def query(self, by:str="session", t_begin=None, t_end=None) -> dict:
+        if by not in GROUP_BY:
+            raise ValueError(f"unknown grouping : {by} (one of {GROUP_BY})")
+        if not self.segments:
+            return {}
+        columns = self.columns
+        if t_begin is not None or t_end is not None:
+            t_wall = columns["t_wall"]
+            mask = np.ones(len(t_wall), dtype=bool)
+            if t_begin is not None:
+                mask &= t_wall >= _to_ns(t_begin)
+            if t_end is not None:
+                mask &= t_wall < _to_ns(t_end)
+            columns = {name:column[mask] for name, column in columns.items()}
+
+        # segment id -> group number
+        labels = [self._label(s, by) for s in self.segments]
+        names = sorted(set(labels))
+        lookup = np.full(max(s["id"] for s in self.segments)+1, -1, dtype=np.int64)
+        for s, label in zip(self.segments, labels):
+            lookup[s["id"]] = names.index(label)
+        groups = lookup[columns["segment"]]
+        n = len(names)
+
+        person, flags = columns["person"], columns["flags"]
+        frame = person <= 0 # one row per frame (first person, or no detection)
+        frames = np.bincount(groups[frame], minlength=n)
+        detected = np.bincount(groups[person == 0], minlength=n)
+        inferred = frame & (flags & (FLAG_HELD | FLAG_TRACKED) == 0) # the detector ran on the frame
+
+        result = {name:{"frames":int(frames[i]), "detected":int(detected[i]),
+                        "detection_ratio":round(float(detected[i]/frames[i]), 4) if frames[i] else None} for i, name in enumerate(names)}
+        stats = {"jitter_px":_distribution(groups, columns["jitter"], n, _DISTRIBUTION_SCALE["jitter"])}
+        for name in TIMING_COLUMNS:
+            stats[f"{name[2:]}_ms"] = _distribution(groups[inferred], columns[name][inferred], n, 1000.)
+        for key, values in stats.items():
+            for i, name in enumerate(names):
+                result[name][key] = values[i]
+        return {name:result[name] for i, name in enumerate(names) if frames[i]} # groups without rows in the time range are left out
+
+    # total rows and time span of the store
+    def info(self) -> dict:
+        t_wall = self.columns.get("t_wall")
+        return {"segments":len(self.segments), "sessions":len({s["session"] for s in self.segments}),
+                "rows":int(len(t_wall)) if t_wall is not None else 0,
+                "begin":datetime.fromtimestamp(t_wall.min()/1e9).isoformat() if t_wall is not None and len(t_wall) else None,
+                "end":datetime.fromtimestamp(t_wall.max()/1e9).isoformat() if t_wall is not None and len(t_wall) else None}
+
+    @staticmethod
+    def _label(segment:dict, by:str) -> str:
+        if by == "session":
+            return segment["session"]
+        if by == "camera":
+            return segment["camera"]
+        return f"{segment['session']}/{segment['camera']}"
+
+
+# count, mean, percentiles and max of values per group (log-linear histograms as metrics.LatencyHistogram, about 3% precision)
+def _distribution(groups:np.ndarray, values:np.ndarray, n:int, scale:float) -> list:
+    valid = np.isfinite(values)
+    groups, scaled = groups[valid], np.asarray(values[valid], dtype=np.float64)*scale
+    buckets = bucket_count()
+    counts = np.bincount(groups*buckets + bucket_indices(scaled), minlength=n*buckets).reshape(n, buckets)
+    total = counts.sum(axis=1)
+    sums = np.bincount(groups, weights=scaled, minlength=n)
+    maxima = np.full(n, 0.)
+    np.maximum.at(maxima, groups, scaled)
+    cumulative = np.cumsum(counts, axis=1)
+    summary = [{"count":int(total[i])} for i in range(n)]
+    for i in range(n):
+        if total[i] == 0:
+            continue
+        summary[i]["mean"] = round(sums[i]/total[i]/scale, 3)
+        summary[i]["max"] = round(maxima[i]/scale, 3)
+    for p in REPORT_PERCENTILES:
+        rank = np.maximum(1, (total*p/100. + 0.5).astype(np.int64))
+        index = np.argmax(cumulative >= rank[:, None], axis=1)
+        values_at = np.minimum(bucket_values(index), maxima)/scale
+        for i in range(n):
+            if total[i]:
+                summary[i][f"p{p}"] = round(float(values_at[i]), 3)
+    return summary
+
+
+# ns timestamp from datetime or ns
+def _to_ns(t) -> int:
+    return int(t.timestamp()*1e9) if isinstance(t, datetime) else int(t)
+
+
+# datetime from text (YYYY-mm-dd[ HH:MM[:SS[.fff]]])
+def _parse_time(text:str):
+    if text is None:
+        return None
+    for pattern in ("%Y-%m-%d %H:%M:%S.%f", "%Y-%m-%d %H:%M:%S", "%Y-%m-%d %H:%M", "%Y-%m-%d"):
+        try:
+            return datetime.strptime(text, pattern)
+        except ValueError:
+            continue
+    raise ValueError(f"unknown time format : {text} (YYYY-mm-dd[ HH:MM[:SS[.fff]]])")
+
+
+# timedelta from text (e.g. 7d, 12h, 30m)
+def _parse_span(text:str) -> timedelta:
+    match = re.fullmatch(r"(\d+(?:\.\d+)?)([dhm])", text)
+    if match is None:
+        raise ValueError(f"unknown time span : {text} (e.g. 7d, 12h, 30m)")
+    value, unit = float(match.group(1)), match.group(2)
+    return timedelta(**{{"d":"days", "h":"hours", "m":"minutes"}[unit]:value})
+
+
+def _print_table(result:dict, by:str):
+    timing = lambda stats: f"{stats.get('p50', 0):7.2f} {stats.get('p95', 0):7.2f} {stats.get('p99', 0):7.2f}" if stats["count"] else f"{'-':>7} {'-':>7} {'-':>7}"
+    print(f"{by:<32} {'frames':>7} {'detect%':>7} {'jitter px (p50/p95)':>19} | {'preprocess ms p50/p95/p99':>23} | "
+          f"{'inference ms p50/p95/p99':>23} | {'postprocess ms p50/p95/p99':>23}")
+    for name, stats in result.items():
+        jitter = stats["jitter_px"]
+        ratio = f"{stats['detection_ratio']*100:7.1f}" if stats["detection_ratio"] is not None else f"{'-':>7}"
+        jitter_text = f"{jitter.get('p50', 0):9.2f} {jitter.get('p95', 0):9.2f}" if jitter["count"] else f"{'-':>9} {'-':>9}"
+        print(f"{name:<32} {stats['frames']:>7} {ratio} {jitter_text} | {timing(stats['preprocess_ms'])} | "
+              f"{timing(stats['inference_ms'])} | {timing(stats['postprocess_ms'])}")
+
+
+'''
+Entry point (store update and queries)
+'''
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Detection ratio, keypoint jitter and inference timings of the recorded sessions")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    ingest = subparsers.add_parser("ingest", help="ingest new and changed sessions into the store")
+    ingest.add_argument('data', nargs='?', default="data", help="data root (default : data)")
+    ingest.add_argument('--force', action='store_true', help="ingest every session again")
+    query = subparsers.add_parser("query", help="statistics per session, camera or segment (session/camera)")
+    query.add_argument('data', nargs='?', default="data", help="data root (default : data)")
+    query.add_argument('--by', choices=GROUP_BY, default="session")
+    query.add_argument('--begin', default=None, help="start time (YYYY-mm-dd[ HH:MM[:SS[.fff]]])")
+    query.add_argument('--end', default=None, help="end time (exclusive)")
+    query.add_argument('--last', default=None, help="time span until now (e.g. 7d, 12h), instead of --begin")
+    query.add_argument('--no-update', action='store_true', help="query the store as it is (no check for new sessions)")
+    query.add_argument('--json', action='store_true', help="print the result as JSON")
+    args = parser.parse_args()
+
+    store = PoseStore(args.data)
+    if args.command == "ingest":
+        store.update(force=args.force)
+        print(f"[Info] analytics store : {store.info()}")
+    else:
+        if not args.no_update:
+            store.update()
+        t_begin = datetime.now()-_parse_span(args.last) if args.last else _parse_time(args.begin)
+        t_start = time.perf_counter()
+        result = store.query(args.by, t_begin, _parse_time(args.end))
+        elapsed = time.perf_counter()-t_start
+        if args.json:
+            print(json.dumps(result, indent=2))
+        else:
+            _print_table(result, args.by)
+            print(f"[Info] {len(result)} group(s) of {store.info()['rows']} rows queried in {elapsed*1000:.1f} ms")
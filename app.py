@@ -3,26 +3,17 @@
  @author Byunghun Hwang<bh.hwang@iae.re.kr>
 '''
 
-import sys, os
-from PyQt6 import QtGui
-import cv2
+import time
+T_LAUNCH = time.monotonic() # startup phases are measured from here
+
+import sys
 import pathlib
-import json
-from PyQt6.QtGui import QImage, QPixmap, QCloseEvent
-from PyQt6.QtWidgets import QApplication, QMainWindow, QLabel, QPushButton, QMessageBox
-from PyQt6.uic import loadUi
-from PyQt6.QtCore import QObject, Qt, QTimer, QThread, pyqtSignal, pyqtSlot
-import timeit
-import paho.mqtt.client as mqtt
-from datetime import datetime
 import argparse
-import time
-from ultralytics import YOLO
-import math
-import pynvml
+from PyQt6.QtCore import QTimer
 
-from window import CameraWindow
-from machine import MachineMonitor
+# heavy modules (ultralytics, torch) are imported when the pose model is loaded in background
+from metrics import StartupTimer
+from config import load_config
 
 # pre-defined options
 WORKING_PATH = pathlib.Path(__file__).parent
@@ -55,25 +46,30 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument('--broker', nargs='?', required=False, help="Broker IP Address", default="127.0.0.1")
     parser.add_argument('--config', nargs='?', required=False, help="Configuration File(*.cfg)", default="param.cfg")
+    parser.add_argument('--headless', action='store_true', help="run without GUI, controlled over the MQTT message API (broker 'loopback' : in-process stand-in)")
     args = parser.parse_args()
 
     broker_ip_address = ""
-    configure = {}
     if args.broker is not None:
         broker_ip_address = args.broker
-    if args.config is not None:
-        _config_name = args.config
-        configure = {
-            "camera_ids":[0,2,4,6],
-            "camera_windows_map":{
-                0:"window_camera_1",
-                2:"window_camera_2",
-                4:"window_camera_3",
-                6:"window_camera_4"
-            }
-        }
+    try:
+        configure = load_config(args.config) # defaults for the options not in the file
+    except (ValueError, OSError) as e:
+        print(f"[Error] configuration {args.config} : {e}")
+        sys.exit(1)
     
+    startup = StartupTimer(T_LAUNCH)
+    if args.headless:
+        from service import run_service # no widgets
+        startup.mark("imports")
+        sys.exit(run_service(broker_ip_address, configure, startup))
+
+    from PyQt6.QtWidgets import QApplication
+    from window import CameraWindow
+    startup.mark("imports")
     app = QApplication(sys.argv)
-    window = CameraWindow(broker_ip_address=broker_ip_address, config=configure)
+    window = CameraWindow(broker_ip_address=broker_ip_address, config=configure, startup=startup)
+    startup.mark("window created")
     window.show()
+    QTimer.singleShot(0, lambda: startup.mark("window shown")) # first event loop iteration
     sys.exit(app.exec())
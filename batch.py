@@ -0,0 +1,236 @@
+'''
+Headless offline batch mode (re-runs pose estimation over recorded sessions in parallel)
+@author bh.hwang@iae.re.kr
+'''
+
+import argparse
+import json
+import multiprocessing as mp
+import os
+import pathlib
+import re
+import resource
+import shutil
+import time
+from datetime import datetime
+import cv2
+import numpy as np
+from inference import PoseResult, load_pose_model, backend_predict_options, HPE_MODEL_PATH, BACKENDS, BACKEND_TORCH, PRECISIONS, PRECISION_FP32
+from poselog import PoseLogWriter, pose_rows, poselog_path, POSE_DTYPE, FLAG_DETECTED, FLAG_ESTIMATED_TIME
+from frameindex import index_path, INDEX_ESTIMATED
+
+# pre-defined options
+RAW_VIDEO_PATTERN = re.compile(r"^cam_(?P<camera_id>\w+)\.avi$") # raw videos only (not proc_cam_*)
+SESSION_TIME_FORMAT = "%Y-%m-%d-%H-%M-%S"
+CHUNK_FRAMES = 300 # frames per task
+PREDICT_BATCH_SIZE = 8 # frames per predict call
+WORKER_THREADS = 4 # torch threads per worker process (default workers : cores // WORKER_THREADS, every worker holds its own model)
+PROGRESS_INTERVAL = 2.0 # sec
+
+# model of the worker process
+_worker_model = None
+
+
+# process pool initializer (loads the model once per worker)
+def _init_worker(model_path:str, backend:str, imgsz:int, precision:str, num_threads:int):
+    global _worker_model
+    cv2.setNumThreads(1)
+    try:
+        import torch
+        torch.set_num_threads(num_threads)
+    except ImportError:
+        pass
+    _worker_model = load_pose_model(model_path, backend, imgsz, precision)
+    resident = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024. # KB on Linux
+    print(f"[Info] batch worker {os.getpid()} loaded the model ({resident:.0f} MB resident, {num_threads} thread(s))")
+
+
+# predict a batch of frames and convert to log rows (times : camera frame index, t_mono, t_wall (ns) and flags per video frame)
+def _predict_rows(frames:list, indices:list, times:np.ndarray, predict_options:dict) -> list:
+    results = _worker_model.predict([cv2.cvtColor(f, cv2.COLOR_BGR2RGB) for f in frames], **predict_options) # same input as live recording
+    rows = []
+    for index, result in zip(indices, results):
+        source, t_mono, t_wall, flags = times[index]
+        frame_rows = pose_rows(0., None, source, PoseResult.from_ultralytics(result), FLAG_DETECTED | flags)
+        frame_rows["t_mono"], frame_rows["t_wall"] = t_mono, t_wall # recorded timestamps as they are (ns)
+        rows.append(frame_rows)
+    return rows
+
+
+# decode and process a range of frames of a video (runs in a worker process)
+def _process_chunk(task:tuple):
+    video_path, start, count, times, batch_size, predict_options = task
+    t_start = time.perf_counter()
+
+    capture = cv2.VideoCapture(str(video_path))
+    capture.set(cv2.CAP_PROP_POS_FRAMES, start)
+    rows = []
+    frames = []
+    indices = []
+    for index in range(start, start+count):
+        ret, frame = capture.read() # streaming decode
+        if not ret:
+            break
+        frames.append(frame)
+        indices.append(index-start)
+        if len(frames) == batch_size:
+            rows += _predict_rows(frames, indices, times, predict_options)
+            frames, indices = [], []
+    if frames:
+        rows += _predict_rows(frames, indices, times, predict_options)
+    capture.release()
+
+    processed = len(rows)
+    rows = np.concatenate(rows) if rows else np.zeros(0, dtype=POSE_DTYPE)
+    return rows, processed, time.perf_counter()-t_start
+
+
+# session start time from directory name (data/<%Y-%m-%d-%H-%M-%S>)
+def session_start_time(session_path:pathlib.Path) -> float:
+    try:
+        return datetime.strptime(session_path.name, SESSION_TIME_FORMAT).timestamp()
+    except ValueError:
+        return session_path.stat().st_mtime
+
+
+# camera frame index, timestamps (ns) and row flags of every video frame : (source, t_mono, t_wall, flags) rows
+# from the seek index (index_cam_<id>.npy), the first recorded frame (record_cam_<id>.json) or the session start time
+def frame_times(session_path:pathlib.Path, camera_id, total:int, fps:float) -> np.ndarray:
+    period = 1e9/fps
+    times = np.zeros(total, dtype=[("source", "<i8"), ("t_mono", "<i8"), ("t_wall", "<i8"), ("flags", "u1")])
+    times["flags"] = FLAG_ESTIMATED_TIME
+    steps = np.arange(total)
+
+    path = index_path(session_path, camera_id)
+    index = np.load(path)[:total] if path.exists() else None
+    record = session_path / f"record_cam_{camera_id}.json"
+    info = json.loads(record.read_text()) if record.exists() else {}
+    first = dict(info["pretrigger"], index=info["pretrigger"]["first_index"]) if info.get("pretrigger") else info.get("first_frame")
+    if index is not None and len(index):
+        # frames beyond the index (e.g. cut off by a crash) continue with the frame period
+        last = index[-1]
+        n = len(index)
+        times["source"][:n] = index["source"]
+        times["t_mono"][:n] = index["t_mono"]
+        times["t_wall"][:n] = index["t_wall"]
+        times["flags"][:n] = np.where(index["flags"] & INDEX_ESTIMATED, FLAG_ESTIMATED_TIME, 0)
+        times["source"][n:] = last["source"]+steps[1:total-n+1] if last["source"] >= 0 else -1
+        times["t_mono"][n:] = last["t_mono"]+steps[1:total-n+1]*period if last["t_mono"] >= 0 else -1
+        times["t_wall"][n:] = last["t_wall"]+steps[1:total-n+1]*period
+    elif first is not None:
+        # raw video frames are consecutive camera frames from the first recorded one
+        times["source"] = first["index"]+steps
+        times["t_mono"] = first["t_mono"]*1e9+steps*period
+        times["t_wall"] = first["t_wall"]*1e9+steps*period
+    else:
+        # legacy session : start time from the directory name
+        times["source"] = steps
+        times["t_mono"] = -1
+        times["t_wall"] = session_start_time(session_path)*1e9+steps*period
+    return times
+
+
+# raw videos of a session (camera id -> path)
+def find_raw_videos(session_path:pathlib.Path) -> dict:
+    videos = {}
+    for path in sorted(session_path.iterdir()):
+        matched = RAW_VIDEO_PATTERN.match(path.name)
+        if matched:
+            videos[matched.group("camera_id")] = path
+    return videos
+
+
+'''
+offline batch processor
+'''
+class BatchProcessor:
+    def __init__(self, model_path:str=HPE_MODEL_PATH, workers:int=None, chunk_frames:int=CHUNK_FRAMES,
+                 batch_size:int=PREDICT_BATCH_SIZE, overwrite:bool=False, backend:str=BACKEND_TORCH, imgsz:int=None, precision:str=PRECISION_FP32):
+        self.model_path = model_path
+        self.backend = backend
+        self.imgsz = imgsz
+        self.precision = precision
+        self.predict_options = backend_predict_options(backend, precision, imgsz)
+        self.workers = workers if workers else max(1, (os.cpu_count() or 1)//WORKER_THREADS)
+        self.chunk_frames = chunk_frames
+        self.batch_size = batch_size
+        self.overwrite = overwrite
+
+    # split every video into frame range tasks (in video/frame order)
+    def _make_jobs(self, sessions:list) -> list:
+        jobs = []
+        for session_path in sessions:
+            session_path = pathlib.Path(session_path)
+            for camera_id, video_path in find_raw_videos(session_path).items():
+                out_path = poselog_path(session_path, camera_id)
+                if out_path.exists():
+                    if not self.overwrite:
+                        print(f"[Warning] {out_path} already exists, skipped (use --overwrite)")
+                        continue
+                    shutil.rmtree(out_path)
+
+                capture = cv2.VideoCapture(str(video_path))
+                total = int(capture.get(cv2.CAP_PROP_FRAME_COUNT))
+                fps = capture.get(cv2.CAP_PROP_FPS) or 30.
+                capture.release()
+                if total <= 0:
+                    print(f"[Warning] {video_path} has no frame, skipped")
+                    continue
+
+                times = frame_times(session_path, camera_id, total, fps)
+                tasks = [(video_path, start, min(self.chunk_frames, total-start), times[start:start+self.chunk_frames], self.batch_size, self.predict_options)
+                         for start in range(0, total, self.chunk_frames)]
+                jobs.append((out_path, total, tasks))
+        return jobs
+
+    # process sessions, returns total number of processed frames
+    def run(self, sessions:list) -> int:
+        jobs = self._make_jobs(sessions)
+        total_frames = sum(total for _, total, _ in jobs)
+        if total_frames == 0:
+            print("[Info] nothing to process")
+            return 0
+
+        print(f"[Info] {total_frames} frames of {len(jobs)} video(s) with {self.workers} worker(s)")
+        num_threads = max(1, (os.cpu_count() or 1)//self.workers)
+        processed = 0
+        t_start = time.perf_counter()
+        t_report = t_start
+        with mp.get_context("spawn").Pool(self.workers, initializer=_init_worker, initargs=(self.model_path, self.backend, self.imgsz, self.precision, num_threads)) as pool:
+            for out_path, total, tasks in jobs:
+                writer = PoseLogWriter(out_path)
+                for rows, count, _ in pool.imap(_process_chunk, tasks): # in order, workers run ahead
+                    writer.append(rows)
+                    processed += count
+                    now = time.perf_counter()
+                    if now-t_report > PROGRESS_INTERVAL:
+                        t_report = now
+                        print(f"[Info] progress {processed}/{total_frames} frames ({processed/total_frames*100.:.1f}%), {processed/(now-t_start):.1f} fps")
+                writer.close()
+                print(f"[Info] {out_path} is written ({writer.rows_written} rows)")
+
+        elapsed = time.perf_counter()-t_start
+        print(f"[Info] processed {processed} frames in {elapsed:.1f}s ({processed/elapsed:.1f} fps)")
+        return processed
+
+
+'''
+Entry point
+'''
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Re-run pose estimation over recorded sessions (no GUI and no camera required)")
+    parser.add_argument('sessions', nargs='+', help="session directories (e.g. data/2023-11-23-18-09-36)")
+    parser.add_argument('--model', nargs='?', required=False, help="pose model", default=HPE_MODEL_PATH)
+    parser.add_argument('--workers', type=int, required=False, default=None,
+                        help=f"number of worker processes (default : cores // {WORKER_THREADS}). "
+                             "Every worker loads its own model copy (memory grows with the workers), the cores are shared among them as torch threads")
+    parser.add_argument('--chunk', type=int, required=False, help="frames per task", default=CHUNK_FRAMES)
+    parser.add_argument('--batch', type=int, required=False, help="frames per predict call", default=PREDICT_BATCH_SIZE)
+    parser.add_argument('--overwrite', action='store_true', help="replace existing keypoint logs")
+    parser.add_argument('--backend', nargs='?', required=False, choices=BACKENDS, default=BACKEND_TORCH)
+    parser.add_argument('--precision', nargs='?', required=False, choices=PRECISIONS, default=PRECISION_FP32)
+    parser.add_argument('--imgsz', type=int, required=False, help="model input size", default=None)
+    args = parser.parse_args()
+
+    processor = BatchProcessor(args.model, args.workers, args.chunk, args.batch, args.overwrite, args.backend, args.imgsz, args.precision)
+    processor.run(args.sessions)
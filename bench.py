@@ -0,0 +1,229 @@
+'''
+End-to-end throughput/latency benchmark (capture -> infer -> draw -> record -> display) for 1 to N cameras
+@author bh.hwang@iae.re.kr
+'''
+
+import argparse
+import json
+import os
+import pathlib
+import platform
+import resource
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+import numpy as np
+from PyQt6.QtCore import QCoreApplication, Qt
+from inference import PoseInferenceEngine, HPE_MODEL_PATH, INFERENCE_MAX_WAIT_MS
+from source import create_source
+from camera import CameraController
+from worker import CameraWorkerProcess
+from session import RecordingSession
+
+# pre-defined options
+WORKING_PATH = pathlib.Path(__file__).parent
+BENCH_RESULT_DIR = WORKING_PATH / "bench" / "results"
+BENCH_SOURCE = "synthetic:1920x1080@30"
+BENCH_DURATION = 20.0 # sec
+BENCH_WARMUP = 5.0 # sec
+
+
+'''
+collects emitted frames of a camera (called from the camera thread)
+'''
+class _OutputProbe:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latency = [] # glass-to-output latency (sec)
+        self.measuring = False
+
+    def on_output(self, index:int, t_grab:float):
+        t_out = time.monotonic()
+        if self.measuring:
+            with self.lock:
+                self.latency.append(t_out-t_grab)
+
+
+# peak resident set size of this process (bytes)
+def peak_rss() -> int:
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == "darwin" else rss*1024
+
+
+# run benchmark with given number of cameras (in this process)
+def run_single(num_cameras:int, source:str, duration:float, warmup:float, realtime:bool, record:bool,
+               model_path:str, batch_size:int, max_wait_ms:float, processes:bool=False) -> dict:
+    app = QCoreApplication.instance() or QCoreApplication(sys.argv)
+    out_dir = pathlib.Path(tempfile.mkdtemp(prefix="avsim-cam-bench-"))
+    config = {"data_out_dir":str(out_dir), "hpe_model":model_path}
+
+    # camera worker processes load their own model (no shared engine)
+    engine = None
+    if not processes:
+        engine = PoseInferenceEngine(model_path=model_path, batch_size=batch_size, max_wait_ms=max_wait_ms)
+        engine.start()
+
+    cameras = []
+    probes = []
+    for camera_id in range(num_cameras):
+        camera_class = CameraWorkerProcess if processes else CameraController
+        camera = camera_class(camera_id, engine=engine, config=config, source=create_source(source, realtime=realtime, loop=True))
+        if not camera.open():
+            raise RuntimeError(f"cannot open frame source {source}")
+        probe = _OutputProbe()
+        camera.frame_output_slot.connect(probe.on_output, Qt.ConnectionType.DirectConnection)
+        cameras.append(camera)
+        probes.append(probe)
+
+    session = RecordingSession(out_dir)
+    for camera in cameras:
+        camera.begin()
+        if record:
+            camera.prepare_recording(session.path)
+    time.sleep(warmup)
+
+    # measurement
+    grab_begin = [camera.frame_stats() for camera in cameras]
+    if record:
+        session.start([camera.camera_id for camera in cameras])
+        for camera in cameras:
+            camera.start_recording(session.path, session.t_start, session.t_start_wall)
+    for probe in probes:
+        probe.measuring = True
+    t_begin = time.monotonic()
+    time.sleep(duration)
+    for probe in probes:
+        probe.measuring = False
+    elapsed = time.monotonic()-t_begin
+    grab_end = [camera.frame_stats() for camera in cameras]
+    writer_stats = [camera.recorder_stats() for camera in cameras]
+
+    for camera in cameras:
+        camera.stop_recording()
+        camera.close()
+    if engine is not None:
+        engine.close()
+    shutil.rmtree(out_dir, ignore_errors=True)
+
+    per_camera = []
+    all_latency = []
+    for camera, probe, begin, end, writers in zip(cameras, probes, grab_begin, grab_end, writer_stats):
+        latency = np.asarray(probe.latency)*1000.
+        all_latency.append(latency)
+        per_camera.append({
+            "camera":camera.camera_id,
+            "grabbed_fps":(end["pushed"]-begin["pushed"])/elapsed,
+            "output_fps":len(latency)/elapsed,
+            "dropped_frames":end["dropped"]-begin["dropped"],
+            "writer_dropped":sum(w["dropped"] for w in writers.values()),
+            "latency_ms":_percentiles(latency),
+        })
+    all_latency = np.concatenate(all_latency) if all_latency else np.zeros(0)
+
+    return {
+        "cameras":num_cameras,
+        "duration":elapsed,
+        "output_fps":sum(c["output_fps"] for c in per_camera),
+        "grabbed_fps":sum(c["grabbed_fps"] for c in per_camera),
+        "dropped_frames":sum(c["dropped_frames"] for c in per_camera),
+        "writer_dropped":sum(c["writer_dropped"] for c in per_camera),
+        "latency_ms":_percentiles(all_latency),
+        "mean_batch_size":engine.mean_batch_size() if engine is not None else None,
+        "peak_rss_mb":peak_rss()/(1024*1024),
+        "per_camera":per_camera,
+    }
+
+
+# latency percentiles (ms)
+def _percentiles(values:np.ndarray) -> dict:
+    if len(values) == 0:
+        return {"p50":None, "p95":None, "p99":None, "max":None}
+    p50, p95, p99 = np.percentile(values, [50, 95, 99])
+    return {"p50":float(p50), "p95":float(p95), "p99":float(p99), "max":float(values.max())}
+
+
+# machine description (to compare runs on the same machine)
+def machine_info() -> dict:
+    import cv2
+    return {"hostname":socket.gethostname(), "platform":platform.platform(), "processor":platform.processor(),
+            "cpu_count":os.cpu_count(), "python":platform.python_version(), "opencv":cv2.__version__}
+
+
+# print difference against a previous result file
+def compare(result:dict, baseline_path:pathlib.Path):
+    baseline = json.loads(pathlib.Path(baseline_path).read_text())
+    if baseline["machine"]["hostname"] != result["machine"]["hostname"]:
+        print(f"[Warning] baseline was measured on another machine ({baseline['machine']['hostname']})")
+    previous = {r["cameras"]:r for r in baseline["runs"]}
+    for run in result["runs"]:
+        base = previous.get(run["cameras"])
+        if base is None:
+            continue
+        print(f"{run['cameras']} camera(s) : fps {base['output_fps']:.1f} -> {run['output_fps']:.1f}, "
+              f"p99 {base['latency_ms']['p99']} -> {run['latency_ms']['p99']} ms, "
+              f"dropped {base['dropped_frames']} -> {run['dropped_frames']}, "
+              f"peak rss {base['peak_rss_mb']:.0f} -> {run['peak_rss_mb']:.0f} MB")
+
+
+'''
+Entry point
+'''
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="End-to-end pipeline benchmark")
+    parser.add_argument('--cameras', type=int, required=False, help="max. number of cameras (runs 1 to N)", default=4)
+    parser.add_argument('--source', nargs='?', required=False, help="frame source (synthetic:<w>x<h>@<fps>, file:<path>, v4l2:<id>)", default=BENCH_SOURCE)
+    parser.add_argument('--unthrottled', action='store_true', help="deliver source frames as fast as possible")
+    parser.add_argument('--no-record', action='store_true', help="disable recording stage")
+    parser.add_argument('--duration', type=float, required=False, help="measurement time per run (sec)", default=BENCH_DURATION)
+    parser.add_argument('--warmup', type=float, required=False, help="warmup time per run (sec)", default=BENCH_WARMUP)
+    parser.add_argument('--model', nargs='?', required=False, help="pose model", default=HPE_MODEL_PATH)
+    parser.add_argument('--batch', type=int, required=False, help="inference batch size (default : number of cameras)", default=None)
+    parser.add_argument('--max-wait-ms', type=float, required=False, help="inference batch max. wait", default=INFERENCE_MAX_WAIT_MS)
+    parser.add_argument('--processes', action='store_true', help="run every camera in its own worker process")
+    parser.add_argument('--out', nargs='?', required=False, help="result file (*.json)", default=None)
+    parser.add_argument('--compare', nargs='?', required=False, help="previous result file to compare with", default=None)
+    parser.add_argument('--single', type=int, required=False, help=argparse.SUPPRESS, default=None) # internal : one run per process
+    args = parser.parse_args()
+
+    if args.single is not None:
+        run = run_single(args.single, args.source, args.duration, args.warmup, not args.unthrottled, not args.no_record,
+                         args.model, args.batch or args.single, args.max_wait_ms, args.processes)
+        print(json.dumps(run))
+        sys.exit(0)
+
+    # every run in a fresh process (for independent peak rss)
+    runs = []
+    for num_cameras in range(1, args.cameras+1):
+        print(f"[Info] benchmark with {num_cameras} camera(s)...")
+        command = [sys.executable, __file__, "--single", str(num_cameras), "--source", args.source, "--duration", str(args.duration),
+                   "--warmup", str(args.warmup), "--model", args.model, "--max-wait-ms", str(args.max_wait_ms)]
+        if args.unthrottled:
+            command.append("--unthrottled")
+        if args.no_record:
+            command.append("--no-record")
+        if args.processes:
+            command.append("--processes")
+        if args.batch:
+            command += ["--batch", str(args.batch)]
+        output = subprocess.run(command, check=True, capture_output=True, text=True).stdout
+        run = json.loads(output.strip().splitlines()[-1])
+        print(f"[Info] {num_cameras} camera(s) : {run['output_fps']:.1f} fps, latency p50/p95/p99 {run['latency_ms']['p50']}/{run['latency_ms']['p95']}/{run['latency_ms']['p99']} ms, "
+              f"{run['dropped_frames']} dropped, peak rss {run['peak_rss_mb']:.0f} MB")
+        runs.append(run)
+
+    result = {"timestamp":datetime.now().isoformat(), "machine":machine_info(),
+              "options":{"source":args.source, "realtime":not args.unthrottled, "record":not args.no_record, "processes":args.processes, "duration":args.duration,
+                         "model":args.model, "batch":args.batch, "max_wait_ms":args.max_wait_ms},
+              "runs":runs}
+    out_path = pathlib.Path(args.out) if args.out else BENCH_RESULT_DIR / f"{socket.gethostname()}-{datetime.now().strftime('%Y%m%d-%H%M%S')}.json"
+    out_path.parent.mkdir(parents=True, exist_ok=True)
+    out_path.write_text(json.dumps(result, indent=2))
+    print(f"[Info] benchmark result is saved : {out_path}")
+
+    if args.compare:
+        compare(result, args.compare)
@@ -4,6 +4,7 @@ In-Cabin Camera Controller Class
 '''
 
 import sys, os
+import math
 from PyQt6 import QtGui
 import cv2
 import pathlib
@@ -16,9 +17,22 @@ import timeit
 import paho.mqtt.client as mqtt
 from datetime import datetime
 from datetime import datetime
-from ultralytics import YOLO
-import csv
 from itertools import chain
+import threading
+import time
+import numpy as np
+from framebuffer import FrameRingBuffer
+from inference import PoseInferenceEngine, PoseResult, create_engine
+from poselog import pose_rows, FLAG_DETECTED, FLAG_TRACKED, FLAG_HELD
+from roi import RoiSelector, ROI_MODE_OFF, ROI_MARGIN, ROI_MIN_SIZE
+from tracker import KeypointTracker, AdaptiveDetectionScheduler, DETECT_INTERVAL_MIN, DETECT_INTERVAL_MAX, TRACK_CONF_THRESHOLD, TRACK_ERROR_TOLERANCE
+from source import FrameSource, create_source, format_mismatch, format_text
+from config import camera_profile
+from metrics import PipelineMetrics
+from session import RecordingSession
+from pretrigger import create_pretrigger
+from recorder import SessionRecorder, AsyncWriter, ImageSink, WRITER_QUEUE_SIZE, OVERFLOW_BLOCK, OVERFLOW_DROP
+from concurrent.futures import CancelledError, TimeoutError as FutureTimeoutError, ThreadPoolExecutor, as_completed
 
 # pre-defined options
 WORKING_PATH = pathlib.Path(__file__).parent
@@ -29,6 +43,10 @@ VIDEO_FILE_EXT = "avi"
 CAMERA_RECORD_FPS = 30
 CAMERA_RECORD_WIDTH = 1920
 CAMERA_RECORD_HEIGHT = 1080
+CAMERA_PREVIEW_WIDTH = 640
+CAMERA_PREVIEW_HEIGHT = 360
+CAMERA_PREVIEW_FPS = 15 # max. preview refresh rate (0 means every processed frame)
+FRAME_BUFFER_SIZE = 4 # latest frames kept between grab and inference stage
 
 
 # camera interfaces for GUI
@@ -40,142 +58,387 @@ camera controller class
 '''
 class CameraController(QThread):
     image_frame_slot = pyqtSignal(QImage)
+    frame_output_slot = pyqtSignal(int, float) # frame index, grab time (time.monotonic) of the emitted frame
 
-    def __init__(self, camera_id):
+    def __init__(self, camera_id, engine:PoseInferenceEngine=None, config:dict=None, source=None):
         super().__init__()
+        self.setObjectName(f"cam-{camera_id}")
 
         self.camera_id = camera_id # camera idinfo
+        self.config = config if config is not None else {}
+        self.source = source if source is not None else camera_id # frame source (V4L2 device by default)
+        self.profile = camera_profile(self.config, camera_id) # capture format, inference, recording codec and preview size
+        self.capture_format = None # format negotiated with the device at open
         self.recording_start_trigger = False # True means starting
         self.is_recording = False # video recording status
         self.is_capturing = False # image capturing status
-        self.data_out_path = DATA_OUT_DIR
+        self.data_root = pathlib.Path(self.config.get("data_out_dir", DATA_OUT_DIR))
+        self.data_out_path = self.data_root
         self.grabber = None
-        self.raw_video_writer = None
-        self.processed_video_writer = None
-        self.pose_csvfile = None
-        self.pose_csvfile_writer = None
+        self.recorder = None # recording session writers (SessionRecorder)
+        self.pending_recorder = None # writers opened ahead of the next record trigger
+        self.record_start_time = 0. # common start timestamp of the session (time.monotonic), older frames are not recorded
+        self.pose_start_time = 0. # keypoints are logged from here (earliest pre-trigger frame, or the start timestamp)
+        self.pretrigger = create_pretrigger(camera_id, self.config) # last seconds before the record trigger (None if disabled)
+        self.closing_recorders = [] # recorders being flushed in background
+        self.snapshot_writer = AsyncWriter(ImageSink(), f"snapshot_cam_{camera_id}", queue_size=4, overflow=OVERFLOW_DROP)
         self.capture_start_time = timeit.default_timer()
         self.capture_delay = 1 # 1 sec
 
         self.start_trigger_on = False # trigger for starting 
 
-        # for pose estimation
-        print("Load HPE model...")
-        self.hpe_model = YOLO(model="./model/yolov8x-pose.pt")
-        self.hpe_activated = True
+        # grab stage (drains the device at full camera rate)
+        self.frame_buffer = FrameRingBuffer(FRAME_BUFFER_SIZE)
+        self.frame_grabber = FrameGrabber(self)
+        self.writer_lock = threading.Lock() # recorder is used by grab & inference stage
+
+        # for preview (display rate is decoupled from capture and inference rate)
+        self.preview_size = (CAMERA_PREVIEW_WIDTH, CAMERA_PREVIEW_HEIGHT)
+        self.preview_fps = self.config.get("preview_fps", CAMERA_PREVIEW_FPS)
+        self.preview_enabled = self.config.get("preview_enabled", True) # False in headless mode (nothing to display)
+        self.last_preview_time = 0.
+
+        # per-stage latency histograms
+        self.metrics = PipelineMetrics(f"cam{camera_id}", enabled=self.config.get("metrics_enabled", True))
+
+        # for pose estimation (shared engine, or a private one if not given)
+        self.owns_engine = engine is None
+        self.hpe_engine = create_engine(self.config, batch_size=1) if engine is None else engine
+        inference = self.profile["inference"]
+        self.hpe_activated = inference["enabled"]
+        self.inference_fps = inference["fps"] if inference["fps"] is not None else self.config.get("inference_fps", 0) # max. inference rate (0 means every processed frame)
+        self.record_processed = self.config.get("record_processed_video", True) # annotated video recorded live (False : raw video and keypoints only, rendered afterwards)
+        self.inference_imgsz = inference["imgsz"] # model input size of this camera (None means engine default)
+        self.configured_quality = {"inference_fps":self.inference_fps, "imgsz":self.inference_imgsz, "preview_fps":self.preview_fps} # upper limits of set_quality
+        self.last_inference_time = 0.
+        self.last_pose = PoseResult.empty()
+        self.keypoint_streamer = None # keypoint telemetry (set by the owner before begin)
+
+        # for region of interest cropping before inference
+        self.roi = RoiSelector(mode=self.config.get("roi_mode", ROI_MODE_OFF), static_roi=self.config.get("roi_static", None),
+                               margin=self.config.get("roi_margin", ROI_MARGIN), min_size=self.config.get("roi_min_size", ROI_MIN_SIZE))
+
+        # for detect-every-N-frames with keypoint tracking in between (disabled if detect_interval_max is 1)
+        self.tracker = KeypointTracker()
+        self.detect_scheduler = AdaptiveDetectionScheduler(min_interval=self.config.get("detect_interval_min", DETECT_INTERVAL_MIN),
+                                                           max_interval=self.config.get("detect_interval_max", DETECT_INTERVAL_MAX),
+                                                           conf_threshold=self.config.get("track_conf_threshold", TRACK_CONF_THRESHOLD),
+                                                           error_tolerance=self.config.get("track_error_tolerance", TRACK_ERROR_TOLERANCE))
 
 
     # open camera device (if open success, return True, otherwise return False)
     def open(self) -> bool:
-        self.grabber = cv2.VideoCapture(self.camera_id, cv2.CAP_V4L2) # video capture instance with opencv
+        self.grabber = create_source(self.source, capture=self.profile["capture"]) # V4L2 device, video file or synthetic frames
         
-        if not self.grabber.isOpened():
+        if not self.grabber.open():
             return False
         
-        print(f"[Info] connected camera device {self.camera_id}")
+        # format negotiated with the device (the driver may fall back to the nearest supported mode)
+        self.capture_format = self.grabber.format()
+        print(f"[Info] connected camera device {self.camera_id} ({self.grabber}) : {format_text(self.capture_format)}")
+        mismatch = format_mismatch(getattr(self.grabber, "requested", {}), self.capture_format)
+        if mismatch:
+            print(f"[Warning] camera {self.camera_id} format is not as requested : " +
+                  ", ".join(f"{key} {requested} -> {negotiated}" for key, (requested, negotiated) in mismatch.items()))
 
         self.is_recording = False
         return True
 
-    # recording by thread
+    # inference stage by thread (takes the newest grabbed frame, older ones are dropped)
     def run(self):
         while True:
             if self.isInterruptionRequested():
                 print(f"camera {self.camera_id} controller worker is interrupted")
                 break
-            
-            t_start = datetime.now()
-            ret, frame = self.grabber.read() # grab
-
-            if frame is not None:
-                frame_rgb = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB) # warning! it should be converted from BGR to RGB. But each camera IR turns ON, grayscale is able to use. (grayscale is optional)
-
-                # performing pose estimation
-                if self.hpe_activated:
-                    results = self.hpe_model.predict(frame_rgb, iou=0.7, conf=0.7, verbose=False)
-
-                    # count found
-                    log_bbox = []
-                    log_kps = []
-                    if len(results[0].boxes)==0:
-                        log_bbox = [float('nan') for i in range(4)]
-                        log_kps = [float('nan') for i in range(17*2)]
-                    else:
-                        # draw key points
-                        for kps in results[0].keypoints.xy.tolist(): #for multi-person
-                            for kp in kps:
-                                cv2.circle(frame_rgb, center=(int(kp[0]), int(kp[1])), radius=7, color=(255,0,0), thickness=-1)
-                                log_kps = log_kps + kp
-                        
-                        # draw bounding box
-                        for bbox in results[0].boxes.xyxy.tolist():
-                            # cv2.rectangle(frame_rgb, pt1=(int(bbox[0]), int(bbox[1])), pt2=(int(bbox[2]), int(bbox[3])), color=(255,0,0), thickness=1)
-                            log_bbox = log_bbox + bbox
-
-                # recording if recording status flag is on
-                if self.is_recording:
-                    self.raw_video_record(frame)
-                    self.processed_video_record(frame_rgb)
-                    logdata = [t_start.strftime('%Y-%m-%d %H:%M:%S.%f')[:-3]] + log_kps + log_bbox + [results[0].speed['preprocess'], results[0].speed['inference'], results[0].speed['postprocess']]
-                    self.pose_csvfile_writer.writerow(logdata)
-                elif self.is_capturing:
-                    if timeit.default_timer()-self.capture_start_time>self.capture_delay:
-                        cv2.imwrite(f"{self.camera_id}.png", frame)
-                        print(f"Captured image from {self.camera_id}")
-                        self.is_capturing = False
-
-                # camera monitoring (only for RGB color image)
-                t_end = datetime.now()
-                framerate = int(1./(t_end - t_start).total_seconds())
-                cv2.putText(frame_rgb, f"Camera #{self.camera_id}(fps:{framerate}, processing time:{int(results[0].speed['preprocess']+results[0].speed['inference']+results[0].speed['postprocess'])}ms)", (10,50), cv2.FONT_HERSHEY_SIMPLEX, 1.5, (0,255,0), 2, cv2.LINE_AA)
-                cv2.putText(frame_rgb, t_start.strftime('%Y-%m-%d %H:%M:%S.%f')[:-3], (10, 1070), cv2.FONT_HERSHEY_SIMPLEX, 1.5, (0,255,0), 2, cv2.LINE_AA)
-
-                _h, _w, _ch = frame_rgb.shape
-                _bpl = _ch*_w # bytes per line
-                qt_image = QImage(frame_rgb.data, _w, _h, _bpl, QImage.Format.Format_RGB888)
-                self.image_frame_slot.emit(qt_image)
+
+            frame_t = self.frame_buffer.get_latest(timeout=0.1)
+            if frame_t is None:
+                continue
+
+            clock = self.metrics.clock(frame_t.t_mono) # no-op if instrumentation is disabled
+            clock.lap("queue")
+
+            frame = frame_t.image
+            t_start = datetime.fromtimestamp(frame_t.t_wall)
+            frame_rgb = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB) # warning! it should be converted from BGR to RGB. But each camera IR turns ON, grayscale is able to use. (grayscale is optional)
+            clock.lap("convert")
+
+            # performing pose estimation (detector, or tracker between detections)
+            pose = PoseResult.empty()
+            flags = 0
+            if self.hpe_activated:
+                if self.is_inference_due(frame_t.t_mono):
+                    pose, flags = self.estimate_pose(frame, frame_rgb)
+                    if pose is None:
+                        continue # interrupted
+                    self.last_pose = pose
+                else:
+                    pose, flags = self.last_pose, FLAG_HELD # inference rate is limited (e.g. by the governor)
+                clock.lap("predict")
+
+            # processed frame (drawn at full resolution only when it is recorded)
+            recording = self.is_recording and frame_t.t_mono >= self.record_start_time
+            drawn = recording and self.record_processed
+            if drawn:
+                self.draw_keypoints(frame_rgb, pose.keypoints)
+                clock.lap("draw")
+
+            # recording if recording status flag is on (raw video is recorded by the grab stage)
+            if drawn:
+                self.processed_video_record(frame_rgb)
+            rows = pose_rows(frame_t.t_wall, frame_t.t_mono, frame_t.index, pose, flags)
+            with self.writer_lock: # pre-trigger frames handed over uncompressed get their keypoints logged too
+                logged = self.is_recording and frame_t.t_mono >= self.pose_start_time
+                if not logged and self.pretrigger != None and not self.is_recording and self.hpe_activated:
+                    self.pretrigger.put_pose(frame_t.t_mono, rows)
+            if logged:
+                self.pose_record(rows)
+            if not recording and self.is_capturing:
+                if timeit.default_timer()-self.capture_start_time>self.capture_delay:
+                    self.snapshot_writer.put((f"{self.camera_id}.png", frame))
+                    print(f"Captured image from {self.camera_id}")
+                    self.is_capturing = False
+            clock.lap("write")
+
+            # camera monitoring (downscaled in this thread, at most preview_fps)
+            if self.preview_enabled and self.is_preview_due(frame_t.t_mono):
+                self.publish_preview(self.make_preview(frame_rgb, pose, t_start, keypoints_drawn=drawn), frame_t)
+            self.publish_pose(frame_t, pose, flags)
+            self.frame_output_slot.emit(frame_t.index, frame_t.t_mono)
+            clock.lap("emit")
+            clock.finish()
+
+    # draw key points (for multi-person)
+    def draw_keypoints(self, image, keypoints, scale:float=1.0):
+        radius = max(2, int(7*scale))
+        for kps in (keypoints*scale).tolist():
+            for kp in kps:
+                cv2.circle(image, center=(int(kp[0]), int(kp[1])), radius=radius, color=(255,0,0), thickness=-1)
+
+    # set target size of the preview (label size on GUI, at most the profile preview size)
+    def set_preview_size(self, width:int, height:int):
+        preview = self.profile["preview"]
+        width = min(width, preview["width"]) if preview["width"] else width
+        height = min(height, preview["height"]) if preview["height"] else height
+        self.preview_size = (max(1, int(width)), max(1, int(height)))
+
+    # True if a preview frame should be emitted now (preview rate is independent of capture/inference rate)
+    def is_preview_due(self, t_now:float) -> bool:
+        if self.preview_fps > 0 and t_now-self.last_preview_time < 1./self.preview_fps:
+            return False
+        self.last_preview_time = t_now
+        return True
+
+    # True if pose estimation should run on this frame (at most inference_fps)
+    def is_inference_due(self, t_now:float) -> bool:
+        if self.inference_fps > 0 and t_now-self.last_inference_time < 1./self.inference_fps:
+            return False
+        self.last_inference_time = t_now
+        return True
+
+    # processing quality (set by the quality governor), None restores the configured value
+    # the configured values are upper limits (unless unlimited or the model default)
+    def set_quality(self, inference_fps:float=None, imgsz:int=None, preview_fps:float=None):
+        configured = self.configured_quality
+        self.inference_fps = _quality_limit(inference_fps, configured["inference_fps"])
+        self.inference_imgsz = _quality_limit(imgsz, configured["imgsz"])
+        self.preview_fps = _quality_limit(preview_fps, configured["preview_fps"])
+
+    # load of this camera pipeline (recording queue fill and frame drops)
+    def load_stats(self) -> dict:
+        recorder = self.recorder
+        return {"writer_fill":recorder.fill() if recorder is not None else 0.,
+                "dropped":self.frame_buffer.dropped}
+
+    # downscaled preview image with overlays (owns its buffer)
+    def make_preview(self, frame_rgb, pose:PoseResult, t_start:datetime, keypoints_drawn:bool=False) -> np.ndarray:
+        _h, _w = frame_rgb.shape[:2]
+        scale = min(self.preview_size[0]/_w, self.preview_size[1]/_h, 1.0) # keep aspect ratio
+        if scale < 1.0:
+            preview = cv2.resize(frame_rgb, (max(1, int(_w*scale)), max(1, int(_h*scale))), interpolation=cv2.INTER_AREA)
+        else:
+            preview = frame_rgb.copy()
+        if not keypoints_drawn:
+            self.draw_keypoints(preview, pose.keypoints, scale)
+
+        # camera monitoring (only for RGB color image, stage latencies are shown in the status area)
+        _ph, _pw, _ch = preview.shape
+        font_scale = max(0.4, 1.5*scale)
+        cv2.putText(preview, f"Camera #{self.camera_id}", (10, int(50*scale)+5), cv2.FONT_HERSHEY_SIMPLEX, font_scale, (0,255,0), max(1, int(2*scale)), cv2.LINE_AA)
+        cv2.putText(preview, t_start.strftime('%Y-%m-%d %H:%M:%S.%f')[:-3], (10, _ph-10), cv2.FONT_HERSHEY_SIMPLEX, font_scale, (0,255,0), max(1, int(2*scale)), cv2.LINE_AA)
+        return preview
+
+    # send preview image to the display (RGB, owned by the caller)
+    def publish_preview(self, preview:np.ndarray, frame_t):
+        _ph, _pw, _ch = preview.shape
+        _bpl = _ch*_pw # bytes per line
+        self.image_frame_slot.emit(QImage(preview.data, _pw, _ph, _bpl, QImage.Format.Format_RGB888).copy()) # deep copy, independent of the numpy buffer
+
+    # pose of every processed frame (to the keypoint stream, overridden by the process worker)
+    def publish_pose(self, frame_t, pose:PoseResult, flags:int):
+        if self.keypoint_streamer is not None:
+            self.keypoint_streamer.submit(self.camera_id, frame_t.index, frame_t.t_wall, flags, pose)
+
+    # pose of the frame with its log flag (detected or tracked), pose is None if interrupted
+    def estimate_pose(self, frame, frame_rgb):
+        if not self.hpe_engine.is_ready:
+            return PoseResult.empty(), 0 # model is still loading (preview and recording run without pose)
+        if not self.detect_scheduler.enabled:
+            return self.infer(frame_rgb), FLAG_DETECTED
+
+        gray = self.tracker.prepare(frame)
+        has_target = self.tracker.has_target()
+        tracked = self.tracker.track(gray) if has_target else None
+        if not self.detect_scheduler.should_detect(has_target, self.tracker.confidence):
+            self.detect_scheduler.on_tracked()
+            return tracked, FLAG_TRACKED
+
+        detected = self.infer(frame_rgb)
+        if detected is None:
+            return None, 0
+        self.detect_scheduler.on_detection(tracked, detected, self.tracker.confidence)
+        self.tracker.reset(gray, detected)
+        return detected, FLAG_DETECTED
+
+    # pose estimation on the region of interest (full frame coordinates), returns None if interrupted
+    def infer(self, image) -> PoseResult:
+        region = self.roi.select(image.shape) if self.roi.enabled else None
+        if region is None:
+            pose = self.infer_image(image)
+        else:
+            x1, y1, x2, y2 = region
+            pose = self.infer_image(np.ascontiguousarray(image[y1:y2, x1:x2]))
+            if pose is not None:
+                pose = pose.translate(x1, y1)
+        if pose is not None and self.roi.enabled:
+            self.roi.update(pose)
+        return pose
+
+    # request pose estimation to the (shared) engine, returns None if interrupted
+    def infer_image(self, image) -> PoseResult:
+        future = self.hpe_engine.submit(self.camera_id, image, self.inference_imgsz)
+        while not self.isInterruptionRequested():
+            try:
+                return future.result(timeout=0.1)
+            except FutureTimeoutError:
+                continue
+            except CancelledError:
+                return None
+            except Exception as e:
+                print(f"[Error] camera {self.camera_id} pose inference failed : {e}")
+                return PoseResult.empty()
+        future.cancel()
+        return None
 
     # video recording process impl.
-    def raw_video_record(self, frame):
-        if self.raw_video_writer != None:
-            self.raw_video_writer.write(frame)
+    def raw_video_record(self, frame_t):
+        recorder = self.recorder
+        if recorder != None:
+            recorder.write_raw(frame_t)
 
     # processed video recording impl.
     def processed_video_record(self, frame):
-        if self.processed_video_writer != None:
-            self.processed_video_writer.write(frame)
-
-    # create new video writer to save as video file
-    def create_raw_video_writer(self):
+        recorder = self.recorder
+        if recorder != None:
+            recorder.write_processed(frame)
+
+    # keypoint log recording impl. (rows of poselog.POSE_DTYPE)
+    def pose_record(self, rows):
+        recorder = self.recorder
+        if recorder != None:
+            recorder.write_pose(rows)
+
+    # create new video writers of a session directory
+    def create_raw_video_writer(self, out_path:pathlib.Path) -> SessionRecorder:
+        capture_format = self.capture_format if self.capture_format != None else self.grabber.format()
+        camera_fps = capture_format["fps"] if capture_format["fps"] > 0 else CAMERA_RECORD_FPS # negotiated rate (unknown for some sources)
+        camera_w, camera_h = capture_format["width"], capture_format["height"]
+
+        print(f"recording camera({self.camera_id}) info : ({camera_w},{camera_h}@{camera_fps:g})")
+        return SessionRecorder(pathlib.Path(out_path), self.camera_id, camera_fps, (camera_w, camera_h),
+                               fourcc=self.profile["record"]["fourcc"], # MJPG : low compression but bigger (file extension : avi)
+                               video_ext=VIDEO_FILE_EXT,
+                               queue_size=self.config.get("writer_queue_size", WRITER_QUEUE_SIZE),
+                               overflow=self.config.get("writer_overflow", OVERFLOW_BLOCK),
+                               processed=self.record_processed)
+
+    # open the writers of the next session in its pending directory (off the record trigger path)
+    def prepare_recording(self, pending_path:pathlib.Path):
+        recorder = self.create_raw_video_writer(pending_path)
+        with self.writer_lock:
+            previous = self.pending_recorder
+            self.pending_recorder = recorder
+        if previous != None:
+            self._discard_recorder(previous)
+
+    # start video recording in the session directory from the common start timestamp (own session if not given)
+    def start_recording(self, session_path:pathlib.Path=None, t_start:float=None, t_start_wall:float=None):
         if self.is_recording:
-            self.release_video_writer()
-
-        record_start_datetime = datetime.now().strftime("%Y-%m-%d-%H-%M-%S")
-        
-        self.data_out_path = DATA_OUT_DIR / record_start_datetime
-        self.data_out_path.mkdir(parents=True, exist_ok=True)
-
-        camera_fps = int(self.grabber.get(cv2.CAP_PROP_FPS))
-        camera_w = int(self.grabber.get(cv2.CAP_PROP_FRAME_WIDTH))
-        camera_h = int(self.grabber.get(cv2.CAP_PROP_FRAME_HEIGHT))
-        fourcc = cv2.VideoWriter_fourcc(*'MJPG') # low compression but bigger (file extension : avi)
-
-        print(f"recording camera({self.camera_id}) info : ({camera_w},{camera_h}@{camera_fps})")
-        self.raw_video_writer = cv2.VideoWriter(str(self.data_out_path/f'cam_{self.camera_id}.{VIDEO_FILE_EXT}'), fourcc, CAMERA_RECORD_FPS, (camera_w, camera_h))
-        self.processed_video_writer = cv2.VideoWriter(str(self.data_out_path/f'proc_cam_{self.camera_id}.{VIDEO_FILE_EXT}'), fourcc, CAMERA_RECORD_FPS, (camera_w, camera_h))
-        self.pose_csvfile = open(self.data_out_path / "keypoints.csv", mode="a+", newline='')
-        self.pose_csvfile_writer = csv.writer(self.pose_csvfile)
-
-    # start video recording
-    def start_recording(self):
-        if not self.is_recording:
-            self.create_raw_video_writer()
+            return
+        if session_path is None:
+            session = RecordingSession(self.data_root)
+            session_path = session.start([self.camera_id])
+            t_start, t_start_wall = session.t_start, session.t_start_wall
+        session_path = pathlib.Path(session_path)
+
+        with self.writer_lock:
+            recorder = self.pending_recorder
+            self.pending_recorder = None
+        if recorder != None and recorder.out_path != session_path:
+            if not recorder.out_path.exists() and (session_path/recorder.raw_writer.sink.path.name).exists():
+                recorder.relocate(session_path) # pending directory is renamed to the session
+            else:
+                self._discard_recorder(recorder) # prepared for another session
+                recorder = None
+        if recorder == None:
+            recorder = self.create_raw_video_writer(session_path)
+        recorder.set_start(t_start if t_start is not None else time.monotonic(), t_start_wall if t_start_wall is not None else time.time())
+
+        self.data_out_path = session_path
+        with self.writer_lock: # grab & inference stage switch from the pre-trigger buffer to the recorder at once
+            self.record_start_time = self.pose_start_time = recorder.t_start
+            if self.pretrigger != None:
+                self.flush_pretrigger(recorder)
+            self.recorder = recorder
             self.is_recording = True # working on thread
 
+    # buffered frames and pose rows go into the session before the live frames (decoded by the writer threads)
+    def flush_pretrigger(self, recorder:SessionRecorder):
+        frames, rows = self.pretrigger.take()
+        if not frames:
+            return
+        self.pose_start_time = frames[0].t_mono
+        keypoints = {} # frame index -> keypoints of the detected persons
+        for row in rows[rows["person"] >= 0]:
+            keypoints.setdefault(int(row["frame"]), []).append(row["keypoints"])
+        processed_indices = set(rows["frame"].tolist()) if recorder.records_processed else set()
+        processed = [frame for frame in frames if frame.index in processed_indices]
+
+        def overlay(image, frame):
+            image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB) # as the live processed frames
+            if frame.index in keypoints:
+                self.draw_keypoints(image, np.array(keypoints[frame.index]))
+            return image
+
+        recorder.write_pretrigger(frames, rows, overlay, processed)
+        self.record_start_time = math.nextafter(frames[-1].t_mono, math.inf) # live frames continue after the buffered ones
+        after_trigger = [frame for frame in frames if frame.t_mono >= recorder.t_start]
+        if after_trigger:
+            self.on_first_record_frame(recorder, after_trigger[0])
+        print(f"[Info] camera {self.camera_id} pre-trigger frames recorded : {len(frames)} ({recorder.pretrigger['seconds']:.2f} s before the trigger)")
+
+    # first frame recorded after the trigger (trigger-to-first-frame latency)
+    def on_first_record_frame(self, recorder:SessionRecorder, frame_t):
+        latency = recorder.mark_first_frame(frame_t.index, frame_t.t_mono, frame_t.t_wall)
+        print(f"[Info] camera {self.camera_id} first recorded frame #{frame_t.index} : grabbed {latency*1000.:.1f} ms after the record trigger")
+
     # stop video recording
     def stop_recording(self):
         if self.is_recording:
             self.is_recording = False
+            self.release_video_writer()
+            if self.pretrigger != None:
+                self.pretrigger.clear() # frames left from before this session
     
     # start image capturing        
     def start_capturing(self, delay_sec:float=1.0):
@@ -184,31 +447,168 @@ class CameraController(QThread):
             self.capture_delay = delay_sec
             self.is_capturing = True
 
-    # destory the video writer
-    def release_video_writer(self):
-        if self.raw_video_writer:
-            self.raw_video_writer.release()
-
-        if self.processed_video_writer:
-            self.processed_video_writer.release()
+    # close writers that will not be used (e.g. opened for another session)
+    def _discard_recorder(self, recorder:SessionRecorder):
+        recorder.close(wait=False)
+        self.closing_recorders.append(recorder)
+
+    # destory the video writer (remaining frames are flushed in background)
+    def release_video_writer(self, wait:bool=False):
+        with self.writer_lock:
+            recorder = self.recorder
+            self.recorder = None
+
+        if recorder != None:
+            recorder.close(wait=wait)
+            self.closing_recorders.append(recorder)
+        self.closing_recorders = [r for r in self.closing_recorders if not r.is_finished()]
+
+        if wait:
+            for r in self.closing_recorders:
+                r.close(wait=True)
+            self.closing_recorders.clear()
+
+    # queue depth and write latency of the recording writers
+    def recorder_stats(self) -> dict:
+        recorder = self.recorder
+        return recorder.stats() if recorder != None else {}
         
 
     # close this camera device
     def close(self):
 
+        self.frame_grabber.requestInterruption()
+        self.frame_grabber.wait(1000)
+
         self.requestInterruption() # to quit for thread
+        self.frame_buffer.close()
         self.quit()
         self.wait(1000)
 
-        self.release_video_writer()
-        self.grabber.release()
+        self.is_recording = False
+        with self.writer_lock:
+            pending = self.pending_recorder
+            self.pending_recorder = None
+        if pending != None:
+            self._discard_recorder(pending)
+        self.release_video_writer(wait=True)
+        self.snapshot_writer.close()
+        if self.pretrigger != None:
+            self.pretrigger.close()
+        if self.grabber is not None:
+            self.grabber.release()
+        if self.owns_engine:
+            self.hpe_engine.close()
         print(f"camera controller {self.camera_id} is terminated successfully")
     
     # thread start
     def begin(self):
         if self.grabber.isOpened():
+            if self.owns_engine and not self.hpe_engine.isRunning():
+                self.hpe_engine.start()
+            self.snapshot_writer.start()
+            if self.pretrigger != None:
+                self.pretrigger.start()
+            self.frame_grabber.start()
             self.start()
             
+    # stage latency summary of the rolling window (ms)
+    def metrics_summary(self) -> dict:
+        return self.metrics.summary()
+
+    # grab/drop counters of the frame buffer
+    def frame_stats(self) -> dict:
+        return self.frame_buffer.stats()
+
+    # one line stage latency text for the status area
+    def metrics_text(self) -> str:
+        return self.metrics.text()
+
+    # pipeline status of this camera (metrics report)
+    def report(self) -> dict:
+        return {"stages":self.metrics_summary(), "frames":self.frame_stats(), "recorder":self.recorder_stats(),
+                "detection_ratio":self.detect_scheduler.detection_ratio(), "detect_interval":self.detect_scheduler.interval,
+                "capture":self.capture_format, "hpe_activated":self.hpe_activated,
+                "inference_fps":self.inference_fps, "inference_imgsz":self.inference_imgsz, "preview_fps":self.preview_fps,
+                "pretrigger":self.pretrigger.stats() if self.pretrigger != None else None}
+
     def __str__(self):
         return str(self.camera_id)
-       
\ No newline at end of file
+
+
+'''
+grab stage of the camera controller (drains the device into the ring buffer)
+'''
+class FrameGrabber(QThread):
+    def __init__(self, controller:CameraController):
+        super().__init__()
+        self.setObjectName(f"grab-{controller.camera_id}")
+        self.controller = controller
+        self.grab_failed = 0 # count of failed reads
+
+    def run(self):
+        controller = self.controller
+        metrics = controller.metrics
+        while True:
+            if self.isInterruptionRequested():
+                print(f"camera {controller.camera_id} grabber is interrupted")
+                break
+
+            t_grab = time.monotonic()
+            ret, frame = controller.grabber.read() # grab
+            if not ret or frame is None:
+                if controller.grabber.is_exhausted():
+                    print(f"camera {controller.camera_id} source is exhausted")
+                    break
+                self.grab_failed += 1
+                QThread.msleep(1)
+                continue
+
+            frame_t = controller.frame_buffer.put(frame)
+            if metrics.enabled:
+                metrics.record("grab", frame_t.t_mono-t_grab)
+
+            # raw video is recorded at full camera rate, regardless of the inference rate (from the common start timestamp)
+            with controller.writer_lock: # never between the pre-trigger buffer and the recorder
+                recorder = controller.recorder if controller.is_recording and frame_t.t_mono >= controller.record_start_time else None
+                if recorder == None and controller.pretrigger != None and not controller.is_recording:
+                    controller.pretrigger.put(frame_t)
+            if recorder != None:
+                if recorder.first_frame is None:
+                    controller.on_first_record_frame(recorder, frame_t)
+                recorder.write_raw(frame_t)
+       
+
+
+# quality setting within its configured value (0 or None : unlimited)
+def _quality_limit(value, configured):
+    if value is None:
+        return configured
+    return min(value, configured) if configured else value
+
+
+'''
+opens camera devices concurrently (off the GUI thread)
+'''
+class CameraOpener(QThread):
+    camera_opened_slot = pyqtSignal(object, bool, float) # camera id, success, open time (sec)
+
+    def __init__(self, cameras:list):
+        super().__init__()
+        self.cameras = cameras
+
+    def run(self):
+        with ThreadPoolExecutor(max_workers=max(1, len(self.cameras)), thread_name_prefix="camera-open") as executor:
+            futures = {executor.submit(self._open, camera):camera for camera in self.cameras}
+            for future in as_completed(futures):
+                success, elapsed = future.result()
+                self.camera_opened_slot.emit(futures[future].camera_id, success, elapsed)
+
+    def _open(self, camera:CameraController):
+        t_start = time.monotonic()
+        try:
+            success = camera.open()
+        except Exception as e:
+            print(f"[Error] camera {camera.camera_id} open failed : {e}")
+            success = False
+        return success, time.monotonic()-t_start
@@ -0,0 +1,159 @@
+'''
+Application configuration (defaults, configuration file and per-camera profiles)
+@author bh.hwang@iae.re.kr
+'''
+
+import copy
+import json
+import pathlib
+
+# pre-defined options
+CAMERA_WINDOW_FORMAT = "window_camera_{}" # preview label of the n-th camera (1-based) on the GUI
+FOURCC_LENGTH = 4
+DATA_OUT_DIR = pathlib.Path(__file__).parent / "data" # default root of the recorded sessions
+
+# every application option with its default (overridden by the top-level keys of the configuration file)
+DEFAULT_CONFIG = {
+    "camera_ids":[0,2,4,6],
+    "camera_windows_map":None, # camera id -> preview label (built from the camera order and profiles if not given)
+    "camera_defaults":{}, # profile applied to every camera (see CAMERA_PROFILE)
+    "cameras":{}, # camera id -> profile (overrides camera_defaults)
+    "data_out_dir":str(DATA_OUT_DIR), # root of the recorded sessions (data/<session>)
+    "hpe_model":"./model/yolov8x-pose.pt",
+    "model_size":None, # n, s, m, l or x (overrides hpe_model)
+    "inference_backend":"torch", # torch, onnx (ONNX Runtime) or openvino, exported models are cached in model/cache
+    "inference_precision":"fp32", # fp32, fp16 (PyTorch : CUDA only) or int8 (onnx and openvino only)
+    "inference_batch_size":4, # max. number of camera frames per inference
+    "inference_max_wait_ms":5, # max. wait time to fill up a batch
+    "writer_queue_size":64, # queued items per recording writer
+    "writer_overflow":"block", # recording queue overflow policy (block, drop, spill)
+    "record_processed_video":True, # record the annotated video live (False : raw video and keypoint log only, render.py regenerates it)
+    "pretrigger_seconds":0, # frames and keypoints kept before the record trigger and recorded into the session (0 disables, e.g. 3 in param.cfg)
+    "pretrigger_max_mb":64, # memory cap of the pre-trigger buffer per camera (JPEG-compressed frames)
+    "pretrigger_jpeg_quality":90,
+    "detect_interval_min":1, # shortest detection interval (frames), the interval adapts between min and max to the tracking drift
+    "detect_interval_max":1, # run the detector at most every N frames and track keypoints in between (1 disables tracking)
+    "track_conf_threshold":0.6, # detector runs again if tracking confidence drops below
+    "track_error_tolerance":0.02, # accepted tracking drift at a detection (fraction of the bbox diagonal)
+    "roi_mode":"off", # inference region (off, dynamic : around the last bbox, static : roi_static)
+    "roi_static":None, # static cabin region [x1, y1, x2, y2], also the fallback search region of dynamic mode
+    "roi_margin":0.25, # expansion of the last bbox in dynamic mode (fraction of its width/height on each side)
+    "roi_min_size":320, # min. width/height of the inference region (px)
+    "inference_imgsz":None, # model input size (e.g. 480 with roi cropping), None means model default
+    "preview_fps":15, # max. preview refresh rate, independent of the capture rate (0 means unlimited)
+    "preview_enabled":True, # downscaled previews for the GUI (the headless service turns them off)
+    "camera_process":False, # run capture, inference and recording of every camera in its own process (preview via shared memory)
+    "inference_fps":0, # max. inference rate per camera (0 means every processed frame)
+    "governor_enabled":False, # lower inference rate, input size and preview rate per camera under load (recording is never throttled)
+    "governor_bounds":{"inference_fps":[5, 30], "imgsz":[320, 640], "preview_fps":[5, 15]}, # [lower, upper]
+    "metrics_enabled":True, # per-stage latency histograms
+    "metrics_interval_s":5, # metrics dump interval (published to flame/avsim/cam/metrics)
+    "status_interval_s":5, # camera health and throughput publish interval of the headless mode (flame/avsim/cam/status)
+    "metrics_file":None, # metrics dump file (*.json), optional
+    "keypoint_stream_enabled":False, # publish keypoints of every camera to flame/avsim/cam/keypoints/<camera id> (quantized binary)
+    "keypoint_stream_coalesce":1, # frames per message (more frames per message lower the message rate, but add latency)
+    "keypoint_stream_max_rate":30, # max. messages per second per camera (0 means unlimited, older frames are dropped)
+    "keypoint_stream_max_delay_ms":100, # a partial message is sent at the latest after this delay
+    "startup_log":"./log/startup.jsonl" # startup phase timings appended on exit (None to disable)
+}
+
+# profile of a camera (None keeps the device default, or follows the global option)
+CAMERA_PROFILE = {
+    "window":None, # preview label on the GUI
+    "capture":{"fourcc":None, "width":None, "height":None, "fps":None}, # requested V4L2 format (e.g. MJPG or YUYV)
+    "inference":{"enabled":True, "fps":None, "imgsz":None}, # max. inference rate and model input size (inference_fps, inference_imgsz)
+    "record":{"fourcc":"MJPG"}, # recording codec of the raw and processed videos (avi container)
+    "preview":{"width":None, "height":None}, # max. preview size (the label size on the GUI otherwise)
+}
+
+# configuration file keys of older versions
+_LEGACY_KEYS = {"camera_id":"camera_ids"}
+
+
+# application configuration from the defaults and a configuration file (JSON, optional)
+def load_config(path:pathlib.Path=None) -> dict:
+    config = copy.deepcopy(DEFAULT_CONFIG)
+    if path is not None:
+        path = pathlib.Path(path)
+        if path.exists():
+            values = json.loads(path.read_text())
+            if not isinstance(values, dict):
+                raise ValueError(f"{path} must hold a JSON object")
+            for key, value in values.items():
+                key = _LEGACY_KEYS.get(key, key)
+                if key not in DEFAULT_CONFIG:
+                    print(f"[Warning] unknown configuration key in {path} : {key}")
+                config[key] = value
+        else:
+            print(f"[Warning] configuration file {path} does not exist (defaults are used)")
+    return resolve_config(config)
+
+
+# camera ids, preview labels and complete profiles of every camera (config["camera_profiles"])
+def resolve_config(config:dict) -> dict:
+    cameras = {str(id):profile for id, profile in (config.get("cameras") or {}).items()}
+    if "camera_ids" not in config or config["camera_ids"] is None:
+        config["camera_ids"] = list(cameras)
+    config["camera_ids"] = [_camera_id(id) for id in config["camera_ids"]]
+    unknown = set(cameras)-{str(id) for id in config["camera_ids"]}
+    if unknown:
+        print(f"[Warning] profiles of unused cameras are ignored : {', '.join(sorted(unknown))}")
+
+    profiles = {str(id):_build_profile(config, id) for id in config["camera_ids"]}
+    config["camera_profiles"] = profiles
+
+    windows = {_camera_id(id):label for id, label in (config.get("camera_windows_map") or {}).items()}
+    for n, id in enumerate(config["camera_ids"]):
+        windows.setdefault(id, profiles[str(id)]["window"] or CAMERA_WINDOW_FORMAT.format(n+1))
+    config["camera_windows_map"] = windows
+    return config
+
+
+# complete profile of a camera (also for configurations not resolved by load_config, e.g. of the benchmark)
+def camera_profile(config:dict, camera_id) -> dict:
+    profiles = config.get("camera_profiles")
+    if profiles and str(camera_id) in profiles:
+        return profiles[str(camera_id)]
+    return _build_profile(config, camera_id)
+
+
+# defaults <- camera_defaults <- cameras[camera id]
+def _build_profile(config:dict, camera_id) -> dict:
+    cameras = {str(id):profile for id, profile in (config.get("cameras") or {}).items()}
+    profile = _merge(copy.deepcopy(CAMERA_PROFILE), config.get("camera_defaults") or {}, "camera_defaults")
+    profile = _merge(profile, cameras.get(str(camera_id), {}), f"cameras.{camera_id}")
+    _check_profile(camera_id, profile)
+    return profile
+
+
+# V4L2 device numbers stay integers (as given on the command line, "0" and 0 are the same device)
+def _camera_id(id):
+    return int(id) if isinstance(id, str) and id.isdigit() else id
+
+
+def _merge(base:dict, values:dict, name:str) -> dict:
+    if not isinstance(values, dict):
+        raise ValueError(f"camera profile {name} must be an object")
+    for key, value in values.items():
+        if key not in base:
+            raise ValueError(f"unknown camera profile key : {name}.{key} (one of {tuple(base)})")
+        if isinstance(base[key], dict):
+            _merge(base[key], value, f"{name}.{key}")
+        else:
+            base[key] = value
+    return base
+
+
+def _check_profile(camera_id, profile:dict):
+    for section in ("capture", "record"):
+        fourcc = profile[section]["fourcc"]
+        if fourcc is not None and (not isinstance(fourcc, str) or len(fourcc) != FOURCC_LENGTH):
+            raise ValueError(f"camera {camera_id} {section} fourcc must be a 4 character code (e.g. MJPG, YUYV) : {fourcc}")
+    for section, keys in (("capture", ("width", "height", "fps")), ("inference", ("imgsz",)), ("preview", ("width", "height"))):
+        for key in keys:
+            value = profile[section][key]
+            if value is not None and (not isinstance(value, (int, float)) or value <= 0):
+                raise ValueError(f"camera {camera_id} {section} {key} must be positive : {value}")
+    fps = profile["inference"]["fps"]
+    if fps is not None and (not isinstance(fps, (int, float)) or fps < 0):
+        raise ValueError(f"camera {camera_id} inference fps must be 0 (every frame) or positive : {fps}")
@@ -0,0 +1,165 @@
+'''
+Timestamped latest-frame ring buffer shared by the grab and inference stages, and shared-memory frame ring between processes
+@author bh.hwang@iae.re.kr
+'''
+
+import threading
+import time
+from collections import deque
+from multiprocessing import shared_memory
+from typing import NamedTuple, Optional, Any
+import numpy as np
+
+# slot header of the shared-memory ring (seq 0 means the slot is being written)
+SHARED_SLOT_HEADER = np.dtype([("seq", "<u8"), ("height", "<u4"), ("width", "<u4"), ("channels", "<u4"), ("reserved", "<u4")])
+
+
+'''
+frame with capture timestamps
+'''
+class TimedFrame(NamedTuple):
+    index: int      # sequence number assigned by the grabber (starts at 0)
+    t_mono: float   # time.monotonic() right after grab
+    t_wall: float   # time.time() right after grab
+    image: Any      # BGR frame (numpy array)
+
+
+'''
+bounded ring buffer keeping only the most recent frames
+'''
+class FrameRingBuffer:
+    def __init__(self, capacity:int=4):
+        if capacity < 1:
+            raise ValueError("ring buffer capacity must be >= 1")
+
+        self.capacity = capacity
+        self._frames = deque(maxlen=capacity)
+        self._cond = threading.Condition()
+        self._next_index = 0
+        self._closed = False
+
+        # counters
+        self.pushed = 0     # frames written by the producer
+        self.overwritten = 0    # frames evicted before anybody consumed them
+        self.skipped = 0    # frames discarded by get_latest() in favor of a newer one
+        self.consumed = 0   # frames handed out to the consumer
+
+    # push new frame (never blocks, oldest frame is evicted when full)
+    def put(self, image, t_mono:float=None, t_wall:float=None) -> TimedFrame:
+        frame = TimedFrame(self._next_index,
+                           time.monotonic() if t_mono is None else t_mono,
+                           time.time() if t_wall is None else t_wall,
+                           image)
+        with self._cond:
+            if len(self._frames) == self.capacity:
+                self.overwritten += 1
+            self._frames.append(frame)
+            self._next_index += 1
+            self.pushed += 1
+            self._cond.notify()
+        return frame
+
+    # take the newest frame and drop the older ones (returns None on timeout or close)
+    def get_latest(self, timeout:Optional[float]=None) -> Optional[TimedFrame]:
+        with self._cond:
+            if not self._frames and not self._closed:
+                self._cond.wait(timeout)
+            if not self._frames:
+                return None
+            frame = self._frames.pop()
+            self.skipped += len(self._frames)
+            self._frames.clear()
+            self.consumed += 1
+            return frame
+
+    # wake up every waiting consumer (used on shutdown)
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+    # frames dropped in total (evicted + skipped)
+    @property
+    def dropped(self) -> int:
+        return self.overwritten + self.skipped
+
+    def __len__(self):
+        with self._cond:
+            return len(self._frames)
+
+    # counter snapshot
+    def stats(self) -> dict:
+        with self._cond:
+            return {"pushed":self.pushed, "consumed":self.consumed, "overwritten":self.overwritten,
+                    "skipped":self.skipped, "dropped":self.overwritten+self.skipped, "depth":len(self._frames)}
+
+
+'''
+fixed-size frame slots in shared memory (one writer process, one reader process)
+frames are announced over a separate channel by (slot, seq), the reader copies the slot and
+drops it if the writer has reused the slot meanwhile (sequence check before and after the copy)
+'''
+class SharedFrameRing:
+    def __init__(self, slots:int, slot_bytes:int, name:str=None):
+        if slots < 2:
+            raise ValueError("shared frame ring requires at least 2 slots")
+
+        self.slots = slots
+        self.slot_bytes = slot_bytes
+        self.owner = name is None # the creator unlinks the memory
+        size = slots*(SHARED_SLOT_HEADER.itemsize + slot_bytes)
+        self.shm = shared_memory.SharedMemory(name=name, create=self.owner, size=size if self.owner else 0) # worker processes share the resource tracker of the creator
+
+        self.headers = np.ndarray((slots,), dtype=SHARED_SLOT_HEADER, buffer=self.shm.buf)
+        self.data = np.ndarray((slots, slot_bytes), dtype=np.uint8, buffer=self.shm.buf, offset=slots*SHARED_SLOT_HEADER.itemsize)
+        if self.owner:
+            self.headers[:] = 0
+        self._next_seq = 1
+
+        # counters
+        self.written = 0
+        self.too_large = 0  # frames not fitting in a slot (writer)
+        self.overrun = 0    # slots reused before they were read (reader)
+
+    @property
+    def name(self) -> str:
+        return self.shm.name
+
+    # copy image into the next slot, returns (slot, seq) to announce or None if it does not fit
+    def write(self, image:np.ndarray):
+        if image.nbytes > self.slot_bytes:
+            self.too_large += 1
+            return None
+        seq = self._next_seq
+        self._next_seq += 1
+        slot = seq % self.slots
+
+        header = self.headers[slot:slot+1]
+        header["seq"] = 0 # being written
+        self.data[slot, :image.nbytes] = np.ascontiguousarray(image).reshape(-1)
+        header["height"] = image.shape[0]
+        header["width"] = image.shape[1]
+        header["channels"] = image.shape[2] if image.ndim == 3 else 1
+        header["seq"] = seq
+        self.written += 1
+        return slot, seq
+
+    # copy of the announced frame, None if the slot was reused
+    def read(self, slot:int, seq:int) -> Optional[np.ndarray]:
+        header = self.headers[slot]
+        if int(header["seq"]) != seq:
+            self.overrun += 1
+            return None
+        height, width, channels = int(header["height"]), int(header["width"]), int(header["channels"])
+        image = self.data[slot, :height*width*channels].copy()
+        if int(self.headers[slot]["seq"]) != seq:
+            self.overrun += 1
+            return None
+        return image.reshape(height, width, channels) if channels > 1 else image.reshape(height, width)
+
+    def close(self):
+        self.headers = None
+        self.data = None # views must be released before the memory is closed
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
@@ -0,0 +1,325 @@
+'''
+Timestamp-to-frame seek index of recorded videos (frame number, timestamps and byte offset of every raw video frame)
+@author bh.hwang@iae.re.kr
+'''
+
+import argparse
+import json
+import pathlib
+import struct
+from datetime import datetime
+from typing import Optional
+import cv2
+import numpy as np
+from poselog import PoseLogReader, POSE_DTYPE, poselog_path
+
+# pre-defined options
+INDEX_PATTERN = "index_cam_{}.npy"
+VIDEO_PATTERN = "cam_*.avi" # raw videos of a session
+INDEX_FPS = 30 # frame period assumed for sessions without timestamps
+
+# index flags
+INDEX_ESTIMATED = 0x01 # timestamps are interpolated (index rebuilt from a session without per-frame timestamps)
+INDEX_NO_MONO = 0x02 # monotonic timestamp is unknown (legacy session)
+
+# one entry per frame of the video file
+INDEX_DTYPE = np.dtype([
+    ("frame", "<u4"),       # frame number in the video file
+    ("source", "<i8"),      # frame index of the camera (poselog frame), -1 if unknown
+    ("t_mono", "<i8"),      # monotonic timestamp (ns), -1 if unknown
+    ("t_wall", "<i8"),      # wall-clock timestamp (ns since epoch)
+    ("offset", "<i8"),      # byte offset of the frame data in the file, -1 if unknown
+    ("size", "<u4"),        # frame data size (bytes)
+    ("flags", "u1"),
+])
+
+_CHUNK = struct.Struct("<4sI")
+
+
+# index file of camera in a session directory
+def index_path(session_path:pathlib.Path, camera_id) -> pathlib.Path:
+    return pathlib.Path(session_path) / INDEX_PATTERN.format(camera_id)
+
+
+# (offset, size) of every video frame of an AVI file, from its chunk structure (RIFF and OpenDML AVIX parts)
+def avi_frame_offsets(path:pathlib.Path) -> np.ndarray:
+    frames = []
+    with open(path, "rb") as f:
+        file_size = f.seek(0, 2)
+        position = 0
+        while position+12 <= file_size:
+            f.seek(position)
+            ckid, size = _CHUNK.unpack(f.read(8))
+            if ckid != b"RIFF":
+                break
+            _scan_list(f, position+12, position+8+size, frames)
+            position += 8+size+(size & 1)
+    return np.array(frames, dtype=np.int64).reshape(-1, 2)
+
+def _scan_list(f, begin:int, end:int, frames:list, in_movi:bool=False):
+    position = begin
+    while position+8 <= end:
+        f.seek(position)
+        header = f.read(12)
+        if len(header) < 8:
+            break
+        ckid, size = _CHUNK.unpack(header[:8])
+        if ckid == b"LIST":
+            _scan_list(f, position+12, position+8+size, frames, in_movi or header[8:12] == b"movi")
+        elif in_movi and ckid[2:4] in (b"dc", b"db") and ckid[:2] == b"00": # video stream
+            frames.append((position+8, size))
+        position += 8+size+(size & 1)
+
+
+'''
+per-frame timestamps collected by the raw video sink, saved with the byte offsets when the video is closed
+'''
+class FrameIndexWriter:
+    def __init__(self, path:pathlib.Path):
+        self.path = pathlib.Path(path)
+        self._entries = [] # (source index, t_mono, t_wall)
+
+    def add(self, source:int, t_mono:Optional[float], t_wall:float):
+        self._entries.append((source, -1 if t_mono is None else int(t_mono*1e9), int(t_wall*1e9)))
+
+    def __len__(self):
+        return len(self._entries)
+
+    # build the index of the closed video file
+    def save(self, video_path:pathlib.Path) -> np.ndarray:
+        entries = np.zeros(len(self._entries), dtype=INDEX_DTYPE)
+        entries["frame"] = np.arange(len(entries))
+        if len(entries):
+            entries["source"], entries["t_mono"], entries["t_wall"] = np.array(self._entries, dtype=np.int64).T
+        _fill_offsets(entries, video_path)
+        np.save(self.path, entries)
+        return entries
+
+
+def _fill_offsets(entries:np.ndarray, video_path:pathlib.Path):
+    entries["offset"] = -1
+    try:
+        offsets = avi_frame_offsets(video_path)
+    except (OSError, struct.error) as e:
+        print(f"[Warning] frame offsets of {video_path} are not available : {e}")
+        return
+    if len(offsets) != len(entries):
+        print(f"[Warning] {video_path} has {len(offsets)} frames, {len(entries)} indexed (offsets are not used)")
+        return
+    if len(entries):
+        entries["offset"], entries["size"] = offsets.T
+
+
+# rebuild the index of a recorded video (timestamps from the keypoint log and record info, interpolated in between)
+def rebuild_index(session_path:pathlib.Path, camera_id) -> np.ndarray:
+    session_path = pathlib.Path(session_path)
+    video_path = session_path / f"cam_{camera_id}.avi"
+    offsets = avi_frame_offsets(video_path)
+    capture = cv2.VideoCapture(str(video_path))
+    fps = capture.get(cv2.CAP_PROP_FPS) or INDEX_FPS
+    n = len(offsets) if len(offsets) else int(capture.get(cv2.CAP_PROP_FRAME_COUNT)) # not an AVI chunk structure
+    capture.release()
+
+    entries = np.zeros(n, dtype=INDEX_DTYPE)
+    entries["frame"] = np.arange(n)
+    entries["flags"] = INDEX_ESTIMATED
+    entries["offset"] = -1
+    if len(offsets) == n and n:
+        entries["offset"], entries["size"] = offsets.T
+
+    # first frame of the file (pre-trigger frames come first) and the frame period
+    info = _record_info(session_path, camera_id)
+    first = info.get("first_frame")
+    if info.get("pretrigger"):
+        first = dict(info["pretrigger"], index=info["pretrigger"]["first_index"])
+    rows = _pose_rows(session_path, camera_id)
+    rows = rows[rows["frame"] >= 0]
+    if first is not None:
+        # camera frames are consecutive in the raw video (writer drops make the tail estimate late)
+        entries["source"] = first["index"]+np.arange(n)
+        t_mono = np.full(n, np.nan)
+        t_wall = np.full(n, np.nan)
+        t_mono[0], t_wall[0] = first["t_mono"]*1e9, first["t_wall"]*1e9
+        if len(rows):
+            _, first_row = np.unique(rows["frame"], return_index=True)
+            known = rows[first_row]
+            position = known["frame"]-first["index"]
+            inside = (position >= 0) & (position < n)
+            t_mono[position[inside]] = known["t_mono"][inside]
+            t_wall[position[inside]] = known["t_wall"][inside]
+        entries["t_mono"] = _interpolate(t_mono, 1e9/fps)
+        entries["t_wall"] = _interpolate(t_wall, 1e9/fps)
+    else:
+        # legacy session : start time from the directory name, constant frame period
+        entries["source"] = -1
+        entries["t_mono"] = -1
+        entries["flags"] |= INDEX_NO_MONO
+        try:
+            t_start = datetime.strptime(session_path.name[:19], "%Y-%m-%d-%H-%M-%S").timestamp()
+        except ValueError:
+            t_start = video_path.stat().st_mtime-n/fps
+        entries["t_wall"] = (t_start*1e9+np.arange(n)*(1e9/fps)).astype(np.int64)
+
+    np.save(index_path(session_path, camera_id), entries)
+    return entries
+
+def _interpolate(values:np.ndarray, period:float) -> np.ndarray:
+    known = np.flatnonzero(~np.isnan(values))
+    if len(known) == 1: # extrapolate with the frame period
+        return (values[known[0]]+(np.arange(len(values))-known[0])*period).astype(np.int64)
+    result = np.interp(np.arange(len(values)), known, values[known])
+    tail = np.arange(len(values)) > known[-1]
+    result[tail] = values[known[-1]]+(np.arange(len(values))[tail]-known[-1])*period
+    return result.astype(np.int64)
+
+def _record_info(session_path:pathlib.Path, camera_id) -> dict:
+    path = session_path / f"record_cam_{camera_id}.json"
+    return json.loads(path.read_text()) if path.exists() else {}
+
+def _pose_rows(session_path:pathlib.Path, camera_id) -> np.ndarray:
+    path = poselog_path(session_path, camera_id)
+    return PoseLogReader(path).read() if path.exists() else np.zeros(0, dtype=POSE_DTYPE)
+
+
+# ns timestamp from datetime (wall-clock) or seconds
+def _to_ns(t) -> int:
+    if isinstance(t, datetime):
+        return int(t.timestamp()*1e9)
+    return int(t*1e9)
+
+
+'''
+recorded video of a camera with its seek index (frames and matching keypoint rows by timestamp)
+'''
+class IndexedVideo:
+    def __init__(self, session_path:pathlib.Path, camera_id, rows:np.ndarray=None):
+        self.session_path = pathlib.Path(session_path)
+        self.camera_id = camera_id
+        self.video_path = self.session_path / f"cam_{camera_id}.avi"
+        path = index_path(self.session_path, camera_id)
+        if not path.exists():
+            rebuild_index(self.session_path, camera_id)
+        self.index = np.load(path, mmap_mode="r")
+        self.rows = rows if rows is not None else _pose_rows(self.session_path, camera_id) # keypoint log (or the part in use)
+        self._file = None
+        self._capture = None
+
+    def __len__(self):
+        return len(self.index)
+
+    # frame number at or before timestamp t (datetime or seconds, clock : "wall" or "mono"), O(log n)
+    def locate(self, t, clock:str="wall") -> int:
+        if len(self.index) == 0:
+            raise ValueError(f"{self.video_path} has no frames")
+        position = int(np.searchsorted(self.index[self._column(clock)], _to_ns(t), side="right"))-1
+        return min(max(position, 0), len(self.index)-1)
+
+    # frame numbers [begin, end) in time range [t_begin, t_end)
+    def locate_range(self, t_begin, t_end, clock:str="wall") -> tuple:
+        column = self.index[self._column(clock)]
+        begin, end = np.searchsorted(column, [_to_ns(t_begin), _to_ns(t_end)])
+        return int(begin), int(end)
+
+    # (index entry, BGR image, keypoint rows) of the frame at or before t
+    def seek(self, t, clock:str="wall") -> tuple:
+        frame = self.locate(t, clock)
+        return self.index[frame], self.read_frame(frame), self.keypoints(frame)
+
+    # frames in time range [t_begin, t_end)
+    def read_range(self, t_begin, t_end, clock:str="wall"):
+        begin, end = self.locate_range(t_begin, t_end, clock)
+        for frame in range(begin, end):
+            yield self.index[frame], self.read_frame(frame), self.keypoints(frame)
+
+    # image of a frame (direct read of the JPEG data if the offset is known, decoder seek otherwise)
+    def read_frame(self, frame:int) -> Optional[np.ndarray]:
+        entry = self.index[frame]
+        if entry["offset"] >= 0:
+            if self._file is None:
+                self._file = open(self.video_path, "rb")
+            self._file.seek(int(entry["offset"]))
+            image = cv2.imdecode(np.frombuffer(self._file.read(int(entry["size"])), dtype=np.uint8), cv2.IMREAD_COLOR)
+            if image is not None:
+                return image
+        if self._capture is None:
+            self._capture = cv2.VideoCapture(str(self.video_path))
+        self._capture.set(cv2.CAP_PROP_POS_FRAMES, frame)
+        ok, image = self._capture.read()
+        return image if ok else None
+
+    # keypoint log rows of a frame (by camera frame index, or by timestamp for logs without frame indices)
+    def keypoints(self, frame:int) -> np.ndarray:
+        entry = self.index[frame]
+        if entry["source"] >= 0 and len(self.rows) and self.rows["frame"][0] >= 0:
+            begin, end = np.searchsorted(self.rows["frame"], [entry["source"], entry["source"]+1])
+        else:
+            period = self._period()
+            begin, end = np.searchsorted(self.rows["t_wall"], [entry["t_wall"]-period//2, entry["t_wall"]+period//2])
+        return self.rows[begin:end]
+
+    def _period(self) -> int:
+        if len(self.index) < 2:
+            return int(1e9/INDEX_FPS)
+        return int((self.index["t_wall"][-1]-self.index["t_wall"][0])/(len(self.index)-1))
+
+    def _column(self, clock:str) -> str:
+        if clock not in ("wall", "mono"):
+            raise ValueError(f"unknown clock : {clock} (wall or mono)")
+        if clock == "mono" and len(self.index) and self.index["flags"][0] & INDEX_NO_MONO:
+            raise ValueError(f"{self.video_path} has no monotonic timestamps")
+        return "t_wall" if clock == "wall" else "t_mono"
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        if self._capture is not None:
+            self._capture.release()
+            self._capture = None
+
+
+# camera ids of the raw videos in a session
+def session_cameras(session_path:pathlib.Path) -> list:
+    return sorted(path.stem[len("cam_"):] for path in pathlib.Path(session_path).glob(VIDEO_PATTERN))
+
+
+# rebuild missing (or every) index of the sessions under data root
+def rebuild_sessions(data_root:pathlib.Path, force:bool=False):
+    for session_path in sorted(p for p in pathlib.Path(data_root).iterdir() if p.is_dir() and not p.name.startswith(".")):
+        for camera_id in session_cameras(session_path):
+            if force or not index_path(session_path, camera_id).exists():
+                try:
+                    entries = rebuild_index(session_path, camera_id)
+                    print(f"[Info] {session_path.name} camera {camera_id} : {len(entries)} frames indexed")
+                except Exception as e:
+                    print(f"[Warning] {session_path.name} camera {camera_id} index is not rebuilt : {e}")
+
+
+'''
+Entry point (index rebuild and seek)
+'''
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Seek index of recorded sessions")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    rebuild = subparsers.add_parser("rebuild", help="build missing indexes of the sessions under data root")
+    rebuild.add_argument('data', nargs='?', default="./data", help="data root")
+    rebuild.add_argument('--force', action='store_true', help="rebuild existing indexes too")
+    seek = subparsers.add_parser("seek", help="show the frame and keypoints at a timestamp")
+    seek.add_argument('session', help="session directory")
+    seek.add_argument('camera', help="camera id")
+    seek.add_argument('time', help="wall-clock time (YYYY-mm-dd HH:MM:SS.fff) or monotonic seconds with --mono")
+    seek.add_argument('--mono', action='store_true', help="time is a monotonic timestamp (sec)")
+    seek.add_argument('--save', nargs='?', default=None, help="save the frame image (*.png)")
+    args = parser.parse_args()
+
+    if args.command == "rebuild":
+        rebuild_sessions(args.data, args.force)
+    else:
+        video = IndexedVideo(args.session, args.camera)
+        t = float(args.time) if args.mono else datetime.strptime(args.time, "%Y-%m-%d %H:%M:%S.%f")
+        entry, image, rows = video.seek(t, "mono" if args.mono else "wall")
+        print(f"frame {entry['frame']} (camera frame {entry['source']}) at {datetime.fromtimestamp(entry['t_wall']/1e9)}, "
+              f"{int((rows['person'] >= 0).sum())} person(s)")
+        if args.save and image is not None:
+            cv2.imwrite(args.save, image)
+        video.close()
@@ -0,0 +1,121 @@
+'''
+Load-adaptive quality governor (inference rate, model input size and preview rate per camera)
+@author bh.hwang@iae.re.kr
+'''
+
+# pre-defined options
+GOVERNOR_LEVELS = 5 # quality steps from the configured quality (level 0) down to the lower bounds
+GOVERNOR_BOUNDS = {"inference_fps":(5, 30), "imgsz":(320, 640), "preview_fps":(5, 15)} # (lower, upper)
+IMGSZ_ALIGN = 32 # model stride
+CPU_HIGH = 90. # machine cpu usage (%) that lowers the quality
+CPU_LOW = 70. # machine cpu usage (%) that allows raising the quality
+GPU_HIGH = 95.
+GPU_LOW = 80.
+MEMORY_HIGH = 90.
+WRITER_FILL_HIGH = 0.25 # recording queue fill of a camera that lowers its quality immediately
+WRITER_FILL_LOW = 0.05
+ENGINE_QUEUE_HIGH = 1.0 # waiting inference requests per camera
+RECOVER_SAMPLES = 5 # consecutive relaxed samples before the quality is raised by one step
+CAMERA_THREADS = ("cam-{}", "grab-{}") # inference and grab thread names of a camera (camera.py)
+THREAD_NAME_LENGTH = 15 # thread names are truncated by the kernel
+
+
+'''
+steps the quality of each camera down under load and back up when the machine is relaxed
+(recording is never throttled, only inference and preview are)
+'''
+class QualityGovernor:
+    def __init__(self, bounds:dict=None, levels:int=GOVERNOR_LEVELS, recover_samples:int=RECOVER_SAMPLES):
+        if levels < 2:
+            raise ValueError("governor requires at least 2 quality levels")
+        self.bounds = dict(GOVERNOR_BOUNDS)
+        self.bounds.update(bounds or {})
+        for key, (lower, upper) in self.bounds.items():
+            if key not in GOVERNOR_BOUNDS:
+                raise ValueError(f"unknown governor bound : {key} (one of {tuple(GOVERNOR_BOUNDS)})")
+            if lower > upper:
+                raise ValueError(f"governor bound {key} must be (lower, upper)")
+        self.num_levels = levels
+        self.recover_samples = recover_samples
+        self.levels = {} # camera id -> quality level (0 is the best)
+        self.relaxed = 0 # consecutive relaxed samples
+
+    # settings of a quality level (None : configured value of the camera, at level 0)
+    def settings(self, level:int) -> dict:
+        if level == 0:
+            return {key:None for key in self.bounds}
+        ratio = level/(self.num_levels-1)
+        values = {}
+        for key, (lower, upper) in self.bounds.items():
+            values[key] = upper - (upper-lower)*ratio
+        values["imgsz"] = max(IMGSZ_ALIGN, int(values["imgsz"])//IMGSZ_ALIGN*IMGSZ_ALIGN)
+        values["inference_fps"] = round(values["inference_fps"], 1)
+        values["preview_fps"] = round(values["preview_fps"], 1)
+        return values
+
+    # True if any machine resource is saturated (unknown values are ignored)
+    def is_overloaded(self, resources:dict, engine_queue:float) -> bool:
+        return (_above(resources.get("cpu_usage"), CPU_HIGH) or _above(resources.get("gpu_usage"), GPU_HIGH) or
+                _above(resources.get("memory_usage"), MEMORY_HIGH) or engine_queue >= ENGINE_QUEUE_HIGH)
+
+    def is_relaxed(self, resources:dict) -> bool:
+        return not (_above(resources.get("cpu_usage"), CPU_LOW) or _above(resources.get("gpu_usage"), GPU_LOW))
+
+    # update with the machine resources and camera loads (camera id -> {"writer_fill"}), returns changed settings per camera
+    def update(self, resources:dict, loads:dict, engine_queue:int=0) -> dict:
+        for camera_id in list(self.levels):
+            if camera_id not in loads:
+                del self.levels[camera_id]
+        for camera_id in loads:
+            self.levels.setdefault(camera_id, 0)
+        if not loads:
+            return {}
+
+        changed = set()
+        pressed = [camera_id for camera_id, load in loads.items() if load["writer_fill"] >= WRITER_FILL_HIGH]
+        if pressed:
+            # recording of these cameras falls behind : free their share first
+            for camera_id in pressed:
+                changed.add(self._step(camera_id, +1))
+            self.relaxed = 0
+        elif self.is_overloaded(resources, engine_queue/len(loads)):
+            # degrade evenly : of the cameras with the best quality, the one with the busiest threads steps down
+            cpu = camera_thread_loads(resources.get("threads") or [], self.levels)
+            changed.add(self._step(min(self.levels, key=lambda camera_id: (self.levels[camera_id], -cpu[camera_id])), +1))
+            self.relaxed = 0
+        elif self.is_relaxed(resources) and all(load["writer_fill"] <= WRITER_FILL_LOW for load in loads.values()):
+            self.relaxed += 1
+            if self.relaxed >= self.recover_samples:
+                changed.add(self._step(max(self.levels, key=self.levels.get), -1))
+                self.relaxed = 0
+        else:
+            self.relaxed = 0
+
+        changed.discard(None)
+        return {camera_id:self.settings(self.levels[camera_id]) for camera_id in changed}
+
+    # move camera by one level, returns camera id if its level changed
+    def _step(self, camera_id, step:int):
+        level = min(self.num_levels-1, max(0, self.levels[camera_id]+step))
+        if level == self.levels[camera_id]:
+            return None
+        self.levels[camera_id] = level
+        return camera_id
+
+    # current level of every camera
+    def report(self) -> dict:
+        return dict(self.levels)
+
+
+# cpu load (percent of one core) of the threads of every camera, from the thread loads of the resource monitor
+# (threads of camera worker processes are not in there, their cameras count as idle)
+def camera_thread_loads(threads:list, camera_ids) -> dict:
+    loads = {}
+    for camera_id in camera_ids:
+        names = {pattern.format(camera_id)[:THREAD_NAME_LENGTH] for pattern in CAMERA_THREADS}
+        loads[camera_id] = sum(thread["cpu"] for thread in threads if thread["name"] in names)
+    return loads
+
+
+def _above(value, threshold:float) -> bool:
+    return value is not None and value >= threshold
@@ -0,0 +1,443 @@
+'''
+Shared pose inference engine (one model instance, batched multi-camera inference)
+@author bh.hwang@iae.re.kr
+'''
+
+import argparse
+import hashlib
+import json
+import pathlib
+import shutil
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+import numpy as np
+from PyQt6.QtCore import QThread, pyqtSignal
+
+# pre-defined options
+MODEL_DIR = pathlib.Path("./model")
+MODEL_CACHE_DIR = MODEL_DIR / "cache" # exported models
+HPE_MODEL_PATH = "./model/yolov8x-pose.pt"
+MODEL_SIZES = ("n", "s", "m", "l", "x")
+BACKEND_TORCH = "torch"
+BACKEND_ONNX = "onnx"           # ONNX Runtime
+BACKEND_OPENVINO = "openvino"   # Intel OpenVINO (CPU)
+BACKENDS = (BACKEND_TORCH, BACKEND_ONNX, BACKEND_OPENVINO)
+PRECISION_FP32 = "fp32"
+PRECISION_FP16 = "fp16"
+PRECISION_INT8 = "int8"
+PRECISIONS = (PRECISION_FP32, PRECISION_FP16, PRECISION_INT8)
+DEFAULT_IMGSZ = 640
+WARMUP_SHAPE = (1080, 1920, 3)
+WARMUP_RUNS = 2
+COMPARE_FRAMES = 300 # frames of the clip used for backend comparison
+COMPARE_PCK_THRESHOLD = 0.05 # keypoint agrees if closer than this fraction of the bbox diagonal
+COMPARE_KEYPOINT_CONF = 0.5
+NUM_KEYPOINTS = 17
+INFERENCE_BATCH_SIZE = 4
+INFERENCE_MAX_WAIT_MS = 5
+LATENCY_WINDOW = 120 # number of recent requests used for latency statistics
+LATENCY_REPORT_INTERVAL = 10.0 # sec
+PREDICT_OPTIONS = {"iou":0.7, "conf":0.7, "verbose":False}
+
+
+'''
+pose estimation result of a single image (detached from the model output)
+'''
+class PoseResult:
+    def __init__(self, keypoints, keypoint_conf, boxes, box_conf, speed:dict):
+        self.keypoints = keypoints          # (n, 17, 2) float32, pixel coordinates
+        self.keypoint_conf = keypoint_conf  # (n, 17) float32
+        self.boxes = boxes                  # (n, 4) float32, xyxy
+        self.box_conf = box_conf            # (n,) float32
+        self.speed = speed                  # {"preprocess", "inference", "postprocess"} in ms
+
+    # convert ultralytics result to numpy arrays
+    @classmethod
+    def from_ultralytics(cls, result):
+        n = len(result.boxes)
+        boxes = result.boxes.xyxy.cpu().numpy().astype(np.float32).reshape(n, 4)
+        box_conf = result.boxes.conf.cpu().numpy().astype(np.float32).reshape(n)
+        if result.keypoints is not None and n > 0:
+            keypoints = result.keypoints.xy.cpu().numpy().astype(np.float32).reshape(n, NUM_KEYPOINTS, 2)
+            if result.keypoints.conf is not None:
+                keypoint_conf = result.keypoints.conf.cpu().numpy().astype(np.float32).reshape(n, NUM_KEYPOINTS)
+            else:
+                keypoint_conf = np.ones((n, NUM_KEYPOINTS), dtype=np.float32)
+        else:
+            keypoints = np.zeros((n, NUM_KEYPOINTS, 2), dtype=np.float32)
+            keypoint_conf = np.zeros((n, NUM_KEYPOINTS), dtype=np.float32)
+        return cls(keypoints, keypoint_conf, boxes, box_conf, dict(result.speed))
+
+    # result without any detection
+    @classmethod
+    def empty(cls, speed:dict=None):
+        return cls(np.zeros((0, NUM_KEYPOINTS, 2), dtype=np.float32),
+                   np.zeros((0, NUM_KEYPOINTS), dtype=np.float32),
+                   np.zeros((0, 4), dtype=np.float32),
+                   np.zeros((0,), dtype=np.float32),
+                   speed if speed is not None else {"preprocess":float('nan'), "inference":float('nan'), "postprocess":float('nan')})
+
+    # shift keypoints and boxes by offset (crop to full frame coordinates), undetected (0, 0) keypoints are kept
+    def translate(self, dx:float, dy:float) -> "PoseResult":
+        if len(self) == 0 or (dx == 0 and dy == 0):
+            return self
+        offset = np.array([dx, dy], dtype=np.float32)
+        detected = np.any(self.keypoints != 0, axis=2, keepdims=True)
+        keypoints = np.where(detected, self.keypoints+offset, self.keypoints)
+        boxes = self.boxes + np.tile(offset, 2)
+        return PoseResult(keypoints, self.keypoint_conf, boxes, self.box_conf, self.speed)
+
+    # total processing time in ms
+    def processing_time(self) -> float:
+        return self.speed["preprocess"] + self.speed["inference"] + self.speed["postprocess"]
+
+    def __len__(self):
+        return len(self.boxes)
+
+
+# model weights path of a model size (n, s, m, l, x)
+def model_path_for_size(size:str) -> str:
+    if size not in MODEL_SIZES:
+        raise ValueError(f"unknown model size : {size} (one of {MODEL_SIZES})")
+    return str(MODEL_DIR / f"yolov8{size}-pose.pt")
+
+
+# cache directory of an exported model (keyed by weights hash and export options)
+def exported_model_dir(model_path:str, backend:str, imgsz:int, precision:str) -> pathlib.Path:
+    digest = hashlib.sha256()
+    with open(model_path, "rb") as f:
+        for block in iter(lambda: f.read(1<<20), b""):
+            digest.update(block)
+    key = f"{digest.hexdigest()[:16]}-{backend}-{imgsz}-{precision}"
+    return MODEL_CACHE_DIR / f"{pathlib.Path(model_path).stem}-{key}"
+
+
+# export model for a runtime backend once and reuse it from the cache
+def export_model(model_path:str, backend:str, imgsz:int, precision:str) -> pathlib.Path:
+    cache_dir = exported_model_dir(model_path, backend, imgsz, precision)
+    meta_path = cache_dir / "meta.json"
+    if meta_path.exists():
+        meta = json.loads(meta_path.read_text())
+        return cache_dir / meta["model"]
+
+    from ultralytics import YOLO # heavy import
+    print(f"Export HPE model ({model_path}) for {backend} ({imgsz}, {precision})...")
+    exported = pathlib.Path(YOLO(model=model_path).export(format=backend, imgsz=imgsz, dynamic=True, # dynamic batch for multi-camera inference
+                                                          half=(precision == PRECISION_FP16), int8=(precision == PRECISION_INT8)))
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    target = cache_dir / exported.name
+    if target.is_dir():
+        shutil.rmtree(target)
+    elif target.exists():
+        target.unlink()
+    shutil.move(str(exported), str(target))
+    meta_path.write_text(json.dumps({"model":exported.name, "source":str(model_path), "backend":backend, "imgsz":imgsz, "precision":precision}))
+    return target
+
+
+# load pose estimation model (exported models are cached on disk)
+def load_pose_model(model_path:str=HPE_MODEL_PATH, backend:str=BACKEND_TORCH, imgsz:int=None, precision:str=PRECISION_FP32):
+    if backend not in BACKENDS:
+        raise ValueError(f"unknown inference backend : {backend} (one of {BACKENDS})")
+    if precision not in PRECISIONS:
+        raise ValueError(f"unknown precision : {precision} (one of {PRECISIONS})")
+    if backend == BACKEND_TORCH and precision == PRECISION_INT8:
+        raise ValueError(f"int8 precision requires an exported model (backend {BACKEND_ONNX} or {BACKEND_OPENVINO})")
+
+    from ultralytics import YOLO # heavy import
+    if backend == BACKEND_TORCH:
+        import torch
+        if precision == PRECISION_FP16 and not torch.cuda.is_available():
+            print("[Warning] fp16 of the PyTorch backend requires CUDA, the model runs in fp32 on CPU")
+        print(f"Load HPE model ({model_path})...")
+        return YOLO(model=model_path)
+
+    path = export_model(model_path, backend, imgsz or DEFAULT_IMGSZ, precision)
+    print(f"Load HPE model ({path})...")
+    return YOLO(model=str(path), task="pose")
+
+
+# predict options of a backend and precision (fp16 of the PyTorch model is selected per predict call, CUDA only)
+def backend_predict_options(backend:str=BACKEND_TORCH, precision:str=PRECISION_FP32, imgsz:int=None) -> dict:
+    options = dict(PREDICT_OPTIONS)
+    if imgsz is not None:
+        options["imgsz"] = imgsz
+    if backend == BACKEND_TORCH and precision == PRECISION_FP16:
+        options["half"] = True
+    return options
+
+
+# run a few predictions so that the first camera frames are not slow
+def warmup_model(model, predict_options:dict, batch_size:int=1, shape:tuple=WARMUP_SHAPE, runs:int=WARMUP_RUNS) -> float:
+    t_start = time.perf_counter()
+    images = [np.zeros(shape, dtype=np.uint8) for _ in range(batch_size)]
+    for _ in range(runs):
+        model.predict(images, **predict_options)
+        if batch_size > 1:
+            model.predict(images[:1], **predict_options)
+    elapsed = time.perf_counter()-t_start
+    print(f"[Info] HPE model warmup finished ({elapsed:.2f}s)")
+    return elapsed
+
+
+'''
+request submitted to the engine by a camera
+'''
+class _InferenceRequest:
+    def __init__(self, camera_id, image, imgsz:int=None):
+        self.camera_id = camera_id
+        self.image = image
+        self.imgsz = imgsz
+        self.t_submit = time.monotonic()
+        self.future = Future()
+
+
+'''
+shared inference engine (gathers the latest frame of every camera and runs them as one batch)
+'''
+class PoseInferenceEngine(QThread):
+    ready_slot = pyqtSignal(bool, float) # model loaded and warmed up (success, elapsed sec since start)
+
+    def __init__(self, model_path:str=HPE_MODEL_PATH, batch_size:int=INFERENCE_BATCH_SIZE, max_wait_ms:float=INFERENCE_MAX_WAIT_MS, model=None, imgsz:int=None,
+                 backend:str=BACKEND_TORCH, precision:str=PRECISION_FP32, warmup:bool=True, lazy_load:bool=False):
+        super().__init__()
+        self.setObjectName("pose-engine")
+
+        if batch_size < 1:
+            raise ValueError("batch size must be >= 1")
+
+        self.model_path = model_path
+        self.batch_size = batch_size
+        self.max_wait = max_wait_ms/1000.
+        self.predict_options = backend_predict_options(backend, precision, imgsz) # imgsz : model input size (smaller size with roi cropping)
+
+        self._pending = {} # camera id -> latest request (one in flight per camera)
+        self._cond = threading.Condition()
+        self._latency = {} # camera id -> recent submit-to-result latencies (ms)
+        self._batch_sizes = deque(maxlen=LATENCY_WINDOW)
+        self._last_report = time.monotonic()
+
+        self.backend = backend
+        self.imgsz = imgsz
+        self.precision = precision
+        self.warmup = warmup
+        self.is_ready = False # True after warmup
+        self.model = model
+        if self.model is None and not lazy_load: # lazy load : model is loaded by the engine thread (does not block the caller)
+            self.model = load_pose_model(model_path, backend, imgsz, precision)
+
+    # submit image of camera (a newer image replaces a pending one of the same camera), imgsz overrides the model input size
+    def submit(self, camera_id, image, imgsz:int=None) -> Future:
+        request = _InferenceRequest(camera_id, image, imgsz)
+        with self._cond:
+            replaced = self._pending.get(camera_id)
+            self._pending[camera_id] = request
+            self._cond.notify()
+        if replaced is not None:
+            replaced.future.cancel()
+        return request.future
+
+    # gather up to batch_size requests (waits max_wait after the first arrival)
+    def _gather(self) -> list:
+        with self._cond:
+            if not self._pending:
+                self._cond.wait(0.1)
+                if not self._pending:
+                    return []
+            deadline = time.monotonic() + self.max_wait
+            while len(self._pending) < self.batch_size:
+                remain = deadline - time.monotonic()
+                if remain <= 0:
+                    break
+                self._cond.wait(remain)
+
+            # oldest requests first
+            requests = sorted(self._pending.values(), key=lambda r: r.t_submit)[:self.batch_size]
+            for request in requests:
+                del self._pending[request.camera_id]
+        return requests
+
+    def run(self):
+        t_start = time.monotonic()
+        if self.model is None:
+            try:
+                self.model = load_pose_model(self.model_path, self.backend, self.imgsz, self.precision)
+            except Exception as e:
+                print(f"[Error] HPE model loading failed : {e}")
+                self.ready_slot.emit(False, time.monotonic()-t_start)
+                return
+
+        # warmup before the first camera frame is processed (frames submitted meanwhile wait for it)
+        if self.warmup and not self.is_ready:
+            try:
+                warmup_model(self.model, self.predict_options, self.batch_size)
+            except Exception as e:
+                print(f"[Warning] HPE model warmup failed : {e}")
+        self.is_ready = True
+        self.ready_slot.emit(True, time.monotonic()-t_start)
+
+        while True:
+            if self.isInterruptionRequested():
+                print("pose inference engine is interrupted")
+                break
+
+            requests = [r for r in self._gather() if r.future.set_running_or_notify_cancel()]
+            if not requests:
+                continue
+
+            # one batch per input size (cameras may run at a reduced size)
+            groups = {}
+            default_imgsz = self.predict_options.get("imgsz", DEFAULT_IMGSZ)
+            for request in requests:
+                groups.setdefault(request.imgsz or default_imgsz, []).append(request)
+            for imgsz, group in groups.items():
+                options = dict(self.predict_options, imgsz=imgsz)
+                try:
+                    results = self.model.predict([r.image for r in group], **options)
+                except Exception as e:
+                    for request in group:
+                        request.future.set_exception(e)
+                    continue
+
+                t_done = time.monotonic()
+                self._batch_sizes.append(len(group))
+                results = list(results)
+                for n, request in enumerate(group):
+                    try: # a bad result fails its request only (the engine keeps running)
+                        if n >= len(results):
+                            raise RuntimeError(f"no inference result for camera {request.camera_id}")
+                        pose = PoseResult.from_ultralytics(results[n])
+                    except Exception as e:
+                        request.future.set_exception(e)
+                        continue
+                    self._latency.setdefault(request.camera_id, deque(maxlen=LATENCY_WINDOW)).append((t_done-request.t_submit)*1000.)
+                    request.future.set_result(pose)
+
+            t_now = time.monotonic()
+            if t_now-self._last_report > LATENCY_REPORT_INTERVAL:
+                self._last_report = t_now
+                print(f"[Info] inference latency : {self.latency_stats()}")
+
+    # per-camera submit-to-result latency (ms)
+    def latency_stats(self) -> dict:
+        stats = {}
+        for camera_id, latency in list(self._latency.items()):
+            values = sorted(latency)
+            if values:
+                stats[camera_id] = {"mean":sum(values)/len(values), "p95":values[int(0.95*(len(values)-1))], "max":values[-1]}
+        return stats
+
+    # number of cameras waiting for a batch
+    def queue_depth(self) -> int:
+        with self._cond:
+            return len(self._pending)
+
+    # mean batch size of recent inferences
+    def mean_batch_size(self) -> float:
+        sizes = list(self._batch_sizes)
+        return sum(sizes)/len(sizes) if sizes else 0.
+
+    # engine termination
+    def close(self):
+        self.requestInterruption()
+        self.quit()
+        self.wait(1000)
+
+        with self._cond:
+            pending = list(self._pending.values())
+            self._pending.clear()
+        for request in pending:
+            request.future.cancel()
+
+
+# engine with the model options of the application configuration
+def create_engine(config:dict, batch_size:int=None, lazy_load:bool=True) -> PoseInferenceEngine:
+    model_path = config.get("hpe_model", HPE_MODEL_PATH)
+    if config.get("model_size", None) is not None:
+        model_path = model_path_for_size(config["model_size"])
+    return PoseInferenceEngine(model_path=model_path,
+                               batch_size=batch_size or config.get("inference_batch_size", INFERENCE_BATCH_SIZE),
+                               max_wait_ms=config.get("inference_max_wait_ms", INFERENCE_MAX_WAIT_MS),
+                               imgsz=config.get("inference_imgsz", None),
+                               backend=config.get("inference_backend", BACKEND_TORCH),
+                               precision=config.get("inference_precision", PRECISION_FP32),
+                               lazy_load=lazy_load)
+
+
+# keypoint agreement of two results of the same image (first person), returns (mean normalized distance, PCK@threshold)
+def keypoint_agreement(baseline:PoseResult, candidate:PoseResult, threshold:float=COMPARE_PCK_THRESHOLD):
+    if len(baseline) == 0 or len(candidate) == 0:
+        return None
+    diagonal = max(float(np.linalg.norm(baseline.boxes[0, 2:]-baseline.boxes[0, :2])), 1.)
+    distance = np.linalg.norm(baseline.keypoints[0]-candidate.keypoints[0], axis=1)/diagonal
+    visible = baseline.keypoint_conf[0] >= COMPARE_KEYPOINT_CONF
+    if not visible.any():
+        return None
+    return float(distance[visible].mean()), float((distance[visible] < threshold).mean())
+
+
+# latency and keypoint agreement of a backend against the PyTorch baseline on a recorded clip
+def compare_backends(video_path:str, model_path:str, backend:str, imgsz:int, precision:str, max_frames:int=COMPARE_FRAMES) -> dict:
+    import cv2
+    capture = cv2.VideoCapture(str(video_path))
+    frames = []
+    while len(frames) < max_frames:
+        ret, frame = capture.read()
+        if not ret:
+            break
+        frames.append(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)) # same input as live recording
+    capture.release()
+    if not frames:
+        raise RuntimeError(f"no frame in {video_path}")
+
+    runs = {}
+    for name, (run_backend, run_precision) in (("baseline", (BACKEND_TORCH, PRECISION_FP32)), ("candidate", (backend, precision))):
+        model = load_pose_model(model_path, run_backend, imgsz, run_precision)
+        options = backend_predict_options(run_backend, run_precision, imgsz)
+        warmup_model(model, options, shape=frames[0].shape)
+        latency = []
+        results = []
+        for frame in frames:
+            t_start = time.perf_counter()
+            result = model.predict(frame, **options)[0]
+            latency.append((time.perf_counter()-t_start)*1000.)
+            results.append(PoseResult.from_ultralytics(result))
+        latency = np.asarray(latency)
+        runs[name] = {"backend":run_backend, "precision":run_precision, "results":results,
+                      "latency_ms":{"mean":float(latency.mean()), "p50":float(np.percentile(latency, 50)), "p95":float(np.percentile(latency, 95))}}
+
+    detection_agree = 0
+    agreement = []
+    for base, cand in zip(runs["baseline"]["results"], runs["candidate"]["results"]):
+        detection_agree += int((len(base) > 0) == (len(cand) > 0))
+        matched = keypoint_agreement(base, cand)
+        if matched is not None:
+            agreement.append(matched)
+    agreement = np.asarray(agreement) if agreement else np.full((1, 2), np.nan)
+
+    return {"clip":str(video_path), "frames":len(frames), "imgsz":imgsz,
+            "baseline":{k:v for k, v in runs["baseline"].items() if k != "results"},
+            "candidate":{k:v for k, v in runs["candidate"].items() if k != "results"},
+            "speedup":runs["baseline"]["latency_ms"]["mean"]/runs["candidate"]["latency_ms"]["mean"],
+            "detection_agreement":detection_agree/len(frames),
+            "keypoint_error":float(np.nanmean(agreement[:, 0])), # mean distance / bbox diagonal
+            f"pck@{COMPARE_PCK_THRESHOLD}":float(np.nanmean(agreement[:, 1]))}
+
+
+'''
+Entry point (backend comparison against the PyTorch baseline)
+'''
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare an inference backend with the PyTorch baseline on a recorded clip")
+    parser.add_argument('clip', help="recorded video (e.g. data/<session>/cam_0.avi)")
+    parser.add_argument('--model', nargs='?', required=False, help="pose model weights (*.pt)", default=HPE_MODEL_PATH)
+    parser.add_argument('--backend', nargs='?', required=False, choices=BACKENDS, default=BACKEND_ONNX)
+    parser.add_argument('--precision', nargs='?', required=False, choices=PRECISIONS, default=PRECISION_FP32)
+    parser.add_argument('--imgsz', type=int, required=False, default=DEFAULT_IMGSZ)
+    parser.add_argument('--frames', type=int, required=False, default=COMPARE_FRAMES)
+    args = parser.parse_args()
+
+    report = compare_backends(args.clip, args.model, args.backend, args.imgsz, args.precision, args.frames)
+    print(json.dumps(report, indent=2))
@@ -3,41 +3,152 @@ In-cabin monitoring system performance monitor
 @author bh.hwang@iae.re.kr
 '''
 
+import os
+import pathlib
 from PyQt6.QtCore import QThread, pyqtSignal
-import pynvml
+try:
+    import pynvml
+except ImportError:
+    pynvml = None # gpu monitoring is disabled (no nvidia driver binding)
 
-# for gpu usage monitor
+# pre-defined options
+PROC_DIR = pathlib.Path("/proc")
+THREAD_REPORT_COUNT = 8 # busiest threads of this process in the status
+
+
+# busy and total cpu time of all cores (jiffies), None if /proc is not available
+def read_cpu_times():
+    try:
+        with open(PROC_DIR / "stat") as f:
+            values = [int(v) for v in f.readline().split()[1:]]
+    except (OSError, ValueError):
+        return None
+    idle = values[3] + (values[4] if len(values) > 4 else 0) # idle + iowait
+    total = sum(values[:8]) # guest time is already included in user time
+    return total-idle, total
+
+
+# memory usage from /proc/meminfo, None if not available
+def read_memory():
+    info = {}
+    try:
+        with open(PROC_DIR / "meminfo") as f:
+            for line in f:
+                key, _, value = line.partition(":")
+                info[key] = int(value.split()[0]) # kB
+    except (OSError, ValueError, IndexError):
+        return None
+    total = info.get("MemTotal", 0)
+    available = info.get("MemAvailable", info.get("MemFree", 0))
+    if total <= 0:
+        return None
+    return {"memory_usage":100.*(total-available)/total, "memory_available_mb":available/1024.}
+
+
+# cpu time (clock ticks) of every thread of process, tid -> (name, ticks)
+def read_thread_times(pid:int=None) -> dict:
+    task_dir = PROC_DIR / str(pid if pid is not None else os.getpid()) / "task"
+    times = {}
+    try:
+        tids = os.listdir(task_dir)
+    except OSError:
+        return times
+    for tid in tids:
+        try:
+            with open(task_dir / tid / "stat") as f:
+                stat = f.read()
+        except OSError:
+            continue # thread exited
+        name = stat[stat.index("(")+1:stat.rindex(")")]
+        fields = stat[stat.rindex(")")+2:].split() # fields after the name (state is the first)
+        times[int(tid)] = (name, int(fields[11]) + int(fields[12])) # utime + stime
+    return times
+
+
+'''
+gpu (nvml), cpu, memory and per-thread load monitor
+'''
 class MachineMonitor(QThread):
-    gpu_monitor_slot = pyqtSignal(dict)
+    resource_monitor_slot = pyqtSignal(dict) # one status of the whole machine per interval
 
     def __init__(self, time_ms):
         super().__init__()
 
         self.time_ms = time_ms
         self.gpu_handle = []
-        self.time_ms = time_ms
-
-        # for gpu status
-        pynvml.nvmlInit()
-        self.gpu_count = pynvml.nvmlDeviceGetCount()
-        for gpu_id in range(self.gpu_count):
-            self.gpu_handle.append(pynvml.nvmlDeviceGetHandleByIndex(gpu_id))
+        self.gpu_count = 0
+        self.nvml_initialized = False
+        self.clock_ticks = os.sysconf("SC_CLK_TCK") if hasattr(os, "sysconf") else 100
+        self.last_cpu = None
+        self.last_threads = {}
 
     def run(self):
+        # for gpu status (initialized in this thread, not to delay the window)
+        if pynvml is None:
+            print("[Warning] GPU monitoring is not available : pynvml is not installed")
+        else:
+            try:
+                pynvml.nvmlInit()
+                self.nvml_initialized = True
+                self.gpu_count = pynvml.nvmlDeviceGetCount()
+                for gpu_id in range(self.gpu_count):
+                    self.gpu_handle.append(pynvml.nvmlDeviceGetHandleByIndex(gpu_id))
+            except pynvml.NVMLError as e:
+                print(f"[Warning] GPU monitoring is not available : {e}")
+
         while True:
             if self.isInterruptionRequested():
                 break
 
-            for handle in self.gpu_handle:
+            self.resource_monitor_slot.emit(self.sample())
+            QThread.msleep(self.time_ms)
+
+    # status of all resources (usage in percent, None if not measurable)
+    def sample(self) -> dict:
+        status = {"cpu_count":os.cpu_count()}
+        status.update(self.sample_gpu())
+        status.update(self.sample_cpu())
+        status.update(read_memory() or {"memory_usage":None, "memory_available_mb":None})
+        return status
+
+    # every gpu separately, the busiest one as gpu_usage
+    def sample_gpu(self) -> dict:
+        gpus = []
+        for gpu_id, handle in enumerate(self.gpu_handle):
+            try:
                 info = pynvml.nvmlDeviceGetUtilizationRates(handle)
-                gpu_status = {"gpu_count":int(self.gpu_count), "gpu_usage":int(info.gpu), "gpu_memory_usage":int(info.memory)}
-                self.gpu_monitor_slot.emit(gpu_status)
+            except pynvml.NVMLError:
+                continue
+            gpus.append({"gpu_id":gpu_id, "gpu_usage":int(info.gpu), "gpu_memory_usage":int(info.memory)})
+        return {"gpu_count":int(self.gpu_count), "gpus":gpus,
+                "gpu_usage":max((gpu["gpu_usage"] for gpu in gpus), default=None),
+                "gpu_memory_usage":max((gpu["gpu_memory_usage"] for gpu in gpus), default=None)}
+
+    # machine cpu usage and thread loads of this process (percent of one core) since the previous sample
+    def sample_cpu(self) -> dict:
+        status = {"cpu_usage":None, "process_cpu":None, "threads":[]}
+        cpu = read_cpu_times()
+        if cpu is not None and self.last_cpu is not None and cpu[1] > self.last_cpu[1]:
+            status["cpu_usage"] = 100.*(cpu[0]-self.last_cpu[0])/(cpu[1]-self.last_cpu[1])
+
+        threads = read_thread_times()
+        elapsed = self.time_ms/1000.*self.clock_ticks # ticks per interval
+        if threads and self.last_threads and elapsed > 0:
+            loads = []
+            for tid, (name, ticks) in threads.items():
+                if tid in self.last_threads:
+                    loads.append({"tid":tid, "name":name, "cpu":100.*(ticks-self.last_threads[tid][1])/elapsed})
+            status["process_cpu"] = sum(load["cpu"] for load in loads)
+            status["threads"] = sorted(loads, key=lambda load: load["cpu"], reverse=True)[:THREAD_REPORT_COUNT]
+
+        self.last_cpu = cpu
+        self.last_threads = threads
+        return status
 
-            QThread.msleep(self.time_ms)
-        
     # close machine(gpu) resource monitoring class termination
     def close(self):
-        pynvml.nvmlShutdown()
         self.requestInterruption() # to quit for thread
         self.quit()
         self.wait(1000)
+        if self.nvml_initialized:
+            pynvml.nvmlShutdown()
@@ -0,0 +1,173 @@
+'''
+MQTT message API topics, client creation and an in-process broker stand-in (for tests and dry runs without a broker)
+@author bh.hwang@iae.re.kr
+'''
+
+import queue
+import threading
+import paho.mqtt.client as mqtt
+
+# message API topics
+TOPIC_MANAGER = "flame/avsim/manager"
+TOPIC_REQUEST_ACTIVE = "flame/avsim/mapi_request_active"
+TOPIC_RECORD_START = "flame/avsim/cam/mapi_record_start"
+TOPIC_RECORD_STOP = "flame/avsim/cam/mapi_record_stop"
+TOPIC_CAPTURE = "flame/avsim/cam/mapi_capture"                   # payload {"app", "delay":sec}
+TOPIC_REQUEST_STATUS = "flame/avsim/cam/mapi_request_status"     # answered on TOPIC_STATUS
+TOPIC_REQUEST_METRICS = "flame/avsim/cam/mapi_request_metrics"   # answered on TOPIC_METRICS
+TOPIC_STATUS = "flame/avsim/cam/status"     # per-camera health and throughput (also published periodically)
+TOPIC_METRICS = "flame/avsim/cam/metrics"   # pipeline metrics report
+TOPIC_KEYPOINTS = "flame/avsim/cam/keypoints" # keypoint stream, one sub-topic per camera (binary, see telemetry.py)
+
+# pre-defined options
+MQTT_PORT = 1883
+MQTT_KEEPALIVE = 60
+LOOPBACK_BROKER = "loopback" # broker address of the in-process stand-in
+
+
+# mqtt client (paho-mqtt 1.x and 2.x with the version 1 callback signatures)
+def create_mqtt_client(client_id:str, broker_address:str=None, broker:"LoopbackBroker"=None):
+    if broker_address == LOOPBACK_BROKER or broker is not None:
+        return LoopbackClient(broker if broker is not None else LoopbackBroker.default(), client_id)
+    if hasattr(mqtt, "CallbackAPIVersion"): # paho-mqtt >= 2.0
+        return mqtt.Client(mqtt.CallbackAPIVersion.VERSION1, client_id=client_id, transport='tcp', protocol=mqtt.MQTTv311, clean_session=True)
+    return mqtt.Client(client_id=client_id, transport='tcp', protocol=mqtt.MQTTv311, clean_session=True)
+
+
+'''
+in-process message broker (topic wildcards as MQTT, no persistence, no retained messages)
+'''
+class LoopbackBroker:
+    _default = None
+
+    def __init__(self):
+        self.clients = []
+        self.lock = threading.Lock()
+
+    # broker shared by every client of this process that connects to LOOPBACK_BROKER
+    @classmethod
+    def default(cls) -> "LoopbackBroker":
+        if cls._default is None:
+            cls._default = LoopbackBroker()
+        return cls._default
+
+    def attach(self, client:"LoopbackClient"):
+        with self.lock:
+            if client not in self.clients:
+                self.clients.append(client)
+
+    def detach(self, client:"LoopbackClient"):
+        with self.lock:
+            if client in self.clients:
+                self.clients.remove(client)
+
+    # deliver message to every client with a matching subscription
+    def publish(self, topic:str, payload:bytes):
+        with self.lock:
+            clients = list(self.clients)
+        for client in clients:
+            if client.is_subscribed(topic):
+                client._deliver(topic, payload)
+
+
+'''
+publish result of the loopback client (as paho MQTTMessageInfo, the message is delivered before publish returns)
+'''
+class LoopbackMessageInfo:
+    def __init__(self, mid:int, rc:int):
+        self.mid = mid
+        self.rc = rc
+
+    def is_published(self) -> bool:
+        return self.rc == mqtt.MQTT_ERR_SUCCESS
+
+    def wait_for_publish(self, timeout:float=None):
+        if self.rc != mqtt.MQTT_ERR_SUCCESS:
+            raise RuntimeError(f"Message publish failed: {mqtt.error_string(self.rc)}")
+
+
+'''
+broker stand-in client with the subset of the paho client interface used by this application
+(callbacks are called from the client thread, like the paho network loop)
+'''
+class LoopbackClient:
+    def __init__(self, broker:LoopbackBroker, client_id:str=""):
+        self.broker = broker
+        self.client_id = client_id
+        self.on_connect = None
+        self.on_message = None
+        self.on_disconnect = None
+        self.subscriptions = set()
+        self._connected = False
+        self._inbox = queue.Queue()
+        self._thread = None
+        self._mid = 0
+
+    def connect_async(self, host:str=LOOPBACK_BROKER, port:int=MQTT_PORT, keepalive:int=MQTT_KEEPALIVE):
+        self._inbox.put(("connect", None))
+
+    def connect(self, host:str=LOOPBACK_BROKER, port:int=MQTT_PORT, keepalive:int=MQTT_KEEPALIVE):
+        self.connect_async(host, port, keepalive)
+
+    def loop_start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._loop, name=f"loopback-{self.client_id}", daemon=True)
+            self._thread.start()
+
+    def loop_stop(self):
+        if self._thread is not None:
+            self._inbox.put(("stop", None))
+            self._thread.join()
+            self._thread = None
+
+    def disconnect(self):
+        self._inbox.put(("disconnect", None))
+
+    def is_connected(self) -> bool:
+        return self._connected
+
+    def subscribe(self, topic:str, qos:int=0):
+        self.subscriptions.add(topic)
+        self._mid += 1
+        return mqtt.MQTT_ERR_SUCCESS, self._mid
+
+    def unsubscribe(self, topic:str):
+        self.subscriptions.discard(topic)
+        self._mid += 1
+        return mqtt.MQTT_ERR_SUCCESS, self._mid
+
+    def publish(self, topic:str, payload=None, qos:int=0, retain:bool=False):
+        self._mid += 1
+        if not self._connected:
+            return LoopbackMessageInfo(self._mid, mqtt.MQTT_ERR_NO_CONN)
+        if isinstance(payload, str):
+            payload = payload.encode()
+        self.broker.publish(topic, b"" if payload is None else bytes(payload))
+        return LoopbackMessageInfo(self._mid, mqtt.MQTT_ERR_SUCCESS)
+
+    def is_subscribed(self, topic:str) -> bool:
+        return self._connected and any(mqtt.topic_matches_sub(sub, topic) for sub in list(self.subscriptions))
+
+    def _deliver(self, topic:str, payload:bytes):
+        self._inbox.put(("message", (topic, payload)))
+
+    # client thread (connection state changes and message callbacks)
+    def _loop(self):
+        while True:
+            kind, item = self._inbox.get()
+            if kind == "stop":
+                break
+            if kind == "connect" and not self._connected:
+                self._connected = True
+                self.broker.attach(self)
+                if self.on_connect:
+                    self.on_connect(self, None, {}, 0)
+            elif kind == "disconnect" and self._connected:
+                self._connected = False
+                self.broker.detach(self)
+                if self.on_disconnect:
+                    self.on_disconnect(self, None, 0)
+            elif kind == "message" and self.on_message:
+                message = mqtt.MQTTMessage(topic=item[0].encode())
+                message.payload = item[1]
+                self.on_message(self, None, message)
@@ -0,0 +1,245 @@
+'''
+Hot-path stage instrumentation with rolling HDR-style latency histograms
+@author bh.hwang@iae.re.kr
+'''
+
+import json
+import pathlib
+import threading
+import time
+from datetime import datetime
+import numpy as np
+
+# pre-defined options
+HISTOGRAM_SUB_BITS = 5 # 32 sub-buckets per power of 2 (about 3% relative precision)
+HISTOGRAM_MAX_US = 60*1000*1000 # values above 60 sec are clamped
+ROLLING_WINDOW = 60.0 # sec
+ROLLING_SLOTS = 6 # window is rotated per ROLLING_WINDOW/ROLLING_SLOTS
+PIPELINE_STAGES = ("grab", "queue", "convert", "predict", "draw", "write", "emit", "total")
+REPORT_PERCENTILES = (50, 95, 99)
+
+_SUB_COUNT = 1 << HISTOGRAM_SUB_BITS
+_HALF_COUNT = _SUB_COUNT >> 1
+_MAX_EXPONENT = max(1, HISTOGRAM_MAX_US.bit_length() - HISTOGRAM_SUB_BITS)
+_BUCKETS = _SUB_COUNT + _MAX_EXPONENT*_HALF_COUNT
+
+
+# bucket index of value (us)
+def _bucket_index(value:int) -> int:
+    if value < _SUB_COUNT:
+        return max(value, 0)
+    value = min(value, HISTOGRAM_MAX_US)
+    exponent = value.bit_length() - HISTOGRAM_SUB_BITS
+    return _SUB_COUNT + (exponent-1)*_HALF_COUNT + (value >> exponent) - _HALF_COUNT
+
+
+# lowest value (us) of bucket
+def _bucket_value(index:int) -> int:
+    if index < _SUB_COUNT:
+        return index
+    exponent = (index - _SUB_COUNT)//_HALF_COUNT + 1
+    return ((index - _SUB_COUNT) % _HALF_COUNT + _HALF_COUNT) << exponent
+
+
+# bucket indices of values (vectorized _bucket_index, for bulk histograms of logged values)
+def bucket_indices(values:np.ndarray) -> np.ndarray:
+    values = np.clip(np.asarray(values, dtype=np.int64), 0, HISTOGRAM_MAX_US)
+    exponent = np.maximum(np.frexp(values.astype(np.float64))[1] - HISTOGRAM_SUB_BITS, 1) # bit length of the value
+    indices = _SUB_COUNT + (exponent-1)*_HALF_COUNT + (values >> exponent) - _HALF_COUNT
+    return np.where(values < _SUB_COUNT, values, indices)
+
+
+# lowest values of buckets (vectorized _bucket_value)
+def bucket_values(indices:np.ndarray) -> np.ndarray:
+    indices = np.asarray(indices, dtype=np.int64)
+    exponent = np.maximum((indices - _SUB_COUNT)//_HALF_COUNT + 1, 1)
+    values = ((indices - _SUB_COUNT) % _HALF_COUNT + _HALF_COUNT) << exponent
+    return np.where(indices < _SUB_COUNT, indices, values)
+
+
+# number of histogram buckets
+def bucket_count() -> int:
+    return _BUCKETS
+
+
+'''
+log-linear latency histogram (values in microseconds)
+'''
+class LatencyHistogram:
+    def __init__(self):
+        self.counts = [0]*_BUCKETS
+        self.total = 0
+        self.sum_us = 0
+        self.max_us = 0
+
+    # record latency in seconds
+    def record(self, seconds:float):
+        value = int(seconds*1e6)
+        self.counts[_bucket_index(value)] += 1
+        self.total += 1
+        self.sum_us += value
+        if value > self.max_us:
+            self.max_us = value
+
+    def merge(self, other:"LatencyHistogram"):
+        for i, count in enumerate(other.counts):
+            if count:
+                self.counts[i] += count
+        self.total += other.total
+        self.sum_us += other.sum_us
+        self.max_us = max(self.max_us, other.max_us)
+
+    def reset(self):
+        self.counts = [0]*_BUCKETS
+        self.total = 0
+        self.sum_us = 0
+        self.max_us = 0
+
+    # value at percentile (ms)
+    def percentile(self, p:float) -> float:
+        if self.total == 0:
+            return 0.
+        rank = max(1, int(self.total*p/100. + 0.5))
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                return min(_bucket_value(i), self.max_us)/1000.
+        return self.max_us/1000.
+
+    def mean(self) -> float:
+        return self.sum_us/self.total/1000. if self.total else 0.
+
+    # summary in ms
+    def summary(self) -> dict:
+        summary = {"count":self.total, "mean":round(self.mean(), 3), "max":round(self.max_us/1000., 3)}
+        for p in REPORT_PERCENTILES:
+            summary[f"p{p}"] = round(self.percentile(p), 3)
+        return summary
+
+
+'''
+histogram over a rolling time window (recent ROLLING_WINDOW seconds)
+'''
+class RollingHistogram:
+    def __init__(self, window:float=ROLLING_WINDOW, slots:int=ROLLING_SLOTS):
+        self.slot_length = window/slots
+        self.slots = [LatencyHistogram() for _ in range(slots)]
+        self.slot_ids = [-1]*slots
+
+    # histogram of the current time slot (reset when it is reused)
+    def _current(self) -> LatencyHistogram:
+        slot_id = int(time.monotonic()/self.slot_length)
+        index = slot_id % len(self.slots)
+        if self.slot_ids[index] != slot_id:
+            self.slots[index].reset()
+            self.slot_ids[index] = slot_id
+        return self.slots[index]
+
+    def record(self, seconds:float):
+        self._current().record(seconds)
+
+    # merged histogram of the window
+    def snapshot(self) -> LatencyHistogram:
+        oldest = int(time.monotonic()/self.slot_length) - len(self.slots) + 1
+        merged = LatencyHistogram()
+        for slot_id, histogram in zip(self.slot_ids, self.slots):
+            if slot_id >= oldest:
+                merged.merge(histogram)
+        return merged
+
+
+'''
+lap timer of one frame through the pipeline
+'''
+class StageClock:
+    def __init__(self, metrics:"PipelineMetrics", t_start:float):
+        self.metrics = metrics
+        self.t_start = t_start
+        self.t_last = t_start
+
+    # record time since the previous lap as stage
+    def lap(self, stage:str):
+        now = time.monotonic()
+        self.metrics.record(stage, now-self.t_last)
+        self.t_last = now
+
+    # record time since the clock was started
+    def finish(self, stage:str="total"):
+        self.metrics.record(stage, time.monotonic()-self.t_start)
+
+
+'''
+no-op clock (used when instrumentation is disabled)
+'''
+class _NullStageClock:
+    def lap(self, stage:str):
+        pass
+
+    def finish(self, stage:str="total"):
+        pass
+
+_NULL_CLOCK = _NullStageClock()
+
+
+'''
+per-camera stage latency histograms
+'''
+class PipelineMetrics:
+    def __init__(self, name:str, enabled:bool=True, stages:tuple=PIPELINE_STAGES):
+        self.name = name
+        self.enabled = enabled
+        self.histograms = {stage:RollingHistogram() for stage in stages}
+
+    # clock for a frame (t_start in time.monotonic)
+    def clock(self, t_start:float=None):
+        if not self.enabled:
+            return _NULL_CLOCK
+        return StageClock(self, time.monotonic() if t_start is None else t_start)
+
+    # record latency of stage (sec)
+    def record(self, stage:str, seconds:float):
+        if self.enabled:
+            self.histograms[stage].record(seconds)
+
+    # stage summaries of the rolling window (ms)
+    def summary(self) -> dict:
+        return {stage:histogram.snapshot().summary() for stage, histogram in self.histograms.items()}
+
+    # one line text for the status area
+    def text(self, stages:tuple=("grab", "predict", "draw", "write", "emit", "total")) -> str:
+        parts = []
+        for stage in stages:
+            histogram = self.histograms[stage].snapshot()
+            if histogram.total:
+                parts.append(f"{stage} {histogram.percentile(50):.1f}/{histogram.percentile(99):.1f}")
+        return f"{self.name} : " + (", ".join(parts) if parts else "-")
+
+
+'''
+startup phase timings (seconds since launch)
+'''
+class StartupTimer:
+    def __init__(self, t_launch:float=None):
+        self.t_launch = time.monotonic() if t_launch is None else t_launch # time.monotonic at process launch
+        self.phases = {}
+        self.lock = threading.Lock() # phases are marked from several threads
+
+    # record the first occurrence of phase, returns elapsed time since launch
+    def mark(self, phase:str) -> float:
+        elapsed = time.monotonic()-self.t_launch
+        with self.lock:
+            if phase in self.phases:
+                return self.phases[phase]
+            self.phases[phase] = round(elapsed, 3)
+        print(f"[Startup] {phase} : {elapsed:.3f} s")
+        return elapsed
+
+    # append the phases as a json line (to compare between releases)
+    def save(self, path:str):
+        path = pathlib.Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with self.lock:
+            record = {"timestamp":datetime.now().isoformat(), "phases":dict(self.phases)}
+        with open(path, "a") as f:
+            f.write(json.dumps(record)+"\n")
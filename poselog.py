@@ -0,0 +1,228 @@
+'''
+Fixed-schema binary keypoint log (append-only chunked NumPy files with memory-mapped reader)
+@author bh.hwang@iae.re.kr
+'''
+
+import argparse
+import csv
+import json
+import math
+import pathlib
+import shutil
+from datetime import datetime
+from typing import Optional
+import numpy as np
+
+# pre-defined options
+NUM_KEYPOINTS = 17
+POSELOG_EXT = "kpl" # keypoint log directory extension
+POSELOG_VERSION = 1
+POSELOG_CHUNK_ROWS = 1800 # rows per chunk file (1 min. at 30fps)
+SCHEMA_FILE = "schema.json"
+CHUNK_PATTERN = "chunk_*.npy"
+
+# row flags
+FLAG_DETECTED = 0x01 # keypoints come from the detector
+FLAG_TRACKED = 0x02 # keypoints are propagated by the tracker
+FLAG_HELD = 0x04 # keypoints are held from the previous frame (inference rate is limited)
+FLAG_ESTIMATED_TIME = 0x08 # timestamps are estimated from the frame rate (offline re-extraction without recorded timestamps)
+FLAG_CONVERTED = 0x80 # row converted from a legacy csv file
+
+# one row per person slot (person -1 means no detection in that frame)
+POSE_DTYPE = np.dtype([
+    ("t_wall", "<i8"),          # wall-clock timestamp (ns since epoch)
+    ("t_mono", "<i8"),          # monotonic timestamp (ns), -1 if unknown
+    ("frame", "<i8"),           # frame index of the camera, -1 if unknown
+    ("person", "i1"),           # person slot in the frame
+    ("flags", "u1"),
+    ("keypoints", "<f4", (NUM_KEYPOINTS, 2)),
+    ("keypoint_conf", "<f4", (NUM_KEYPOINTS,)),
+    ("bbox", "<f4", (4,)),      # xyxy
+    ("bbox_conf", "<f4"),
+    ("t_preprocess", "<f4"),    # ms
+    ("t_inference", "<f4"),     # ms
+    ("t_postprocess", "<f4"),   # ms
+])
+
+
+# build log rows of a frame (one row per person, or one empty row without detection)
+def pose_rows(t_wall:float, t_mono:Optional[float], frame_index:int, pose, flags:int=FLAG_DETECTED) -> np.ndarray:
+    n = len(pose)
+    rows = np.zeros(max(n, 1), dtype=POSE_DTYPE)
+    rows["t_wall"] = int(t_wall*1e9)
+    rows["t_mono"] = -1 if t_mono is None else int(t_mono*1e9)
+    rows["frame"] = frame_index
+    rows["flags"] = flags
+    rows["t_preprocess"] = pose.speed["preprocess"]
+    rows["t_inference"] = pose.speed["inference"]
+    rows["t_postprocess"] = pose.speed["postprocess"]
+    if n == 0:
+        rows["person"] = -1
+        rows["keypoints"] = np.nan
+        rows["keypoint_conf"] = np.nan
+        rows["bbox"] = np.nan
+        rows["bbox_conf"] = np.nan
+    else:
+        rows["person"] = np.arange(n)
+        rows["keypoints"] = pose.keypoints
+        rows["keypoint_conf"] = pose.keypoint_conf
+        rows["bbox"] = pose.boxes
+        rows["bbox_conf"] = pose.box_conf
+    return rows
+
+
+# path of the keypoint log of camera in a session directory
+def poselog_path(session_path:pathlib.Path, camera_id) -> pathlib.Path:
+    return pathlib.Path(session_path) / f"pose_cam_{camera_id}.{POSELOG_EXT}"
+
+
+'''
+append-only chunked writer
+'''
+class PoseLogWriter:
+    def __init__(self, path:pathlib.Path, chunk_rows:int=POSELOG_CHUNK_ROWS):
+        self.path = pathlib.Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.chunk_rows = chunk_rows
+        self._buffer = np.zeros(chunk_rows, dtype=POSE_DTYPE)
+        self._count = 0 # rows in buffer
+        self._chunk_seq = len(list(self.path.glob(CHUNK_PATTERN))) # continue an existing log
+        self.rows_written = 0
+
+        schema = self.path / SCHEMA_FILE
+        if not schema.exists():
+            schema.write_text(json.dumps({"version":POSELOG_VERSION, "dtype":np.lib.format.dtype_to_descr(POSE_DTYPE)}))
+
+    # append rows (structured array of POSE_DTYPE)
+    def append(self, rows:np.ndarray):
+        offset = 0
+        while offset < len(rows):
+            n = min(len(rows)-offset, self.chunk_rows-self._count)
+            self._buffer[self._count:self._count+n] = rows[offset:offset+n]
+            self._count += n
+            offset += n
+            if self._count == self.chunk_rows:
+                self.flush()
+
+    # write buffered rows as a new chunk file
+    def flush(self):
+        if self._count == 0:
+            return
+        np.save(self.path / f"chunk_{self._chunk_seq:06d}.npy", self._buffer[:self._count])
+        self._chunk_seq += 1
+        self.rows_written += self._count
+        self._count = 0
+
+    # writer interface for AsyncWriter
+    def write(self, rows:np.ndarray):
+        self.append(rows)
+
+    def close(self):
+        self.flush()
+
+
+'''
+memory-mapped reader
+'''
+class PoseLogReader:
+    def __init__(self, path:pathlib.Path):
+        self.path = pathlib.Path(path)
+        schema = json.loads((self.path / SCHEMA_FILE).read_text())
+        if schema["version"] != POSELOG_VERSION:
+            raise ValueError(f"unsupported keypoint log version : {schema['version']}")
+        self.chunks = [np.load(p, mmap_mode="r") for p in sorted(self.path.glob(CHUNK_PATTERN))]
+
+    def __len__(self):
+        return sum(len(c) for c in self.chunks)
+
+    # all rows as one array
+    def read(self) -> np.ndarray:
+        if not self.chunks:
+            return np.zeros(0, dtype=POSE_DTYPE)
+        if len(self.chunks) == 1:
+            return self.chunks[0]
+        return np.concatenate(self.chunks)
+
+    # rows in wall-clock time range [t_begin, t_end) (datetime or ns)
+    def between(self, t_begin, t_end) -> np.ndarray:
+        rows = self.read()
+        if isinstance(t_begin, datetime):
+            t_begin = int(t_begin.timestamp()*1e9)
+        if isinstance(t_end, datetime):
+            t_end = int(t_end.timestamp()*1e9)
+        begin, end = np.searchsorted(rows["t_wall"], [t_begin, t_end])
+        return rows[begin:end]
+
+
+# parse legacy csv timestamp (local time) into ns
+def _parse_csv_timestamp(text:str) -> int:
+    return int(datetime.strptime(text, "%Y-%m-%d %H:%M:%S.%f").timestamp()*1e9)
+
+
+# convert legacy ragged pose csv rows into log rows
+def csv_to_rows(csv_path:pathlib.Path) -> np.ndarray:
+    rows = []
+    with open(csv_path, newline='') as f:
+        for record in csv.reader(f):
+            if not record:
+                continue
+            t_wall = _parse_csv_timestamp(record[0])
+            values = [float(v) for v in record[1:]]
+            timings, values = values[-3:], values[:-3]
+
+            # keypoints of every person first, bboxes after (old sessions logged only a bbox)
+            if all(math.isnan(v) for v in values):
+                n_person = 0
+            elif len(values) == 4:
+                values = [float('nan')]*(NUM_KEYPOINTS*2) + values
+                n_person = 1
+            else:
+                n_person = len(values) // (NUM_KEYPOINTS*2+4)
+            frame_rows = np.zeros(max(n_person, 1), dtype=POSE_DTYPE)
+            frame_rows["t_wall"] = t_wall
+            frame_rows["t_mono"] = -1
+            frame_rows["frame"] = -1
+            frame_rows["t_preprocess"], frame_rows["t_inference"], frame_rows["t_postprocess"] = timings
+            frame_rows["keypoint_conf"] = np.nan
+            frame_rows["bbox_conf"] = np.nan
+            if n_person == 0:
+                frame_rows["person"] = -1
+                frame_rows["flags"] = FLAG_CONVERTED
+                frame_rows["keypoints"] = np.nan
+                frame_rows["bbox"] = np.nan
+            else:
+                kps = np.asarray(values[:n_person*NUM_KEYPOINTS*2], dtype=np.float32).reshape(n_person, NUM_KEYPOINTS, 2)
+                bbox = np.asarray(values[n_person*NUM_KEYPOINTS*2:n_person*(NUM_KEYPOINTS*2+4)], dtype=np.float32).reshape(n_person, 4)
+                frame_rows["person"] = np.arange(n_person)
+                frame_rows["flags"] = FLAG_CONVERTED | FLAG_DETECTED
+                frame_rows["keypoints"] = kps
+                frame_rows["bbox"] = bbox
+            rows.append(frame_rows)
+    return np.concatenate(rows) if rows else np.zeros(0, dtype=POSE_DTYPE)
+
+
+# convert legacy pose csv file into keypoint log (written next to the csv file by default)
+def convert_csv(csv_path:pathlib.Path, out_path:pathlib.Path=None) -> pathlib.Path:
+    csv_path = pathlib.Path(csv_path)
+    if out_path is None:
+        out_path = csv_path.with_suffix(f".{POSELOG_EXT}")
+    rows = csv_to_rows(csv_path)
+    if pathlib.Path(out_path).exists():
+        shutil.rmtree(out_path) # re-conversion replaces the previous log
+    writer = PoseLogWriter(out_path)
+    writer.append(rows)
+    writer.close()
+    print(f"[Info] converted {csv_path} ({len(rows)} rows) -> {out_path}")
+    return out_path
+
+
+'''
+Entry point (legacy csv converter)
+'''
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Convert legacy pose csv files into binary keypoint logs")
+    parser.add_argument('csv', nargs='+', help="pose csv file(s) (e.g. data/*/pose.csv)")
+    args = parser.parse_args()
+
+    for path in args.csv:
+        convert_csv(path)
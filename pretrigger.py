@@ -0,0 +1,188 @@
+'''
+Pre-trigger buffer (last seconds of JPEG-compressed frames and pose rows before the record trigger)
+@author bh.hwang@iae.re.kr
+'''
+
+import queue
+import threading
+import time
+from collections import deque
+from typing import NamedTuple
+import cv2
+import numpy as np
+from PyQt6.QtCore import QThread
+from framebuffer import TimedFrame
+from poselog import POSE_DTYPE
+
+# pre-defined options
+PRETRIGGER_SECONDS = 3.0 # buffered time before the trigger (0 disables the buffer)
+PRETRIGGER_MAX_MB = 64 # memory cap per camera (compressed frames and pose rows)
+PRETRIGGER_JPEG_QUALITY = 90
+PRETRIGGER_QUEUE_SIZE = 8 # grabbed frames waiting for compression (more are skipped, the grabber never waits)
+
+
+'''
+compressed frame with capture timestamps
+'''
+class EncodedFrame(NamedTuple):
+    index: int
+    t_mono: float
+    t_wall: float
+    data: bytes     # JPEG
+
+
+'''
+buffered frames handed to a video writer as one item (decoded in the writer thread)
+frames not compressed yet when the buffer was taken are TimedFrames
+'''
+class EncodedFrames:
+    def __init__(self, frames:list, overlay=None):
+        self.frames = frames
+        self.overlay = overlay # overlay(image, encoded frame) -> image to write, optional
+
+    def __len__(self):
+        return len(self.frames)
+
+    # (encoded frame, image) pairs
+    def decode(self):
+        for frame in self.frames:
+            if isinstance(frame, TimedFrame):
+                image = frame.image
+            else:
+                image = cv2.imdecode(np.frombuffer(frame.data, dtype=np.uint8), cv2.IMREAD_COLOR)
+            if image is None:
+                continue
+            yield frame, (self.overlay(image, frame) if self.overlay is not None else image)
+
+
+'''
+bounded ring of the most recent frames (compressed by its own thread) and pose rows
+'''
+class PreTriggerBuffer(QThread):
+    def __init__(self, name:str, seconds:float=PRETRIGGER_SECONDS, max_mb:float=PRETRIGGER_MAX_MB,
+                 jpeg_quality:int=PRETRIGGER_JPEG_QUALITY, queue_size:int=PRETRIGGER_QUEUE_SIZE):
+        super().__init__()
+        self.setObjectName(name)
+
+        self.seconds = seconds
+        self.max_bytes = int(max_mb*1024*1024)
+        self.encode_params = [int(cv2.IMWRITE_JPEG_QUALITY), int(jpeg_quality)]
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._frames = deque() # EncodedFrame, oldest first
+        self._poses = deque() # (t_mono, pose rows)
+        self._cond = threading.Condition()
+        self._encoding = None # frame being compressed (handed over as it is if the buffer is taken meanwhile)
+        self._generation = 0 # incremented when the buffer is taken or cleared
+        self.bytes = 0 # memory in use
+
+        # counters
+        self.encoded = 0
+        self.skipped = 0    # frames not compressed in time (queue full)
+        self.evicted = 0    # frames evicted by the memory cap before their time
+        self.encode_time_total = 0. # sec
+
+    # add grabbed frame (never blocks)
+    def put(self, frame_t:TimedFrame):
+        try:
+            self._queue.put_nowait(frame_t)
+        except queue.Full:
+            self.skipped += 1
+            return
+        with self._cond:
+            self._cond.notify_all()
+
+    # add pose rows of a processed frame (poselog.POSE_DTYPE)
+    def put_pose(self, t_mono:float, rows:np.ndarray):
+        with self._cond:
+            self._poses.append((t_mono, rows))
+            self.bytes += rows.nbytes
+            self._evict()
+
+    def run(self):
+        while not self.isInterruptionRequested():
+            with self._cond: # taken from the queue and marked as being compressed at once (take never misses a frame)
+                try:
+                    frame_t = self._queue.get_nowait()
+                except queue.Empty:
+                    self._cond.wait(0.1)
+                    continue
+                self._encoding = frame_t
+                generation = self._generation
+            t_start = time.perf_counter()
+            ok, data = cv2.imencode(".jpg", frame_t.image, self.encode_params)
+            self.encode_time_total += time.perf_counter()-t_start
+            with self._cond:
+                if ok and generation == self._generation: # otherwise handed over uncompressed by take
+                    self._frames.append(EncodedFrame(frame_t.index, frame_t.t_mono, frame_t.t_wall, data.tobytes()))
+                    self.bytes += len(self._frames[-1].data)
+                    self.encoded += 1
+                    self._evict()
+                self._encoding = None
+
+    # drop entries older than the buffered time, and the oldest ones over the memory cap
+    def _evict(self):
+        newest = max(self._frames[-1].t_mono if self._frames else 0., self._poses[-1][0] if self._poses else 0.)
+        while self._frames and (self._frames[0].t_mono < newest-self.seconds or self.bytes > self.max_bytes):
+            if self._frames[0].t_mono >= newest-self.seconds:
+                self.evicted += 1
+            self.bytes -= len(self._frames.popleft().data)
+        oldest = self._frames[0].t_mono if self._frames else newest-self.seconds
+        while self._poses and (self._poses[0][0] < oldest or self.bytes > self.max_bytes):
+            self.bytes -= self._poses.popleft()[1].nbytes
+
+    # take every buffered frame and pose rows (for the session starting now), the buffer is emptied
+    # never waits : frames not compressed yet are handed over as TimedFrames (oldest first in any case)
+    def take(self) -> tuple:
+        with self._cond:
+            frames = list(self._frames)
+            if self._encoding is not None:
+                frames.append(self._encoding)
+            frames.extend(self._drain())
+            rows = [rows for _, rows in self._poses]
+            self._clear()
+        rows = np.concatenate(rows) if rows else np.zeros(0, dtype=POSE_DTYPE)
+        return frames, rows
+
+    def clear(self):
+        with self._cond:
+            self._drain()
+            self._clear()
+
+    def _clear(self):
+        self._frames.clear()
+        self._poses.clear()
+        self._encoding = None
+        self._generation += 1
+        self.bytes = 0
+
+    # frames waiting for compression
+    def _drain(self) -> list:
+        frames = []
+        while True:
+            try:
+                frames.append(self._queue.get_nowait())
+            except queue.Empty:
+                return frames
+
+    # buffered time and memory use
+    def stats(self) -> dict:
+        with self._cond:
+            frames = len(self._frames)
+            seconds = self._frames[-1].t_mono-self._frames[0].t_mono if frames > 1 else 0.
+            used = self.bytes
+        return {"frames":frames, "seconds":round(seconds, 3), "memory_mb":round(used/1024/1024, 2),
+                "max_memory_mb":round(self.max_bytes/1024/1024, 2), "skipped":self.skipped, "evicted":self.evicted,
+                "encode_ms_mean":round(self.encode_time_total/self.encoded*1000., 3) if self.encoded else 0.}
+
+    def close(self):
+        self.requestInterruption()
+        self.wait(1000)
+
+
+# pre-trigger buffer of a camera from the application configuration (None if disabled)
+def create_pretrigger(camera_id, config:dict):
+    seconds = config.get("pretrigger_seconds", 0)
+    if not seconds or seconds <= 0:
+        return None
+    return PreTriggerBuffer(f"pretrigger-{camera_id}", seconds, max_mb=config.get("pretrigger_max_mb", PRETRIGGER_MAX_MB),
+                            jpeg_quality=config.get("pretrigger_jpeg_quality", PRETRIGGER_JPEG_QUALITY))
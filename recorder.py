@@ -0,0 +1,331 @@
+'''
+Asynchronous recording writers (video, keypoint log and snapshot images)
+@author bh.hwang@iae.re.kr
+'''
+
+import cv2
+import json
+import pathlib
+import pickle
+import queue
+import threading
+import time
+from collections import deque
+from PyQt6.QtCore import QThread
+from poselog import PoseLogWriter, poselog_path
+from pretrigger import EncodedFrames
+from framebuffer import TimedFrame
+from frameindex import FrameIndexWriter, index_path
+
+# pre-defined options
+WRITER_QUEUE_SIZE = 64 # items per writer queue
+OVERFLOW_BLOCK = "block"    # producer waits until there is space in the queue
+OVERFLOW_DROP = "drop"      # newest item is discarded
+OVERFLOW_SPILL = "spill"    # items are spilled to disk and written later in order
+OVERFLOW_POLICIES = (OVERFLOW_BLOCK, OVERFLOW_DROP, OVERFLOW_SPILL)
+SPILL_DIR_NAME = ".spill"
+RECORD_META_PATTERN = "record_cam_{}.json" # start timestamps and first frame of a camera in the session
+
+
+'''
+video file sink (with the seek index of timestamped frames if an index path is given)
+'''
+class VideoSink:
+    def __init__(self, path:pathlib.Path, fourcc:str, fps:float, size:tuple, index_path:pathlib.Path=None):
+        self.path = path
+        self.writer = cv2.VideoWriter(str(path), cv2.VideoWriter_fourcc(*fourcc), fps, size)
+        self.index = FrameIndexWriter(index_path) if index_path is not None else None
+
+    def write(self, frame):
+        if isinstance(frame, EncodedFrames): # pre-trigger frames
+            for encoded, image in frame.decode():
+                self.writer.write(image)
+                if self.index is not None:
+                    self.index.add(encoded.index, encoded.t_mono, encoded.t_wall)
+            return
+        if isinstance(frame, TimedFrame):
+            if self.index is not None:
+                self.index.add(frame.index, frame.t_mono, frame.t_wall)
+            frame = frame.image
+        self.writer.write(frame)
+
+    def close(self):
+        self.writer.release()
+        if self.index is not None:
+            self.index.save(self.path)
+
+
+'''
+image file sink (item is a tuple of path and image)
+'''
+class ImageSink:
+    def write(self, item):
+        path, image = item
+        cv2.imwrite(str(path), image)
+
+    def close(self):
+        pass
+
+
+# marker to finish the writer thread
+_CLOSE = object()
+
+
+'''
+background writer consuming items from a bounded queue
+'''
+class AsyncWriter(QThread):
+    def __init__(self, sink, name:str, queue_size:int=WRITER_QUEUE_SIZE, overflow:str=OVERFLOW_BLOCK, spill_dir:pathlib.Path=None):
+        super().__init__()
+
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError(f"unknown overflow policy : {overflow} (one of {OVERFLOW_POLICIES})")
+        if overflow == OVERFLOW_SPILL and spill_dir is None:
+            raise ValueError("spill overflow policy requires a spill directory")
+
+        self.sink = sink
+        self.name = name
+        self.setObjectName(name) # thread name (per-thread load in the resource monitor)
+        self.queue_size = queue_size
+        self.overflow = overflow
+        self.spill_dir = spill_dir
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._spilled = deque() # spilled file paths (or close marker) in order
+        self._spill_seq = 0
+        self._lock = threading.Lock()
+        self._closed = False
+        self._blocked = 0 # puts waiting for queue space (their items are still written after close)
+
+        # counters
+        self.written = 0
+        self.dropped = 0
+        self.spilled = 0
+        self.errors = 0
+        self.write_time_total = 0.  # sec
+        self.write_time_max = 0.    # sec
+
+    # put item to write (returns False if the item is dropped)
+    def put(self, item) -> bool:
+        with self._lock:
+            if self._closed:
+                self.dropped += 1
+                return False
+
+            # keep order : once spilling has started, every item goes to disk until it is drained
+            if self.overflow == OVERFLOW_SPILL and (self._spilled or self._queue.full()):
+                self._spill(item)
+                return True
+
+            if self.overflow != OVERFLOW_BLOCK:
+                try:
+                    self._queue.put_nowait(item)
+                    return True
+                except queue.Full:
+                    self.dropped += 1
+                    return False
+            self._blocked += 1
+
+        try:
+            self._queue.put(item) # block (the writer drains the queue until no put is waiting, also after close)
+        finally:
+            with self._lock:
+                self._blocked -= 1
+        return True
+
+    # write item into spill file
+    def _spill(self, item):
+        self.spill_dir.mkdir(parents=True, exist_ok=True)
+        path = self.spill_dir / f"{self.name}_{self._spill_seq:08d}.pkl"
+        self._spill_seq += 1
+        with open(path, "wb") as f:
+            pickle.dump(item, f, protocol=pickle.HIGHEST_PROTOCOL)
+        self._spilled.append(path)
+        self.spilled += 1
+
+    # next item (queue first, spilled items after the queue is drained)
+    def _next_item(self):
+        with self._lock:
+            spilling = bool(self._spilled)
+        try:
+            # spilled items are waiting : no wait on the (drained) queue, otherwise a spill never catches up
+            return self._queue.get_nowait() if spilling else self._queue.get(timeout=0.05)
+        except queue.Empty:
+            pass
+
+        with self._lock:
+            if not self._spilled:
+                return None
+            path = self._spilled.popleft()
+        if path is _CLOSE:
+            return _CLOSE
+        with open(path, "rb") as f:
+            item = pickle.load(f)
+        path.unlink()
+        return item
+
+    def run(self):
+        closing = False
+        while True:
+            item = self._next_item()
+            if item is _CLOSE:
+                closing = True
+                continue
+            if item is None:
+                # items of puts that were blocked while closing are queued behind the close marker
+                if closing and self._blocked == 0 and self._queue.empty():
+                    break
+                continue
+
+            t_start = time.perf_counter()
+            try:
+                self.sink.write(item)
+                self.written += 1
+            except Exception as e:
+                self.errors += 1
+                print(f"[Error] {self.name} writer failed : {e}")
+            elapsed = time.perf_counter() - t_start
+            self.write_time_total += elapsed
+            self.write_time_max = max(self.write_time_max, elapsed)
+
+        self.sink.close()
+        print(f"[Info] {self.name} writer is closed ({self.written} written, {self.dropped} dropped, {self.spilled} spilled)")
+
+    # flush the remaining items and close the sink (wait=False returns immediately)
+    def close(self, wait:bool=True):
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            if self._spilled:
+                self._spilled.append(_CLOSE)
+                spilling = True
+            else:
+                spilling = False
+        if not spilling:
+            self._queue.put(_CLOSE)
+        if wait:
+            self.wait()
+
+    # number of items waiting to be written
+    def depth(self) -> int:
+        return self._queue.qsize() + len(self._spilled)
+
+    # fraction of the queue in use (>= 1 means the writer does not keep up)
+    def fill(self) -> float:
+        return self.depth()/self.queue_size if self.queue_size > 0 else 0.
+
+    # writer status
+    def stats(self) -> dict:
+        return {"depth":self.depth(), "written":self.written, "dropped":self.dropped, "spilled":self.spilled, "errors":self.errors,
+                "write_ms_mean":(self.write_time_total/self.written*1000.) if self.written else 0.,
+                "write_ms_max":self.write_time_max*1000.}
+
+
+'''
+recording session of a camera (owns raw/processed video and binary keypoint log writers)
+writers can be opened ahead of the record trigger and moved with their session directory
+without the processed video (raw only), the annotated video is rendered afterwards from the raw video and keypoint log (render.py)
+'''
+class SessionRecorder:
+    def __init__(self, out_path:pathlib.Path, camera_id, fps:float, size:tuple, fourcc:str="MJPG", video_ext:str="avi",
+                 queue_size:int=WRITER_QUEUE_SIZE, overflow:str=OVERFLOW_BLOCK, processed:bool=True):
+        self.out_path = out_path
+        self.camera_id = camera_id
+        self.fps = fps
+        self.size = size
+        self.t_start = None # common start timestamp of the session (time.monotonic)
+        self.t_start_wall = None
+        self.first_frame = None # first recorded frame and its latency from the trigger
+        self.pretrigger = None # frames recorded from the pre-trigger buffer
+        spill_dir = out_path / SPILL_DIR_NAME
+
+        self.raw_writer = AsyncWriter(VideoSink(out_path/f"cam_{camera_id}.{video_ext}", fourcc, fps, size, index_path(out_path, camera_id)),
+                                      f"raw_cam_{camera_id}", queue_size, overflow, spill_dir)
+        self.processed_writer = None
+        if processed:
+            self.processed_writer = AsyncWriter(VideoSink(out_path/f"proc_cam_{camera_id}.{video_ext}", fourcc, fps, size),
+                                                f"proc_cam_{camera_id}", queue_size, overflow, spill_dir)
+        self.pose_writer = AsyncWriter(PoseLogWriter(poselog_path(out_path, camera_id)), f"pose_cam_{camera_id}", queue_size, overflow, spill_dir)
+        self.writers = tuple(writer for writer in (self.raw_writer, self.processed_writer, self.pose_writer) if writer is not None)
+        for writer in self.writers:
+            writer.start()
+
+    # raw frame (TimedFrame is indexed by its timestamps)
+    def write_raw(self, frame) -> bool:
+        return self.raw_writer.put(frame)
+
+    def write_processed(self, frame) -> bool:
+        return self.processed_writer.put(frame) if self.processed_writer is not None else False
+
+    # True if the processed (annotated) video is recorded
+    @property
+    def records_processed(self) -> bool:
+        return self.processed_writer is not None
+
+    def write_pose(self, row) -> bool:
+        return self.pose_writer.put(row)
+
+    # frames and pose rows from before the trigger (must be written before any live frame)
+    def write_pretrigger(self, frames:list, rows, overlay=None, processed:list=None):
+        if frames:
+            self.raw_writer.put(EncodedFrames(frames))
+            self.pretrigger = {"frames":len(frames), "first_index":frames[0].index, "t_mono":frames[0].t_mono, "t_wall":frames[0].t_wall,
+                               "seconds":round((self.t_start if self.t_start is not None else frames[-1].t_mono)-frames[0].t_mono, 3)}
+        if processed and self.processed_writer is not None:
+            self.processed_writer.put(EncodedFrames(processed, overlay))
+        if len(rows):
+            self.pose_writer.put(rows)
+
+    # session directory was renamed (only before the first item is written)
+    def relocate(self, out_path:pathlib.Path):
+        out_path = pathlib.Path(out_path)
+        for writer in self.writers:
+            writer.spill_dir = out_path / SPILL_DIR_NAME
+            if hasattr(writer.sink, "path"):
+                writer.sink.path = out_path / writer.sink.path.name
+            if getattr(writer.sink, "index", None) is not None:
+                writer.sink.index.path = out_path / writer.sink.index.path.name
+        self.out_path = out_path
+
+    # common start timestamp of the session
+    def set_start(self, t_start:float, t_start_wall:float):
+        self.t_start = t_start
+        self.t_start_wall = t_start_wall
+        self.first_frame = None
+
+    # first recorded frame (grab time), returns the latency from the trigger in sec
+    def mark_first_frame(self, index:int, t_mono:float, t_wall:float) -> float:
+        latency = t_mono-self.t_start if self.t_start is not None else 0.
+        self.first_frame = {"index":index, "t_mono":t_mono, "t_wall":t_wall, "latency_ms":round(latency*1000., 3),
+                            "written_ms":round((time.monotonic()-self.t_start)*1000., 3) if self.t_start is not None else None}
+        return latency
+
+    # start timestamps and first frame of this camera (written into the session directory on close)
+    def meta(self) -> dict:
+        return {"camera_id":str(self.camera_id), "fps":self.fps, "size":list(self.size), "processed_video":self.records_processed,
+                "t_start_mono":self.t_start, "t_start_wall":self.t_start_wall, "first_frame":self.first_frame, "pretrigger":self.pretrigger}
+
+    # flush and close all writers
+    def close(self, wait:bool=True):
+        if self.t_start is not None:
+            try:
+                (self.out_path / RECORD_META_PATTERN.format(self.camera_id)).write_text(json.dumps(self.meta(), indent=2))
+            except OSError as e:
+                print(f"[Warning] camera {self.camera_id} record info is not saved : {e}")
+        for writer in self.writers:
+            writer.close(wait=False)
+        if wait:
+            for writer in self.writers:
+                writer.wait()
+
+    # True if every writer finished
+    def is_finished(self) -> bool:
+        return all(writer.isFinished() for writer in self.writers)
+
+    # fill of the fullest writer queue
+    def fill(self) -> float:
+        return max(writer.fill() for writer in self.writers)
+
+    # queue depth and write latency of each writer
+    def stats(self) -> dict:
+        return {writer.name:writer.stats() for writer in self.writers}
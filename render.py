@@ -0,0 +1,255 @@
+'''
+Offline overlay renderer (annotated video from the raw video, seek index and keypoint log of a recorded session)
+@author bh.hwang@iae.re.kr
+'''
+
+import argparse
+import multiprocessing as mp
+import os
+import pathlib
+import struct
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+import cv2
+import numpy as np
+from frameindex import IndexedVideo, session_cameras
+
+# pre-defined options
+RENDER_CHUNK_FRAMES = 150 # frames per parallel work item
+RENDER_JPEG_QUALITY = 90
+RENDER_HOLD_S = 0.5 # keypoints of the last processed frame are drawn on the following raw frames up to this age
+RENDER_ROWS_MARGIN_S = 1.0 # keypoint rows passed to a chunk beyond its frames and the hold time (timestamp jitter)
+RENDER_FILE_PATTERN = "render_cam_{}.avi"
+AVI_MAX_BYTES = 1 << 30 # output continues in a new part file beyond this size (AVI 1.0 without OpenDML index)
+
+_AVIF_HASINDEX = 0x10
+_AVIIF_KEYFRAME = 0x10
+
+
+'''
+MJPEG AVI writer taking already encoded JPEG frames (no re-encoding of the rendered frames)
+'''
+class MjpegAviWriter:
+    def __init__(self, path:pathlib.Path, fps:float, size:tuple):
+        self.path = pathlib.Path(path)
+        self.fps = fps
+        self.size = size
+        self.frames = 0
+        self._index = [] # (offset from movi, size)
+        self._max_frame = 0
+        self._file = open(self.path, "wb")
+        self._write_headers()
+
+    def _write_headers(self):
+        width, height = self.size
+        scale, rate = 1000, int(round(self.fps*1000))
+        f = self._file
+        f.write(b"RIFF\0\0\0\0AVI ")
+        f.write(b"LIST" + struct.pack("<I", 4+8+56+8+4+8+56+8+40) + b"hdrl")
+        self._avih = f.tell()+8
+        f.write(b"avih" + struct.pack("<I14I", 56, int(1e6/self.fps), 0, 0, _AVIF_HASINDEX, 0, 0, 1, 0, width, height, 0, 0, 0, 0))
+        f.write(b"LIST" + struct.pack("<I", 4+8+56+8+40) + b"strl")
+        self._strh = f.tell()+8
+        f.write(b"strh" + struct.pack("<I4s4sIHHIIIIIIII4h", 56, b"vids", b"MJPG", 0, 0, 0, 0, scale, rate, 0, 0, 0, 0xFFFFFFFF, 0, 0, 0, width, height))
+        f.write(b"strf" + struct.pack("<IIiiHH4sIiiII", 40, 40, width, height, 1, 24, b"MJPG", width*height*3, 0, 0, 0, 0))
+        self._movi = f.tell()
+        f.write(b"LIST\0\0\0\0movi")
+
+    def write(self, jpeg:bytes):
+        f = self._file
+        offset = f.tell()-(self._movi+8) # relative to the movi fourcc
+        f.write(b"00dc" + struct.pack("<I", len(jpeg)))
+        f.write(jpeg)
+        if len(jpeg) & 1:
+            f.write(b"\0")
+        self._index.append((offset, len(jpeg)))
+        self._max_frame = max(self._max_frame, len(jpeg))
+        self.frames += 1
+
+    # bytes written so far
+    def tell(self) -> int:
+        return self._file.tell()
+
+    def close(self):
+        f = self._file
+        movi_end = f.tell()
+        index = np.zeros(len(self._index), dtype=[("ckid", "S4"), ("flags", "<u4"), ("offset", "<u4"), ("size", "<u4")])
+        index["ckid"] = b"00dc"
+        index["flags"] = _AVIIF_KEYFRAME
+        if len(index):
+            index["offset"], index["size"] = np.array(self._index, dtype=np.uint32).T
+        f.write(b"idx1" + struct.pack("<I", index.nbytes) + index.tobytes())
+        file_end = f.tell()
+
+        f.seek(4)
+        f.write(struct.pack("<I", file_end-8))
+        f.seek(self._movi+4)
+        f.write(struct.pack("<I", movi_end-self._movi-8))
+        f.seek(self._avih+16) # total frames
+        f.write(struct.pack("<I", self.frames))
+        f.seek(self._avih+28) # suggested buffer size
+        f.write(struct.pack("<I", self._max_frame))
+        f.seek(self._strh+32) # stream length
+        f.write(struct.pack("<II", self.frames, self._max_frame))
+        f.close()
+
+
+# draw keypoints, person boxes and the frame timestamp on a BGR image
+def draw_overlay(image:np.ndarray, rows:np.ndarray, camera_id, t_wall_ns:int, held:bool=False) -> np.ndarray:
+    color = (0, 165, 255) if held else (0, 0, 255) # held keypoints (from an earlier frame) in orange
+    for row in rows[rows["person"] >= 0]:
+        for x, y in row["keypoints"]:
+            if np.isfinite(x) and np.isfinite(y):
+                cv2.circle(image, center=(int(x), int(y)), radius=7, color=color, thickness=-1)
+        if np.all(np.isfinite(row["bbox"])):
+            x1, y1, x2, y2 = row["bbox"].astype(int)
+            cv2.rectangle(image, (x1, y1), (x2, y2), (0, 255, 0), 2)
+    _h = image.shape[0]
+    cv2.putText(image, f"Camera #{camera_id}", (10, 55), cv2.FONT_HERSHEY_SIMPLEX, 1.5, (0,255,0), 2, cv2.LINE_AA)
+    cv2.putText(image, datetime.fromtimestamp(t_wall_ns/1e9).strftime('%Y-%m-%d %H:%M:%S.%f')[:-3], (10, _h-10),
+                cv2.FONT_HERSHEY_SIMPLEX, 1.5, (0,255,0), 2, cv2.LINE_AA)
+    return image
+
+
+'''
+annotated frames of a recorded video (sequential, also usable for streaming a time range)
+'''
+class OverlayRenderer:
+    def __init__(self, session_path:pathlib.Path, camera_id, hold_s:float=RENDER_HOLD_S, rows:np.ndarray=None):
+        self.video = IndexedVideo(session_path, camera_id, rows)
+        self.camera_id = camera_id
+        self.hold_ns = int(hold_s*1e9)
+        rows = self.video.rows
+        self._pose_frames = rows["frame"]
+        self._pose_times = rows["t_wall"]
+
+    # frame numbers [begin, end) of a time range (whole video if not given)
+    def frame_range(self, t_begin=None, t_end=None, clock:str="wall") -> tuple:
+        if t_begin is None and t_end is None:
+            return 0, len(self.video)
+        begin = self.video.locate_range(t_begin, t_begin, clock)[0] if t_begin is not None else 0
+        end = self.video.locate_range(t_end, t_end, clock)[0] if t_end is not None else len(self.video)
+        return begin, end
+
+    # keypoint rows of the frame, or of the last processed frame within the hold time
+    def pose_of(self, frame:int) -> tuple:
+        rows = self.video.keypoints(frame)
+        if len(rows) or not len(self._pose_frames):
+            return rows, False
+        entry = self.video.index[frame]
+        key = self._pose_frames if entry["source"] >= 0 and self._pose_frames[0] >= 0 else self._pose_times
+        last = int(np.searchsorted(key, entry["source"] if key is self._pose_frames else entry["t_wall"], side="right"))-1
+        if last < 0 or entry["t_wall"]-self._pose_times[last] > self.hold_ns:
+            return rows, False
+        first = int(np.searchsorted(key, key[last])) # rows of the same frame
+        return self.video.rows[first:last+1], True
+
+    # keypoint rows needed by frames [begin, end) (with the hold time before), so a chunk does not load the whole log
+    def rows_of(self, begin:int, end:int) -> np.ndarray:
+        margin = self.hold_ns+int(RENDER_ROWS_MARGIN_S*1e9)
+        t_begin, t_end = int(self.video.index["t_wall"][begin])-margin, int(self.video.index["t_wall"][end-1])+margin
+        first, last = np.searchsorted(self._pose_times, t_begin), np.searchsorted(self._pose_times, t_end, side="right")
+        return np.array(self.video.rows[int(first):int(last)])
+
+    # (index entry, annotated BGR image) of frames [begin, end)
+    def frames(self, begin:int, end:int):
+        for frame in range(begin, end):
+            image = self.video.read_frame(frame)
+            if image is None:
+                continue
+            rows, held = self.pose_of(frame)
+            entry = self.video.index[frame]
+            yield entry, draw_overlay(image, rows, self.camera_id, int(entry["t_wall"]), held)
+
+    def close(self):
+        self.video.close()
+
+
+# worker : JPEG-encoded annotated frames of a chunk
+def _render_chunk(session_path:str, camera_id, begin:int, end:int, jpeg_quality:int, hold_s:float, rows:np.ndarray) -> list:
+    renderer = OverlayRenderer(session_path, camera_id, hold_s, rows)
+    params = [int(cv2.IMWRITE_JPEG_QUALITY), jpeg_quality]
+    encoded = []
+    for _, image in renderer.frames(begin, end):
+        ok, data = cv2.imencode(".jpg", image, params)
+        if ok:
+            encoded.append(data.tobytes())
+    renderer.close()
+    return encoded
+
+
+# render the annotated video of a camera (time range optional) with chunks rendered in parallel, returns output paths
+def render_video(session_path:pathlib.Path, camera_id, out_path:pathlib.Path=None, t_begin=None, t_end=None, clock:str="wall",
+                 workers:int=None, chunk_frames:int=RENDER_CHUNK_FRAMES, jpeg_quality:int=RENDER_JPEG_QUALITY,
+                 hold_s:float=RENDER_HOLD_S) -> list:
+    session_path = pathlib.Path(session_path)
+    out_path = pathlib.Path(out_path) if out_path is not None else session_path / RENDER_FILE_PATTERN.format(camera_id)
+    renderer = OverlayRenderer(session_path, camera_id, hold_s)
+    begin, end = renderer.frame_range(t_begin, t_end, clock)
+    capture = cv2.VideoCapture(str(renderer.video.video_path))
+    fps = capture.get(cv2.CAP_PROP_FPS) or 30.
+    size = (int(capture.get(cv2.CAP_PROP_FRAME_WIDTH)), int(capture.get(cv2.CAP_PROP_FRAME_HEIGHT)))
+    capture.release()
+    if end <= begin:
+        renderer.close()
+        raise ValueError(f"no frames of camera {camera_id} in the time range")
+
+    chunks = [(b, min(b+chunk_frames, end)) for b in range(begin, end, chunk_frames)]
+    chunk_rows = [renderer.rows_of(b, e) for b, e in chunks] # keypoint log is read once, workers get their part
+    renderer.close()
+    workers = max(1, workers if workers else (os.cpu_count() or 1))
+    outputs = [out_path]
+    writer = MjpegAviWriter(out_path, fps, size)
+    t_start = time.monotonic()
+    with ProcessPoolExecutor(max_workers=workers, mp_context=mp.get_context("spawn")) as executor:
+        pending = deque()
+        next_chunk = 0
+        while next_chunk < len(chunks) or pending:
+            # bounded number of chunks in flight (rendered frames are kept in memory until written in order)
+            while next_chunk < len(chunks) and len(pending) < workers*2:
+                b, e = chunks[next_chunk]
+                pending.append(executor.submit(_render_chunk, str(session_path), camera_id, b, e, jpeg_quality, hold_s, chunk_rows[next_chunk]))
+                next_chunk += 1
+            for jpeg in pending.popleft().result():
+                if writer.tell() >= AVI_MAX_BYTES:
+                    writer.close()
+                    outputs.append(out_path.with_name(f"{out_path.stem}_{len(outputs)}{out_path.suffix}"))
+                    writer = MjpegAviWriter(outputs[-1], fps, size)
+                writer.write(jpeg)
+    writer.close()
+    elapsed = time.monotonic()-t_start
+    print(f"[Info] camera {camera_id} : {end-begin} frames rendered in {elapsed:.2f} s ({(end-begin)/max(elapsed, 1e-9):.1f} fps, "
+          f"{workers} worker(s)) -> {', '.join(str(p) for p in outputs)}")
+    return outputs
+
+
+def _parse_time(text:str, mono:bool):
+    if text is None:
+        return None
+    return float(text) if mono else datetime.strptime(text, "%Y-%m-%d %H:%M:%S.%f")
+
+
+'''
+Entry point
+'''
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Render annotated videos of a recorded session")
+    parser.add_argument('session', help="session directory (e.g. data/<session>)")
+    parser.add_argument('--camera', nargs='*', default=None, help="camera id(s) (default : every camera of the session)")
+    parser.add_argument('--begin', default=None, help="start time (YYYY-mm-dd HH:MM:SS.fff, or monotonic seconds with --mono)")
+    parser.add_argument('--end', default=None, help="end time (exclusive)")
+    parser.add_argument('--mono', action='store_true', help="times are monotonic timestamps (sec)")
+    parser.add_argument('--workers', type=int, default=None, help="parallel render processes (default : cpu count)")
+    parser.add_argument('--chunk', type=int, default=RENDER_CHUNK_FRAMES, help="frames per work item")
+    parser.add_argument('--quality', type=int, default=RENDER_JPEG_QUALITY, help="JPEG quality of the rendered frames")
+    parser.add_argument('--out', default=None, help="output file (single camera only)")
+    args = parser.parse_args()
+
+    cameras = args.camera if args.camera else session_cameras(args.session)
+    if args.out and len(cameras) > 1:
+        parser.error("--out requires a single camera")
+    for camera_id in cameras:
+        render_video(args.session, camera_id, args.out, _parse_time(args.begin, args.mono), _parse_time(args.end, args.mono),
+                     "mono" if args.mono else "wall", args.workers, args.chunk, args.quality)
@@ -0,0 +1,93 @@
+'''
+Dynamic region of interest for pose inference (crop around the previous person bbox)
+@author bh.hwang@iae.re.kr
+'''
+
+import numpy as np
+
+# pre-defined options
+ROI_MODE_OFF = "off"            # full frame inference
+ROI_MODE_DYNAMIC = "dynamic"    # expanded region around the last bbox
+ROI_MODE_STATIC = "static"      # fixed cabin region
+ROI_MODES = (ROI_MODE_OFF, ROI_MODE_DYNAMIC, ROI_MODE_STATIC)
+ROI_MARGIN = 0.25 # expansion of the last bbox (fraction of its width/height on each side)
+ROI_MIN_SIZE = 320 # min. width/height of the region (px)
+ROI_ALIGN = 32 # region size is aligned to the model stride
+ROI_LOST_FRAMES = 1 # consecutive frames without detection before falling back to the full search region
+
+
+'''
+selects the inference region of the next frame
+'''
+class RoiSelector:
+    def __init__(self, mode:str=ROI_MODE_OFF, static_roi:list=None, margin:float=ROI_MARGIN, min_size:int=ROI_MIN_SIZE, lost_frames:int=ROI_LOST_FRAMES):
+        if mode not in ROI_MODES:
+            raise ValueError(f"unknown roi mode : {mode} (one of {ROI_MODES})")
+        if mode == ROI_MODE_STATIC and static_roi is None:
+            raise ValueError("static roi mode requires a region [x1, y1, x2, y2]")
+
+        self.mode = mode
+        self.static_roi = tuple(int(v) for v in static_roi) if static_roi is not None else None
+        self.margin = margin
+        self.min_size = min_size
+        self.lost_frames = lost_frames
+        self.last_bbox = None # union bbox of the last detection (full frame coordinates)
+        self.missed = 0
+
+        # counters
+        self.roi_frames = 0
+        self.full_frames = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.mode != ROI_MODE_OFF
+
+    # region (x1, y1, x2, y2) for a frame of shape (h, w, ...), None means full frame
+    def select(self, shape) -> tuple:
+        h, w = shape[:2]
+        region = None
+        if self.mode == ROI_MODE_DYNAMIC and self.last_bbox is not None and self.missed < self.lost_frames:
+            region = self._expand(self.last_bbox, w, h)
+        elif self.static_roi is not None and self.mode != ROI_MODE_OFF:
+            region = self._clamp(self.static_roi, w, h) # static region is also the fallback search region
+
+        if region is None or (region[2]-region[0] >= w and region[3]-region[1] >= h):
+            self.full_frames += 1
+            return None
+        self.roi_frames += 1
+        return region
+
+    # update with the pose of this frame (full frame coordinates)
+    def update(self, pose):
+        if len(pose) == 0:
+            self.missed += 1
+            if self.missed >= self.lost_frames:
+                self.last_bbox = None
+            return
+        self.missed = 0
+        boxes = pose.boxes
+        self.last_bbox = (float(boxes[:, 0].min()), float(boxes[:, 1].min()), float(boxes[:, 2].max()), float(boxes[:, 3].max()))
+
+    # expanded and aligned region around bbox
+    def _expand(self, bbox, w:int, h:int) -> tuple:
+        x1, y1, x2, y2 = bbox
+        bw, bh = x2-x1, y2-y1
+        x1, x2 = x1-bw*self.margin, x2+bw*self.margin
+        y1, y2 = y1-bh*self.margin, y2+bh*self.margin
+
+        # min. size and stride alignment around the center
+        cx, cy = (x1+x2)/2., (y1+y2)/2.
+        rw = min(w, _align(max(x2-x1, self.min_size)))
+        rh = min(h, _align(max(y2-y1, self.min_size)))
+        x1 = int(min(max(cx-rw/2., 0), w-rw))
+        y1 = int(min(max(cy-rh/2., 0), h-rh))
+        return (x1, y1, x1+rw, y1+rh)
+
+    def _clamp(self, region, w:int, h:int) -> tuple:
+        x1, y1, x2, y2 = region
+        return (max(0, x1), max(0, y1), min(w, x2), min(h, y2))
+
+
+# round up to ROI_ALIGN
+def _align(size:float) -> int:
+    return int(np.ceil(size/ROI_ALIGN))*ROI_ALIGN
@@ -0,0 +1,351 @@
+'''
+Headless camera service (no widgets, controlled over the MQTT message API)
+@author bh.hwang@iae.re.kr
+'''
+
+import json
+import signal
+import sys
+import time
+from datetime import datetime
+from PyQt6.QtCore import QCoreApplication, QObject, QTimer, Qt, pyqtSignal
+from camera import CameraController, CameraOpener, DATA_OUT_DIR
+from session import RecordingSession, remove_stale_sessions
+from worker import CameraWorkerProcess
+from inference import create_engine
+from machine import MachineMonitor
+from governor import QualityGovernor
+from metrics import StartupTimer
+from telemetry import create_streamer
+from messaging import create_mqtt_client, TOPIC_MANAGER, TOPIC_REQUEST_ACTIVE, TOPIC_RECORD_START, TOPIC_RECORD_STOP, TOPIC_CAPTURE, \
+                      TOPIC_REQUEST_STATUS, TOPIC_REQUEST_METRICS, TOPIC_STATUS, TOPIC_METRICS, MQTT_PORT, MQTT_KEEPALIVE
+
+# pre-defined options
+APP_NAME = "avsim-cam"
+STATUS_INTERVAL_S = 5 # health and throughput publish interval
+METRICS_INTERVAL_S = 5
+STALE_FRAME_S = 2.0 # camera is unhealthy if no frame was processed for this time
+THROUGHPUT_MIN_WINDOW_S = 0.5 # min. window of the throughput measurement
+
+
+'''
+processed frame counter of a camera (called from the camera thread)
+'''
+class _ThroughputCounter:
+    def __init__(self):
+        self.frames = 0
+        self.last_output = None # time.monotonic of the last processed frame
+        self.last_frames = 0
+        self.last_sample = time.monotonic()
+        self.fps = 0.
+
+    def on_output(self, index:int, t_grab:float):
+        self.frames += 1
+        self.last_output = time.monotonic()
+
+    # processed frames per second since the previous sample (kept for requests in quick succession)
+    def sample(self) -> float:
+        now = time.monotonic()
+        if now-self.last_sample >= THROUGHPUT_MIN_WINDOW_S:
+            frames = self.frames
+            self.fps = (frames-self.last_frames)/(now-self.last_sample)
+            self.last_frames = frames
+            self.last_sample = now
+        return self.fps
+
+
+'''
+camera service without GUI
+'''
+class CameraService(QObject):
+    mapi_message_slot = pyqtSignal(str, dict) # message api call (emitted from the mqtt client thread, handled on the Qt thread)
+
+    def __init__(self, broker_ip_address:str, config:dict, client=None, startup:StartupTimer=None):
+        super().__init__()
+
+        self.configure_param = dict(config, preview_enabled=False) # nothing to display
+        self.startup = startup if startup is not None else StartupTimer()
+        self.broker_ip_address = broker_ip_address
+        self.opened_camera = {}
+        self.opening_camera = {}
+        self.throughput = {} # camera id -> _ThroughputCounter
+        self.camera_opener = None
+        self.hpe_engine = None
+        self.is_recording = False
+        self.data_root = self.configure_param.get("data_out_dir", DATA_OUT_DIR)
+        self.session = None # recording session (shared by every camera)
+        self.next_session = None # pre-allocated session, writers are opened ahead of the trigger
+        self.resources = {}
+        self.message_api = {
+            TOPIC_RECORD_START : self.mapi_record_start,
+            TOPIC_RECORD_STOP : self.mapi_record_stop,
+            TOPIC_CAPTURE : self.mapi_capture,
+            TOPIC_REQUEST_STATUS : self.mapi_request_status,
+            TOPIC_REQUEST_METRICS : self.mapi_request_metrics,
+            TOPIC_REQUEST_ACTIVE : self.mapi_notify_active
+        }
+
+        # for mqtt connection (a broker stand-in client can be given)
+        self.mq_client = client if client is not None else create_mqtt_client(APP_NAME, broker_ip_address)
+        self.mq_client.on_connect = self.on_mqtt_connect
+        self.mq_client.on_message = self.on_mqtt_message
+        self.mq_client.on_disconnect = self.on_mqtt_disconnect
+        self.mapi_message_slot.connect(self.on_mapi_message, Qt.ConnectionType.QueuedConnection)
+        self.keypoint_streamer = create_streamer(self.mq_client, self.configure_param)
+
+        # for machine resource monitoring and load-adaptive quality
+        self.machine_monitor = MachineMonitor(1000)
+        self.machine_monitor.resource_monitor_slot.connect(self.resource_monitor_update)
+        self.governor = None
+        if self.configure_param.get("governor_enabled", False):
+            self.governor = QualityGovernor(bounds=self.configure_param.get("governor_bounds", None))
+
+        # periodic status and metrics
+        self.status_timer = QTimer(self)
+        self.status_timer.timeout.connect(self.publish_status)
+        self.metrics_timer = QTimer(self)
+        self.metrics_timer.timeout.connect(self.publish_metrics)
+
+    # connect to the broker and open every camera (in background)
+    def start(self):
+        self.mq_client.connect_async(self.broker_ip_address, port=MQTT_PORT, keepalive=MQTT_KEEPALIVE)
+        self.mq_client.loop_start()
+        if self.keypoint_streamer is not None:
+            self.keypoint_streamer.start()
+        self.machine_monitor.start()
+        remove_stale_sessions(self.data_root)
+
+        use_process = self.configure_param.get("camera_process", False)
+        if not use_process:
+            self.hpe_engine = create_engine(self.configure_param, self.configure_param.get("inference_batch_size", len(self.configure_param["camera_ids"])))
+            self.hpe_engine.ready_slot.connect(self.on_engine_ready)
+            self.hpe_engine.start()
+
+        camera_class = CameraWorkerProcess if use_process else CameraController
+        for id in self.configure_param["camera_ids"]:
+            self.opening_camera[id] = camera_class(id, engine=self.hpe_engine, config=self.configure_param)
+        self.camera_opener = CameraOpener(list(self.opening_camera.values()))
+        self.camera_opener.camera_opened_slot.connect(self.on_camera_opened)
+        self.camera_opener.start()
+
+        self.status_timer.start(int(self.configure_param.get("status_interval_s", STATUS_INTERVAL_S)*1000))
+        self.metrics_timer.start(int(self.configure_param.get("metrics_interval_s", METRICS_INTERVAL_S)*1000))
+
+    def on_camera_opened(self, id, success:bool, elapsed:float):
+        camera = self.opening_camera.pop(id, None)
+        if camera is None:
+            return
+        if not success:
+            print(f"[Warning] camera {id} is not connected ({elapsed:.2f} s)")
+            return
+        self.startup.mark(f"camera {id} opened")
+        counter = _ThroughputCounter()
+        camera.frame_output_slot.connect(counter.on_output, Qt.ConnectionType.DirectConnection) # counted in the camera thread
+        self.throughput[id] = counter
+        self.opened_camera[id] = camera
+        camera.keypoint_streamer = self.keypoint_streamer
+        camera.begin()
+        if self.is_recording:
+            camera.start_recording(self.session.path, self.session.t_start, self.session.t_start_wall) # requested while the camera was opening
+        else:
+            camera.prepare_recording(self.prepare_session().path)
+
+    def on_engine_ready(self, success:bool, elapsed:float):
+        if success:
+            self.startup.mark("pose model ready")
+        else:
+            print("[Warning] pose model loading failed (running without keypoints)")
+
+    # pre-allocated session of the next record trigger
+    def prepare_session(self) -> RecordingSession:
+        if self.next_session is None:
+            self.next_session = RecordingSession(self.data_root)
+        return self.next_session
+
+    # internal api for starting record (one session and one start timestamp for every camera)
+    def _api_record_start(self):
+        if self.is_recording:
+            return
+        self.session = self.prepare_session()
+        self.next_session = None
+        self.session.start(list(self.opened_camera.keys()))
+        self.is_recording = True
+        for camera in list(self.opened_camera.values()):
+            camera.start_recording(self.session.path, self.session.t_start, self.session.t_start_wall)
+        print(f"Recording start...({self.session})")
+        self.publish_status()
+
+    # internal api for stopping record (writers of the next session are opened right away)
+    def _api_record_stop(self):
+        if not self.is_recording:
+            return
+        self.is_recording = False
+        for camera in list(self.opened_camera.values()):
+            camera.stop_recording()
+        print(f"Recording stop...({self.session})")
+        self.session = None
+        for camera in list(self.opened_camera.values()):
+            camera.prepare_recording(self.prepare_session().path)
+        self.publish_status()
+
+    def mapi_record_start(self, payload):
+        self._api_record_start()
+
+    def mapi_record_stop(self, payload):
+        self._api_record_stop()
+
+    # mapi : capture image of every camera (after delay sec)
+    def mapi_capture(self, payload):
+        try:
+            delay = float(payload.get("delay", 0))
+        except (ValueError, TypeError):
+            print(f"[Warning] capture delay must be a number : {payload.get('delay')}")
+            return
+        for camera in list(self.opened_camera.values()):
+            camera.start_capturing(delay)
+
+    def mapi_request_status(self, payload):
+        self.publish_status()
+
+    def mapi_request_metrics(self, payload):
+        self.publish_metrics()
+
+    # notification
+    def mapi_notify_active(self, payload=None):
+        if self.mq_client.is_connected():
+            msg = {"app":APP_NAME, "active":True}
+            self.mq_client.publish(TOPIC_MANAGER, json.dumps(msg), 0)
+
+    # health and throughput of every camera
+    def status_report(self) -> dict:
+        now = time.monotonic()
+        cameras = {}
+        for id in self.configure_param["camera_ids"]:
+            camera = self.opened_camera.get(id)
+            if camera is None:
+                cameras[str(id)] = {"connected":False, "opening":id in self.opening_camera, "healthy":False}
+                continue
+            counter = self.throughput[id]
+            age = now-counter.last_output if counter.last_output is not None else None
+            running = camera.isRunning()
+            load = camera.load_stats()
+            cameras[str(id)] = {"connected":True, "running":running, "recording":self.is_recording,
+                                "fps":round(counter.sample(), 2), "frames":counter.frames, "dropped":load["dropped"],
+                                "writer_fill":round(load["writer_fill"], 3),
+                                "last_frame_age":round(age, 3) if age is not None else None,
+                                "healthy":running and age is not None and age < STALE_FRAME_S}
+        status = {"app":APP_NAME, "timestamp":datetime.now().isoformat(), "recording":self.is_recording,
+                  "session":self.session.name if self.session is not None else None, "cameras":cameras,
+                  "pose_model_ready":self.hpe_engine.is_ready if self.hpe_engine is not None else None}
+        if self.resources:
+            status["machine"] = {key:self.resources.get(key) for key in ("cpu_usage", "memory_usage", "gpu_usage", "gpu_memory_usage")}
+        if self.keypoint_streamer is not None:
+            stream = self.keypoint_streamer.stats()
+            status["keypoint_stream"] = {key:stream[key] for key in ("messages", "dropped_frames", "failed_messages")}
+            status["keypoint_stream"]["latency_ms_p95"] = stream["latency_ms"].get("p95")
+        return status
+
+    # pipeline metrics report of every camera
+    def metrics_report(self) -> dict:
+        report = {"app":APP_NAME, "timestamp":datetime.now().isoformat(), "cameras":{}}
+        for id, camera in list(self.opened_camera.items()):
+            report["cameras"][str(id)] = camera.report()
+        if self.governor is not None:
+            report["quality_levels"] = {str(id):level for id, level in self.governor.report().items()}
+        if self.resources:
+            report["machine"] = self.resources
+        if self.hpe_engine is not None:
+            report["inference"] = {"latency":self.hpe_engine.latency_stats(), "mean_batch_size":self.hpe_engine.mean_batch_size()}
+        if self.keypoint_streamer is not None:
+            report["keypoint_stream"] = self.keypoint_streamer.stats()
+        return report
+
+    def publish_status(self):
+        if self.mq_client.is_connected():
+            self.mq_client.publish(TOPIC_STATUS, json.dumps(self.status_report()), 0)
+
+    def publish_metrics(self):
+        if self.mq_client.is_connected():
+            self.mq_client.publish(TOPIC_METRICS, json.dumps(self.metrics_report()), 0)
+
+    # machine resource update (quality governor)
+    def resource_monitor_update(self, status:dict):
+        self.resources = status
+        if self.governor is None or not self.opened_camera:
+            return
+        loads = {id:camera.load_stats() for id, camera in self.opened_camera.items()}
+        engine_queue = self.hpe_engine.queue_depth() if self.hpe_engine is not None else 0
+        for id, settings in self.governor.update(status, loads, engine_queue).items():
+            print(f"[Info] camera {id} quality level {self.governor.levels[id]} : {settings}")
+            self.opened_camera[id].set_quality(**settings)
+
+    # mqtt connection callback function
+    def on_mqtt_connect(self, mqttc, obj, flags, rc):
+        self.mapi_notify_active()
+        for topic in self.message_api.keys():
+            self.mq_client.subscribe(topic, 0)
+        print(f"[Info] connected to broker ({rc})")
+
+    def on_mqtt_disconnect(self, mqttc, userdata, rc):
+        print(f"[Info] disconnected from broker ({rc})")
+
+    # mqtt message receive callback function (called from the mqtt client thread, the api runs on the Qt thread)
+    def on_mqtt_message(self, mqttc, userdata, msg):
+        mapi = str(msg.topic)
+        try:
+            if mapi in self.message_api.keys():
+                payload = json.loads(msg.payload)
+                if not isinstance(payload, dict) or "app" not in payload:
+                    print("Message payload does not contain the app")
+                    return
+                if payload["app"] != APP_NAME:
+                    self.mapi_message_slot.emit(mapi, payload)
+            else:
+                print("Unknown MAPI was called : {}".format(mapi))
+        except json.JSONDecodeError as e:
+            print("MAPI message payload connot be converted : {}".format(str(e)))
+
+    # message api call on the Qt thread (recording state is changed by this thread only)
+    def on_mapi_message(self, mapi:str, payload:dict):
+        try:
+            self.message_api[mapi](payload)
+        except (ValueError, TypeError) as e:
+            print(f"[Warning] MAPI {mapi} payload is invalid : {e}")
+
+    # stop every camera (recordings are flushed) and the broker connection
+    def close(self):
+        self.status_timer.stop()
+        self.metrics_timer.stop()
+        if self.camera_opener is not None:
+            self.camera_opener.wait() # device opening can not be interrupted
+        for camera in list(self.opened_camera.values()) + list(self.opening_camera.values()):
+            camera.close()
+        if self.next_session is not None:
+            self.next_session.discard()
+        if self.hpe_engine is not None:
+            self.hpe_engine.close()
+        if self.keypoint_streamer is not None:
+            self.keypoint_streamer.close()
+        self.machine_monitor.close()
+        if self.configure_param.get("startup_log", None):
+            self.startup.save(self.configure_param["startup_log"])
+        self.mq_client.disconnect()
+        self.mq_client.loop_stop()
+
+
+# run the headless service until SIGINT/SIGTERM
+def run_service(broker_ip_address:str, config:dict, startup:StartupTimer=None) -> int:
+    app = QCoreApplication.instance() or QCoreApplication(sys.argv)
+    service = CameraService(broker_ip_address, config, startup=startup)
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(sig, lambda *args: app.quit())
+    wakeup = QTimer() # python signal handlers run only while the interpreter is active
+    wakeup.timeout.connect(lambda: None)
+    wakeup.start(200)
+
+    service.start()
+    if startup is not None:
+        startup.mark("service started")
+    code = app.exec()
+    service.close()
+    return code
@@ -0,0 +1,90 @@
+'''
+Recording session shared by every camera (pre-allocated directory, common start timestamp)
+@author bh.hwang@iae.re.kr
+'''
+
+import itertools
+import json
+import os
+import pathlib
+import shutil
+import time
+from datetime import datetime
+
+# pre-defined options
+PENDING_PREFIX = ".pending-" # pre-allocated session directory (renamed on the record trigger)
+SESSION_NAME_FORMAT = "%Y-%m-%d-%H-%M-%S"
+SESSION_FILE = "session.json"
+
+_pending_seq = itertools.count()
+
+
+'''
+recording session (the directory is created ahead of the trigger so that the camera writers can be opened in advance)
+'''
+class RecordingSession:
+    def __init__(self, data_root:pathlib.Path):
+        self.data_root = pathlib.Path(data_root)
+        self.path = self.data_root / f"{PENDING_PREFIX}{os.getpid()}-{next(_pending_seq)}"
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.name = None
+        self.t_start = None # time.monotonic (system-wide) of the trigger, frames grabbed from then on are recorded
+        self.t_start_wall = None
+
+    @property
+    def is_started(self) -> bool:
+        return self.t_start is not None
+
+    # take the common start timestamp and give the session its final name (returns the session directory)
+    def start(self, camera_ids:list=()) -> pathlib.Path:
+        if self.is_started:
+            return self.path
+        self.t_start = time.monotonic()
+        self.t_start_wall = time.time()
+
+        name = datetime.fromtimestamp(self.t_start_wall).strftime(SESSION_NAME_FORMAT)
+        target = self.data_root / name
+        for suffix in itertools.count(1):
+            if not target.exists():
+                break
+            target = self.data_root / f"{name}-{suffix}" # triggered twice within a second
+        self.path.rename(target) # files opened in the pending directory stay valid
+        self.path = target
+        self.name = target.name
+
+        info = {"name":self.name, "t_start_mono":self.t_start, "t_start_wall":self.t_start_wall,
+                "t_start":datetime.fromtimestamp(self.t_start_wall).isoformat(), "cameras":[str(id) for id in camera_ids]}
+        (self.path / SESSION_FILE).write_text(json.dumps(info, indent=2))
+        return self.path
+
+    # remove the directory of a session that was never started
+    def discard(self):
+        if not self.is_started:
+            shutil.rmtree(self.path, ignore_errors=True)
+
+    def __str__(self):
+        return self.name if self.is_started else str(self.path)
+
+
+# remove pending directories left by processes that are not running anymore
+def remove_stale_sessions(data_root:pathlib.Path):
+    data_root = pathlib.Path(data_root)
+    if not data_root.is_dir():
+        return
+    for path in data_root.glob(f"{PENDING_PREFIX}*"):
+        try:
+            pid = int(path.name[len(PENDING_PREFIX):].split("-")[0])
+        except ValueError:
+            continue
+        if pid != os.getpid() and not _is_running(pid):
+            shutil.rmtree(path, ignore_errors=True)
+
+
+def _is_running(pid:int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
@@ -0,0 +1,274 @@
+'''
+Frame sources for the camera controller (V4L2 device, video file, synthetic frames)
+@author bh.hwang@iae.re.kr
+'''
+
+import pathlib
+import time
+import cv2
+import numpy as np
+
+# pre-defined options
+SYNTHETIC_WIDTH = 1920
+SYNTHETIC_HEIGHT = 1080
+SYNTHETIC_FPS = 30
+SYNTHETIC_PATTERNS = 30 # number of pre-generated frames cycled by the synthetic source
+
+
+'''
+frame source interface (subset of cv2.VideoCapture used by the controller)
+'''
+class FrameSource:
+    def open(self) -> bool:
+        raise NotImplementedError
+
+    def isOpened(self) -> bool:
+        raise NotImplementedError
+
+    # returns (success, BGR frame)
+    def read(self):
+        raise NotImplementedError
+
+    def get(self, prop:int) -> float:
+        return 0.
+
+    def set(self, prop:int, value) -> bool:
+        return False
+
+    # True if the source will never deliver a frame again (end of file)
+    def is_exhausted(self) -> bool:
+        return False
+
+    # delivered format {"fourcc", "width", "height", "fps"} (fourcc None if unknown)
+    def format(self) -> dict:
+        return {"fourcc":decode_fourcc(self.get(cv2.CAP_PROP_FOURCC)), "width":int(self.get(cv2.CAP_PROP_FRAME_WIDTH)),
+                "height":int(self.get(cv2.CAP_PROP_FRAME_HEIGHT)), "fps":round(self.get(cv2.CAP_PROP_FPS), 3)}
+
+    def release(self):
+        pass
+
+
+'''
+V4L2 camera device (pixel format, resolution and frame rate are negotiated at open, None keeps the driver default)
+'''
+class V4L2Source(FrameSource):
+    def __init__(self, device_id:int, fourcc:str=None, width:int=None, height:int=None, fps:float=None):
+        self.device_id = device_id
+        self.requested = {"fourcc":fourcc, "width":width, "height":height, "fps":fps}
+        self.capture = None
+
+    def open(self) -> bool:
+        self.capture = cv2.VideoCapture(self.device_id, cv2.CAP_V4L2) # video capture instance with opencv
+        if not self.capture.isOpened():
+            return False
+        # the driver picks the nearest supported mode, pixel format first (it limits the available sizes and rates)
+        fourcc, width, height, fps = (self.requested[key] for key in ("fourcc", "width", "height", "fps"))
+        if fourcc is not None:
+            self.capture.set(cv2.CAP_PROP_FOURCC, cv2.VideoWriter_fourcc(*fourcc))
+        if width is not None:
+            self.capture.set(cv2.CAP_PROP_FRAME_WIDTH, width)
+        if height is not None:
+            self.capture.set(cv2.CAP_PROP_FRAME_HEIGHT, height)
+        if fps is not None:
+            self.capture.set(cv2.CAP_PROP_FPS, fps)
+        return True
+
+    def isOpened(self) -> bool:
+        return self.capture is not None and self.capture.isOpened()
+
+    def read(self):
+        return self.capture.read()
+
+    def get(self, prop:int) -> float:
+        return self.capture.get(prop)
+
+    def set(self, prop:int, value) -> bool:
+        return self.capture.set(prop, value)
+
+    def release(self):
+        if self.capture is not None:
+            self.capture.release()
+
+    def __str__(self):
+        return f"v4l2:{self.device_id}"
+
+
+'''
+video file played at native rate (realtime) or as fast as possible
+'''
+class VideoFileSource(FrameSource):
+    def __init__(self, path:str, realtime:bool=True, loop:bool=False):
+        self.path = pathlib.Path(path)
+        self.realtime = realtime
+        self.loop = loop
+        self.capture = None
+        self.frame_interval = 0.
+        self.next_time = 0.
+        self.exhausted = False
+
+    def open(self) -> bool:
+        self.capture = cv2.VideoCapture(str(self.path))
+        if not self.capture.isOpened():
+            return False
+        fps = self.capture.get(cv2.CAP_PROP_FPS)
+        self.frame_interval = 1./fps if fps > 0 else 1./SYNTHETIC_FPS
+        self.next_time = time.monotonic()
+        self.exhausted = False
+        return True
+
+    def isOpened(self) -> bool:
+        return self.capture is not None and self.capture.isOpened()
+
+    def read(self):
+        if self.realtime:
+            delay = self.next_time - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            self.next_time = max(self.next_time + self.frame_interval, time.monotonic() - self.frame_interval)
+
+        ret, frame = self.capture.read()
+        if not ret and self.loop:
+            self.capture.set(cv2.CAP_PROP_POS_FRAMES, 0)
+            ret, frame = self.capture.read()
+        if not ret:
+            self.exhausted = True
+        return ret, frame
+
+    def get(self, prop:int) -> float:
+        return self.capture.get(prop)
+
+    def is_exhausted(self) -> bool:
+        return self.exhausted
+
+    def release(self):
+        if self.capture is not None:
+            self.capture.release()
+
+    def __str__(self):
+        return f"file:{self.path}"
+
+
+'''
+synthetic frames (moving pattern, no device required)
+'''
+class SyntheticSource(FrameSource):
+    def __init__(self, width:int=SYNTHETIC_WIDTH, height:int=SYNTHETIC_HEIGHT, fps:float=SYNTHETIC_FPS, realtime:bool=True, max_frames:int=0):
+        self.width = width
+        self.height = height
+        self.fps = fps
+        self.realtime = realtime
+        self.max_frames = max_frames # 0 means endless
+        self.patterns = []
+        self.count = 0
+        self.next_time = 0.
+        self.opened = False
+
+    def open(self) -> bool:
+        # pre-generate frames so that reading costs only a copy
+        gradient = np.linspace(0, 255, self.width, dtype=np.float32)
+        for i in range(SYNTHETIC_PATTERNS):
+            frame = np.empty((self.height, self.width, 3), dtype=np.uint8)
+            frame[:, :, 0] = np.roll(gradient, i*self.width//SYNTHETIC_PATTERNS).astype(np.uint8)
+            frame[:, :, 1] = 64
+            frame[:, :, 2] = 255-frame[:, :, 0]
+            cx = int(self.width*(0.3+0.4*i/SYNTHETIC_PATTERNS))
+            cv2.circle(frame, (cx, self.height//2), self.height//8, (255, 255, 255), -1)
+            self.patterns.append(frame)
+        self.count = 0
+        self.next_time = time.monotonic()
+        self.opened = True
+        return True
+
+    def isOpened(self) -> bool:
+        return self.opened
+
+    def read(self):
+        if self.is_exhausted():
+            return False, None
+        if self.realtime:
+            delay = self.next_time - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            self.next_time = max(self.next_time + 1./self.fps, time.monotonic() - 1./self.fps)
+
+        frame = self.patterns[self.count % len(self.patterns)].copy()
+        self.count += 1
+        return True, frame
+
+    def get(self, prop:int) -> float:
+        if prop == cv2.CAP_PROP_FRAME_WIDTH:
+            return float(self.width)
+        if prop == cv2.CAP_PROP_FRAME_HEIGHT:
+            return float(self.height)
+        if prop == cv2.CAP_PROP_FPS:
+            return float(self.fps)
+        if prop == cv2.CAP_PROP_FRAME_COUNT:
+            return float(self.max_frames)
+        return 0.
+
+    def is_exhausted(self) -> bool:
+        return self.max_frames > 0 and self.count >= self.max_frames
+
+    def release(self):
+        self.patterns = []
+        self.opened = False
+
+    def __str__(self):
+        return f"synthetic:{self.width}x{self.height}@{self.fps}"
+
+
+# create frame source from spec
+#  - 0 or "v4l2:0" : V4L2 device
+#  - "file:<path>" : video file (realtime=False plays unthrottled)
+#  - "synthetic:<w>x<h>@<fps>" : synthetic frames
+def create_source(spec, realtime:bool=True, loop:bool=False, max_frames:int=0, capture:dict=None) -> FrameSource:
+    if isinstance(spec, FrameSource):
+        return spec
+    capture = capture or {} # requested V4L2 format (camera profile)
+    if isinstance(spec, int):
+        return V4L2Source(spec, **capture)
+
+    spec = str(spec)
+    kind, _, arg = spec.partition(":")
+    if kind == "v4l2":
+        return V4L2Source(int(arg), **capture)
+    if kind == "file":
+        return VideoFileSource(arg, realtime=realtime, loop=loop)
+    if kind == "synthetic":
+        width, height, fps = SYNTHETIC_WIDTH, SYNTHETIC_HEIGHT, SYNTHETIC_FPS
+        if arg:
+            size, _, rate = arg.partition("@")
+            width, height = (int(v) for v in size.split("x"))
+            if rate:
+                fps = float(rate)
+        return SyntheticSource(width, height, fps, realtime=realtime, max_frames=max_frames)
+    if spec.isdigit():
+        return V4L2Source(int(spec), **capture)
+    raise ValueError(f"unknown frame source : {spec}")
+
+
+# fourcc code from the OpenCV property value (None if unknown)
+def decode_fourcc(value:float):
+    code = int(value)
+    if code <= 0:
+        return None
+    text = "".join(chr((code >> 8*i) & 0xFF) for i in range(4))
+    return text if text.isprintable() else None
+
+
+# requested format values the source did not deliver, {key:(requested, negotiated)}
+def format_mismatch(requested:dict, negotiated:dict) -> dict:
+    mismatch = {}
+    for key, value in requested.items():
+        if value is None:
+            continue
+        delivered = negotiated.get(key)
+        same = abs(float(value)-float(delivered or 0)) < 0.5 if key == "fps" else str(value) == str(delivered)
+        if not same:
+            mismatch[key] = (value, delivered)
+    return mismatch
+
+
+# one line format text (e.g. MJPG 1920x1080@30)
+def format_text(fmt:dict) -> str:
+    return f"{fmt.get('fourcc') or '----'} {fmt.get('width')}x{fmt.get('height')}@{fmt.get('fps'):g}"
@@ -0,0 +1,223 @@
+'''
+Real-time keypoint telemetry over MQTT (quantized binary encoding, coalescing, rate limiting, non-blocking publishing)
+@author bh.hwang@iae.re.kr
+'''
+
+import struct
+import threading
+import time
+from collections import deque
+import numpy as np
+import paho.mqtt.client as mqtt
+from PyQt6.QtCore import QThread
+from inference import PoseResult, NUM_KEYPOINTS
+from metrics import LatencyHistogram
+from messaging import TOPIC_KEYPOINTS
+
+# pre-defined options
+STREAM_COALESCE = 1 # frames per message
+STREAM_MAX_RATE = 30. # max. messages per second per camera (0 means unlimited)
+STREAM_MAX_DELAY_MS = 100. # a partial batch is sent at the latest after this delay
+STREAM_MAX_INFLIGHT = 16 # messages handed to the client but not written to the socket yet (more are dropped)
+STREAM_INFLIGHT_TIMEOUT = 5.0 # sec, a message not written until then is given up (e.g. lost by a disconnection)
+STREAM_POLL_MS = 5 # publisher thread period (also the resolution of the publish latency)
+STREAM_BURST = 2 # messages per camera that may be sent back to back (rate limit tolerates frame timing jitter)
+
+# message layout (little endian)
+#  header : magic "KP", version u8, frame count u8
+#  frame  : frame index u32, t_wall (usec since epoch) i64, flags u8, person count u8
+#  person : bbox x1,y1,x2,y2 u16 (1/4 px), bbox conf u8, 17 x (x u16, y u16 (1/4 px), conf u8)
+STREAM_MAGIC = b"KP"
+STREAM_VERSION = 1
+COORD_SCALE = 4. # quarter pixel precision, up to 16383 px
+CONF_SCALE = 255.
+_HEADER = struct.Struct("<2sBB")
+_FRAME = struct.Struct("<IqBB")
+PERSON_DTYPE = np.dtype([("bbox", "<u2", (4,)), ("bbox_conf", "u1"),
+                         ("keypoints", [("x", "<u2"), ("y", "<u2"), ("conf", "u1")], (NUM_KEYPOINTS,))])
+MAX_FRAMES = 255
+MAX_PERSONS = 255
+
+
+def _quantize_coord(values:np.ndarray) -> np.ndarray:
+    return np.clip(np.rint(values*COORD_SCALE), 0, 65535).astype(np.uint16)
+
+def _quantize_conf(values:np.ndarray) -> np.ndarray:
+    return np.clip(np.rint(values*CONF_SCALE), 0, 255).astype(np.uint8)
+
+
+# encode frames [(frame index, t_wall, flags, pose)] of a camera into one message
+def encode_keypoints(frames:list) -> bytes:
+    parts = [_HEADER.pack(STREAM_MAGIC, STREAM_VERSION, len(frames))]
+    for index, t_wall, flags, pose in frames[:MAX_FRAMES]:
+        n = min(len(pose), MAX_PERSONS)
+        parts.append(_FRAME.pack(index & 0xFFFFFFFF, int(t_wall*1e6), flags & 0xFF, n))
+        if n:
+            persons = np.empty(n, dtype=PERSON_DTYPE)
+            persons["bbox"] = _quantize_coord(pose.boxes[:n])
+            persons["bbox_conf"] = _quantize_conf(pose.box_conf[:n])
+            persons["keypoints"]["x"] = _quantize_coord(pose.keypoints[:n, :, 0])
+            persons["keypoints"]["y"] = _quantize_coord(pose.keypoints[:n, :, 1])
+            persons["keypoints"]["conf"] = _quantize_conf(pose.keypoint_conf[:n])
+            parts.append(persons.tobytes())
+    return b"".join(parts)
+
+
+# decode message into [(frame index, t_wall, flags, PoseResult)] (for the receiving side)
+def decode_keypoints(payload:bytes) -> list:
+    magic, version, count = _HEADER.unpack_from(payload, 0)
+    if magic != STREAM_MAGIC or version != STREAM_VERSION:
+        raise ValueError(f"unknown keypoint message (magic {magic}, version {version})")
+    frames = []
+    offset = _HEADER.size
+    for _ in range(count):
+        index, t_usec, flags, n = _FRAME.unpack_from(payload, offset)
+        offset += _FRAME.size
+        persons = np.frombuffer(payload, dtype=PERSON_DTYPE, count=n, offset=offset)
+        offset += n*PERSON_DTYPE.itemsize
+        keypoints = np.stack([persons["keypoints"]["x"], persons["keypoints"]["y"]], axis=-1).astype(np.float32)/COORD_SCALE
+        pose = PoseResult(keypoints.reshape(n, NUM_KEYPOINTS, 2),
+                          persons["keypoints"]["conf"].astype(np.float32).reshape(n, NUM_KEYPOINTS)/CONF_SCALE,
+                          persons["bbox"].astype(np.float32).reshape(n, 4)/COORD_SCALE,
+                          persons["bbox_conf"].astype(np.float32).reshape(n)/CONF_SCALE, {})
+        frames.append((index, t_usec/1e6, flags, pose))
+    return frames
+
+
+'''
+pending frames of a camera (oldest frames are dropped when the batch can not be sent in time)
+'''
+class _CameraStream:
+    def __init__(self, coalesce:int):
+        self.frames = deque(maxlen=coalesce)
+        self.coalesce = coalesce
+        self.tokens = STREAM_BURST # rate limit (token bucket, refilled at the max. rate)
+        self.last_refill = None
+        self.dropped = 0
+
+    def put(self, item:tuple):
+        if len(self.frames) == self.coalesce:
+            self.dropped += 1
+        self.frames.append(item)
+
+    # frames to send now (full batch or max. delay passed, within the rate limit)
+    def take(self, now:float, min_interval:float, max_delay:float) -> list:
+        if min_interval > 0:
+            elapsed = now-self.last_refill if self.last_refill is not None else STREAM_BURST*min_interval
+            self.tokens = min(STREAM_BURST, self.tokens+elapsed/min_interval)
+            self.last_refill = now
+        if not self.frames or (min_interval > 0 and self.tokens < 1.):
+            return []
+        if len(self.frames) < self.coalesce and now-self.frames[0][0] < max_delay:
+            return []
+        batch = list(self.frames)
+        self.frames.clear()
+        if min_interval > 0:
+            self.tokens -= 1.
+        return batch
+
+
+'''
+keypoint publisher thread (submit never blocks the camera thread)
+'''
+class KeypointStreamer(QThread):
+    def __init__(self, client, topic:str=TOPIC_KEYPOINTS, coalesce:int=STREAM_COALESCE, max_rate:float=STREAM_MAX_RATE,
+                 max_delay_ms:float=STREAM_MAX_DELAY_MS, max_inflight:int=STREAM_MAX_INFLIGHT):
+        super().__init__()
+        self.setObjectName("keypoint-stream")
+
+        if not 1 <= coalesce <= MAX_FRAMES:
+            raise ValueError(f"keypoint stream coalescing must be 1 to {MAX_FRAMES} frames")
+        self.client = client
+        self.topic = topic
+        self.coalesce = coalesce
+        self.min_interval = 1./max_rate if max_rate > 0 else 0.
+        self.max_delay = max_delay_ms/1000.
+        self.max_inflight = max_inflight
+        self._streams = {} # camera id -> _CameraStream
+        self._lock = threading.Lock()
+        self._inflight = deque() # (message info, submit time of the oldest frame)
+        self._latency = LatencyHistogram()
+
+        # counters
+        self.messages = 0   # messages written to the socket
+        self.frames = 0     # frames handed to the client
+        self.bytes = 0
+        self.failed = 0     # messages dropped (not connected, too many in flight, client error)
+        self.failed_frames = 0
+
+    # queue pose of a processed frame (called from the camera threads)
+    def submit(self, camera_id, frame_index:int, t_wall:float, flags:int, pose:PoseResult):
+        with self._lock:
+            stream = self._streams.get(camera_id)
+            if stream is None:
+                stream = self._streams[camera_id] = _CameraStream(self.coalesce)
+            stream.put((time.monotonic(), frame_index, t_wall, flags, pose))
+
+    def run(self):
+        while not self.isInterruptionRequested():
+            now = time.monotonic()
+            self._check_inflight(now)
+            with self._lock:
+                batches = [(camera_id, stream.take(now, self.min_interval, self.max_delay)) for camera_id, stream in self._streams.items()]
+            for camera_id, batch in batches:
+                if batch:
+                    self._publish(camera_id, batch)
+            QThread.msleep(STREAM_POLL_MS)
+
+    def _publish(self, camera_id, batch:list):
+        if not self.client.is_connected() or len(self._inflight) >= self.max_inflight:
+            self._fail(len(batch))
+            return
+        payload = encode_keypoints([item[1:] for item in batch])
+        try:
+            info = self.client.publish(f"{self.topic}/{camera_id}", payload, 0)
+        except Exception as e: # e.g. client queue is full
+            print(f"[Warning] keypoint publish failed : {e}")
+            self._fail(len(batch))
+            return
+        if info.rc != mqtt.MQTT_ERR_SUCCESS:
+            self._fail(len(batch))
+            return
+        self._inflight.append((info, batch[0][0]))
+        self.frames += len(batch)
+        self.bytes += len(payload)
+
+    def _fail(self, frames:int):
+        self.failed += 1
+        self.failed_frames += frames
+
+    # messages written to the socket (latency from submit of the oldest frame)
+    def _check_inflight(self, now:float):
+        while self._inflight:
+            info, t_submit = self._inflight[0]
+            if info.is_published():
+                self._latency.record(now-t_submit)
+                self.messages += 1
+            elif now-t_submit > STREAM_INFLIGHT_TIMEOUT:
+                self.failed += 1
+            else:
+                break
+            self._inflight.popleft()
+
+    # publish latency (ms) and drop counters
+    def stats(self) -> dict:
+        with self._lock:
+            dropped = sum(stream.dropped for stream in self._streams.values())
+        return {"messages":self.messages, "frames":self.frames, "bytes":self.bytes, "inflight":len(self._inflight),
+                "dropped_frames":dropped+self.failed_frames, "failed_messages":self.failed,
+                "latency_ms":self._latency.summary()}
+
+    def close(self):
+        self.requestInterruption()
+        self.quit()
+        self.wait(1000)
+
+
+# streamer from the application configuration (None if disabled)
+def create_streamer(client, config:dict):
+    if not config.get("keypoint_stream_enabled", False):
+        return None
+    return KeypointStreamer(client, coalesce=config.get("keypoint_stream_coalesce", STREAM_COALESCE),
+                            max_rate=config.get("keypoint_stream_max_rate", STREAM_MAX_RATE),
+                            max_delay_ms=config.get("keypoint_stream_max_delay_ms", STREAM_MAX_DELAY_MS))
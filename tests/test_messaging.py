@@ -0,0 +1,85 @@
+'''
+in-process broker stand-in (LoopbackBroker, LoopbackClient)
+'''
+
+import queue
+import threading
+import unittest
+import paho.mqtt.client as mqtt
+from messaging import LoopbackBroker, LoopbackClient, TOPIC_KEYPOINTS, TOPIC_RECORD_START
+
+# pre-defined options
+WAIT_TIMEOUT = 2.0 # sec
+
+
+class LoopbackTest(unittest.TestCase):
+    def setUp(self):
+        self.broker = LoopbackBroker()
+        self.clients = []
+
+    def tearDown(self):
+        for client in self.clients:
+            client.loop_stop()
+
+    # connected client with its received (topic, payload) queue
+    def connect(self, client_id:str, *topics) -> tuple:
+        client = LoopbackClient(self.broker, client_id)
+        received = queue.Queue()
+        connected = threading.Event()
+        client.on_connect = lambda client, userdata, flags, rc: connected.set()
+        client.on_message = lambda client, userdata, message: received.put((message.topic, message.payload))
+        for topic in topics:
+            client.subscribe(topic)
+        client.connect_async()
+        client.loop_start()
+        self.clients.append(client)
+        self.assertTrue(connected.wait(WAIT_TIMEOUT))
+        return client, received
+
+    def test_publish_to_matching_subscriptions(self):
+        publisher, _ = self.connect("publisher")
+        _, keypoints = self.connect("keypoints", f"{TOPIC_KEYPOINTS}/+")
+        _, commands = self.connect("commands", "flame/avsim/cam/#")
+
+        publisher.publish(f"{TOPIC_KEYPOINTS}/0", b"\x01\x02")
+        publisher.publish(TOPIC_RECORD_START, '{"app":"test"}')
+
+        self.assertEqual(keypoints.get(timeout=WAIT_TIMEOUT), (f"{TOPIC_KEYPOINTS}/0", b"\x01\x02"))
+        self.assertEqual(commands.get(timeout=WAIT_TIMEOUT), (f"{TOPIC_KEYPOINTS}/0", b"\x01\x02"))
+        self.assertEqual(commands.get(timeout=WAIT_TIMEOUT), (TOPIC_RECORD_START, b'{"app":"test"}'))
+        self.assertTrue(keypoints.empty()) # delivered before publish returns
+
+    def test_message_info(self):
+        publisher, _ = self.connect("publisher")
+        first = publisher.publish(TOPIC_RECORD_START, None)
+        second = publisher.publish(TOPIC_RECORD_START, None)
+        self.assertEqual(first.rc, mqtt.MQTT_ERR_SUCCESS)
+        self.assertTrue(first.is_published())
+        first.wait_for_publish(WAIT_TIMEOUT)
+        self.assertGreater(second.mid, first.mid)
+
+    def test_publish_without_connection(self):
+        client = LoopbackClient(self.broker, "offline")
+        info = client.publish(TOPIC_RECORD_START, b"")
+        self.assertEqual(info.rc, mqtt.MQTT_ERR_NO_CONN)
+        self.assertFalse(info.is_published())
+        with self.assertRaises(RuntimeError):
+            info.wait_for_publish(WAIT_TIMEOUT)
+
+    def test_disconnect(self):
+        publisher, _ = self.connect("publisher")
+        subscriber, received = self.connect("subscriber", TOPIC_RECORD_START)
+        disconnected = threading.Event()
+        subscriber.on_disconnect = lambda client, userdata, rc: disconnected.set()
+        subscriber.disconnect()
+        self.assertTrue(disconnected.wait(WAIT_TIMEOUT))
+        self.assertFalse(subscriber.is_connected())
+
+        publisher.publish(TOPIC_RECORD_START, b"")
+        subscriber.loop_stop()
+        self.assertTrue(received.empty())
+        self.assertNotIn(subscriber, self.broker.clients)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,112 @@
+'''
+headless camera service driven over the in-process broker stand-in (synthetic camera, no pose model)
+'''
+
+import json
+import pathlib
+import queue
+import shutil
+import tempfile
+import time
+import unittest
+from unittest import mock
+from PyQt6.QtCore import QCoreApplication
+from messaging import LoopbackBroker, LoopbackClient, TOPIC_CAPTURE, TOPIC_RECORD_START, TOPIC_RECORD_STOP, TOPIC_REQUEST_STATUS, TOPIC_STATUS
+from service import CameraService
+from session import SESSION_FILE, PENDING_PREFIX
+
+# pre-defined options
+CAMERA_SOURCE = "synthetic:320x240@15"
+WAIT_TIMEOUT = 10.0 # sec
+RECORD_TIME = 1.0 # sec
+
+
+class CameraServiceTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.app = QCoreApplication.instance() or QCoreApplication([])
+
+    def setUp(self):
+        self.data_root = pathlib.Path(tempfile.mkdtemp(prefix="avsim-cam-test-"))
+        self.addCleanup(shutil.rmtree, self.data_root, ignore_errors=True)
+        model = mock.patch("inference.load_pose_model", side_effect=RuntimeError("no pose model in tests")) # runs without keypoints
+        model.start()
+        self.addCleanup(model.stop)
+
+        broker = LoopbackBroker()
+        config = {"camera_ids":[CAMERA_SOURCE], "data_out_dir":str(self.data_root), "keypoint_stream_enabled":False,
+                  "status_interval_s":60, "metrics_interval_s":60, "startup_log":None}
+        self.service = CameraService("loopback", config, client=LoopbackClient(broker, "service"))
+        self.status = queue.Queue()
+        self.tester = LoopbackClient(broker, "tester")
+        self.tester.on_message = lambda client, userdata, message: self.status.put(json.loads(message.payload))
+        self.tester.subscribe(TOPIC_STATUS)
+        self.tester.connect_async()
+        self.tester.loop_start()
+        self.service.start()
+        self.addCleanup(self.tester.loop_stop)
+        self.addCleanup(self.service.close)
+
+    # run the Qt event loop until the condition holds
+    def wait_for(self, condition, timeout:float=WAIT_TIMEOUT) -> bool:
+        t_end = time.monotonic()+timeout
+        while time.monotonic() < t_end:
+            self.app.processEvents()
+            if condition():
+                return True
+            time.sleep(0.01)
+        return False
+
+    # status messages received so far, the latest last
+    def received_status(self) -> list:
+        messages = []
+        while not self.status.empty():
+            messages.append(self.status.get())
+        return messages
+
+    def request(self, topic:str):
+        self.tester.publish(topic, json.dumps({"app":"test"}))
+
+    def sessions(self) -> list:
+        return [path for path in self.data_root.iterdir() if not path.name.startswith(PENDING_PREFIX)]
+
+    def test_record_session_over_message_api(self):
+        self.assertTrue(self.wait_for(lambda: CAMERA_SOURCE in self.service.opened_camera and self.service.mq_client.is_connected()))
+        self.assertTrue(self.wait_for(lambda: self.service.next_session is not None))
+
+        self.request(TOPIC_RECORD_START)
+        self.assertTrue(self.wait_for(lambda: self.service.is_recording))
+        self.assertEqual(len(self.sessions()), 1)
+        session_path = self.sessions()[0]
+        self.assertTrue((session_path / SESSION_FILE).exists())
+        self.wait_for(lambda: False, RECORD_TIME)
+
+        self.received_status()
+        self.request(TOPIC_REQUEST_STATUS)
+        status = []
+        self.assertTrue(self.wait_for(lambda: status.extend(self.received_status()) or status))
+        self.assertTrue(status[-1]["recording"])
+        self.assertEqual(status[-1]["session"], session_path.name)
+        self.assertTrue(status[-1]["cameras"][CAMERA_SOURCE]["connected"])
+
+        self.request(TOPIC_RECORD_STOP)
+        self.assertTrue(self.wait_for(lambda: not self.service.is_recording))
+        status = []
+        self.assertTrue(self.wait_for(lambda: status.extend(self.received_status()) or status)) # published on stop
+        self.assertFalse(status[-1]["recording"])
+        self.assertIsNone(status[-1]["session"])
+
+        # writers are flushed and the camera record info is written when the session is closed
+        camera = self.service.opened_camera[CAMERA_SOURCE]
+        self.assertTrue(self.wait_for(lambda: all(recorder.is_finished() for recorder in camera.closing_recorders)))
+        self.assertTrue((session_path / f"record_cam_{CAMERA_SOURCE}.json").exists())
+        self.assertTrue((session_path / f"cam_{CAMERA_SOURCE}.avi").stat().st_size > 0)
+        self.assertEqual(self.sessions(), [session_path]) # the next session stays pending
+
+    def test_invalid_capture_delay(self):
+        self.assertTrue(self.wait_for(lambda: self.service.mq_client.is_connected()))
+        self.service.on_mapi_message(TOPIC_CAPTURE, {"app":"test", "delay":"soon"}) # logged, not raised
+
+
+if __name__ == "__main__":
+    unittest.main()
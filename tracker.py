@@ -0,0 +1,156 @@
+'''
+Keypoint tracker between detections (pyramidal optical flow) and adaptive detection scheduler
+@author bh.hwang@iae.re.kr
+'''
+
+import time
+import cv2
+import numpy as np
+from inference import PoseResult
+
+# pre-defined options
+TRACK_SCALE = 0.5 # optical flow runs on a downscaled grayscale image
+TRACK_WIN_SIZE = (21, 21)
+TRACK_PYRAMID_LEVEL = 3
+TRACK_KEYPOINT_CONF = 0.5 # keypoints below this confidence are not tracked
+TRACK_FB_ERROR = 1.0 # max. forward-backward error (px, on the tracking scale)
+DETECT_INTERVAL_MIN = 1
+DETECT_INTERVAL_MAX = 1 # 1 means the detector runs on every frame (tracking disabled)
+TRACK_CONF_THRESHOLD = 0.6 # detector runs again if tracking confidence drops below
+TRACK_ERROR_TOLERANCE = 0.02 # accepted tracking drift at a detection (fraction of the bbox diagonal)
+
+
+'''
+propagates keypoints and bbox of the last detection with pyramidal Lucas-Kanade optical flow
+'''
+class KeypointTracker:
+    def __init__(self, scale:float=TRACK_SCALE, keypoint_conf:float=TRACK_KEYPOINT_CONF, fb_error:float=TRACK_FB_ERROR):
+        self.scale = scale
+        self.keypoint_conf = keypoint_conf
+        self.fb_error = fb_error
+        self.lk_params = {"winSize":TRACK_WIN_SIZE, "maxLevel":TRACK_PYRAMID_LEVEL,
+                          "criteria":(cv2.TERM_CRITERIA_EPS | cv2.TERM_CRITERIA_COUNT, 20, 0.03)}
+        self.prev_gray = None
+        self.pose = None # last detected or tracked pose (full frame coordinates)
+        self.confidence = 0. # fraction of keypoints tracked successfully in the last step
+
+    # grayscale image on the tracking scale
+    def prepare(self, frame_bgr):
+        gray = cv2.cvtColor(frame_bgr, cv2.COLOR_BGR2GRAY)
+        if self.scale != 1.0:
+            gray = cv2.resize(gray, None, fx=self.scale, fy=self.scale, interpolation=cv2.INTER_AREA)
+        return gray
+
+    # True if there is a target to track
+    def has_target(self) -> bool:
+        return self.pose is not None and len(self.pose) > 0
+
+    # restart tracking from a detection
+    def reset(self, gray, pose:PoseResult):
+        self.prev_gray = gray
+        self.pose = pose
+        self.confidence = 1.0 if len(pose) > 0 else 0.
+
+    # propagate the last pose to this frame
+    def track(self, gray) -> PoseResult:
+        t_start = time.perf_counter()
+        pose = self.pose
+        n = len(pose)
+        keypoints = pose.keypoints.reshape(-1, 2)
+        valid = (pose.keypoint_conf.reshape(-1) >= self.keypoint_conf) & np.all(keypoints > 0, axis=1)
+        if not valid.any():
+            self.confidence = 0.
+            return self._result(pose.keypoints, pose.keypoint_conf, pose.boxes, pose.box_conf, t_start, gray)
+
+        p0 = (keypoints[valid]*self.scale).astype(np.float32).reshape(-1, 1, 2)
+        p1, status, _ = cv2.calcOpticalFlowPyrLK(self.prev_gray, gray, p0, None, **self.lk_params)
+        p0r, status_r, _ = cv2.calcOpticalFlowPyrLK(gray, self.prev_gray, p1, None, **self.lk_params) # backward check
+        fb = np.linalg.norm((p0-p0r).reshape(-1, 2), axis=1)
+        good = (status.reshape(-1) == 1) & (status_r.reshape(-1) == 1) & (fb < self.fb_error)
+        self.confidence = float(good.sum())/float(valid.sum())
+
+        flow = ((p1-p0).reshape(-1, 2))/self.scale
+        median_flow = np.median(flow[good], axis=0) if good.any() else np.zeros(2, dtype=np.float32)
+
+        # tracked points move with their own flow, the others with the median flow
+        moved = keypoints + median_flow
+        valid_index = np.flatnonzero(valid)
+        moved[valid_index[good]] = keypoints[valid_index[good]] + flow[good]
+        moved[~valid] = keypoints[~valid] # invisible points are kept as they are
+
+        conf = pose.keypoint_conf.reshape(-1).copy()
+        conf[valid_index[~good]] *= 0.5 # lost points decay
+        boxes = pose.boxes + np.tile(median_flow, 2)
+        return self._result(moved.reshape(n, -1, 2).astype(np.float32), conf.reshape(n, -1), boxes.astype(np.float32), pose.box_conf, t_start, gray)
+
+    # build result and keep it as the reference of the next step
+    def _result(self, keypoints, keypoint_conf, boxes, box_conf, t_start:float, gray) -> PoseResult:
+        elapsed = (time.perf_counter()-t_start)*1000.
+        result = PoseResult(keypoints, keypoint_conf, boxes, box_conf, {"preprocess":0., "inference":elapsed, "postprocess":0.})
+        self.prev_gray = gray
+        self.pose = result
+        return result
+
+
+# mean keypoint distance between two poses, normalized by the bbox diagonal (None if not comparable)
+def tracking_error(tracked:PoseResult, detected:PoseResult, keypoint_conf:float=TRACK_KEYPOINT_CONF):
+    if tracked is None or len(tracked) == 0 or len(detected) == 0:
+        return None
+    n = min(len(tracked), len(detected))
+    valid = (detected.keypoint_conf[:n] >= keypoint_conf) & (tracked.keypoint_conf[:n] >= keypoint_conf)
+    if not valid.any():
+        return None
+    distance = np.linalg.norm(tracked.keypoints[:n]-detected.keypoints[:n], axis=2) # (n, 17)
+    diagonal = np.linalg.norm(detected.boxes[:n, 2:]-detected.boxes[:n, :2], axis=1) # (n,)
+    return float(np.mean((distance/np.maximum(diagonal, 1.)[:, None])[valid]))
+
+
+'''
+decides when the detector has to run (adaptive, bounded interval)
+'''
+class AdaptiveDetectionScheduler:
+    def __init__(self, min_interval:int=DETECT_INTERVAL_MIN, max_interval:int=DETECT_INTERVAL_MAX,
+                 conf_threshold:float=TRACK_CONF_THRESHOLD, error_tolerance:float=TRACK_ERROR_TOLERANCE):
+        if min_interval < 1 or max_interval < min_interval:
+            raise ValueError("detection interval must satisfy 1 <= min <= max")
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.conf_threshold = conf_threshold
+        self.error_tolerance = error_tolerance
+        self.interval = min_interval
+        self.since_detection = 0
+
+        # counters
+        self.detected = 0
+        self.tracked = 0
+        self.last_error = None
+
+    # True if tracking is possible at all
+    @property
+    def enabled(self) -> bool:
+        return self.max_interval > 1
+
+    def should_detect(self, has_target:bool, tracking_conf:float) -> bool:
+        if not has_target or tracking_conf < self.conf_threshold:
+            return True
+        return self.since_detection+1 >= self.interval
+
+    # update the interval with the drift of the tracker at a detection
+    def on_detection(self, tracked:PoseResult, detected:PoseResult, tracking_conf:float):
+        error = tracking_error(tracked, detected)
+        self.last_error = error
+        if error is None or tracking_conf < self.conf_threshold or error > self.error_tolerance:
+            self.interval = max(self.min_interval, self.interval//2)
+        elif error < self.error_tolerance/2:
+            self.interval = min(self.max_interval, self.interval+1)
+        self.since_detection = 0
+        self.detected += 1
+
+    def on_tracked(self):
+        self.since_detection += 1
+        self.tracked += 1
+
+    # fraction of frames going through the detector
+    def detection_ratio(self) -> float:
+        total = self.detected + self.tracked
+        return self.detected/total if total else 1.
@@ -5,14 +5,22 @@ In-cabin camera monitor & data extractor window class
 
 import cv2
 import pathlib
-import paho.mqtt.client as mqtt
+from messaging import create_mqtt_client, TOPIC_CAPTURE, TOPIC_REQUEST_METRICS
 from PyQt6.QtGui import QImage, QPixmap, QCloseEvent
 from PyQt6.QtWidgets import QApplication, QMainWindow, QLabel, QPushButton, QMessageBox, QProgressBar
 from PyQt6.uic import loadUi
 from PyQt6.QtCore import QObject, Qt, QTimer, QThread, pyqtSignal, pyqtSlot
-from camera import CameraController
+from camera import CameraController, CameraOpener, DATA_OUT_DIR
+from session import RecordingSession, remove_stale_sessions
+from worker import CameraWorkerProcess
+from inference import create_engine
 from machine import MachineMonitor
+from governor import QualityGovernor
+from metrics import StartupTimer
+from telemetry import create_streamer
 import json
+import time
+from datetime import datetime
 
 # pre-defined options
 WORKING_PATH = pathlib.Path(__file__).parent
@@ -27,23 +35,52 @@ CAMERA_RECORD_HEIGHT = 1080
 
 # for message APIs
 mqtt_topic_manager = "flame/avsim/manager"
+mqtt_topic_metrics = "flame/avsim/cam/metrics"
+METRICS_UPDATE_MS = 1000 # status area update interval
+METRICS_INTERVAL_S = 5 # metrics dump interval
+
+
+# one line machine load text for the status area
+def machine_text(resources:dict) -> str:
+    parts = []
+    for key, name in (("cpu_usage", "cpu"), ("memory_usage", "mem"), ("gpu_usage", "gpu")):
+        if resources.get(key) is not None:
+            parts.append(f"{name} {resources[key]:.0f}%")
+    if resources.get("threads"):
+        busiest = resources["threads"][0]
+        parts.append(f"busiest {busiest['name']} {busiest['cpu']:.0f}%")
+    return "machine : " + (", ".join(parts) if parts else "-")
 
 
 '''
 Main window
 '''
 class CameraWindow(QMainWindow):
-    def __init__(self, broker_ip_address, config:dict):
+    mapi_message_slot = pyqtSignal(str, dict) # message api call (emitted from the mqtt client thread, handled on the GUI thread)
+
+    def __init__(self, broker_ip_address, config:dict, startup:StartupTimer=None):
         super().__init__()
         loadUi(APP_UI, self)
 
         self.configure_param = config
+        self.startup = startup if startup is not None else StartupTimer()
         self.opened_camera = {}
+        self.opening_camera = {} # camera id -> controller being opened in background
+        self.camera_opener = None
+        self.first_frame_shown = set() # camera ids with a preview on the label
         self.machine_monitor = None
+        self.hpe_engine = None
+        self.camera_labels = {} # camera id -> preview label (cached)
         self.is_machine_running = False
+        self.data_root = self.configure_param.get("data_out_dir", DATA_OUT_DIR)
+        self.session = None # recording session (shared by every camera)
+        self.next_session = None # pre-allocated session, writers are opened ahead of the trigger
+        remove_stale_sessions(self.data_root)
         self.message_api = {
             "flame/avsim/cam/mapi_record_start" : self.mapi_record_start,
             "flame/avsim/cam/mapi_record_stop" : self.mapi_record_stop,
+            TOPIC_CAPTURE : self.mapi_capture,
+            TOPIC_REQUEST_METRICS : self.mapi_request_metrics,
             "flame/avsim/mapi_request_active" : self.mapi_notify_active #response directly
         }
         
@@ -58,48 +95,142 @@ class CameraWindow(QMainWindow):
         self.actionConnect_All.triggered.connect(self.on_select_connect_all)
 
         # for mqtt connection
-        self.mq_client = mqtt.Client(client_id=APP_NAME,transport='tcp',protocol=mqtt.MQTTv311, clean_session=True)
+        self.mq_client = create_mqtt_client(APP_NAME, broker_ip_address)
         self.mq_client.on_connect = self.on_mqtt_connect
         self.mq_client.on_message = self.on_mqtt_message
         self.mq_client.on_disconnect = self.on_mqtt_disconnect
+        self.mapi_message_slot.connect(self.on_mapi_message, Qt.ConnectionType.QueuedConnection)
         self.mq_client.connect_async(broker_ip_address, port=1883, keepalive=60)
         self.mq_client.loop_start()
 
-        # for gpu resource monitoring
+        # for real-time keypoint stream (published only while connected)
+        self.keypoint_streamer = create_streamer(self.mq_client, self.configure_param)
+        if self.keypoint_streamer!=None:
+            self.keypoint_streamer.start()
+
+        # for machine resource monitoring (gpu, cpu, memory, threads)
+        self.resources = {}
         self.machine_monitor = MachineMonitor(1000)
-        self.machine_monitor.gpu_monitor_slot.connect(self.gpu_monitor_update)
+        self.machine_monitor.resource_monitor_slot.connect(self.resource_monitor_update)
         self.machine_monitor.start()
 
-    # camera open after show this GUI
+        # for load-adaptive quality per camera (inference rate, input size, preview rate)
+        self.governor = None
+        if self.configure_param.get("governor_enabled", False):
+            self.governor = QualityGovernor(bounds=self.configure_param.get("governor_bounds", None))
+
+        # for pipeline metrics (status area and periodic dump)
+        self.metrics_interval = self.configure_param.get("metrics_interval_s", METRICS_INTERVAL_S)
+        self.metrics_file = self.configure_param.get("metrics_file", None)
+        self.metrics_last_dump = time.monotonic()
+        self.metrics_timer = QTimer(self)
+        self.metrics_timer.timeout.connect(self.on_metrics_timer)
+        self.metrics_timer.start(METRICS_UPDATE_MS)
+
+    # camera open after show this GUI (model loading and device opening run in background)
     def start_monitor(self):
         if self.is_machine_running:
             QMessageBox.critical(self, "Already Running", "This Machine is already working...")
             return
-        
-        # for camera monitoring
+        if self.camera_opener is not None and self.camera_opener.isRunning():
+            self.show_on_statusbar("Cameras are being connected...")
+            return
+        self.startup.mark("connect")
+
+        # one pose model shared by all cameras (batched inference), loaded by the engine thread
+        # (in camera process mode, every worker process loads its own model)
+        use_process = self.configure_param.get("camera_process", False)
+        if self.hpe_engine is None and not use_process:
+            self.hpe_engine = create_engine(self.configure_param, self.configure_param.get("inference_batch_size", len(self.configure_param["camera_ids"])))
+            self.hpe_engine.ready_slot.connect(self.on_engine_ready)
+            self.hpe_engine.start()
+            self.show_on_statusbar("Loading pose model...")
+
+        # for camera monitoring (devices are opened concurrently)
         for id in self.configure_param["camera_ids"]:
-            camera = CameraController(id)
-            if camera.open():
-                self.opened_camera[id] = camera
-                self.opened_camera[id].image_frame_slot.connect(self.update_frame)
-            else:
-                QMessageBox.critical(self, "No Camera", "No Camera device connection")
+            if id in self.opened_camera:
+                continue
+            label = self.findChild(QLabel, self.configure_param["camera_windows_map"][id])
+            if label != None:
+                self.camera_labels[id] = label
+            camera_class = CameraWorkerProcess if use_process else CameraController
+            self.opening_camera[id] = camera_class(id, engine=self.hpe_engine, config=self.configure_param)
+            self.show_camera_state(id, "opening...")
 
-        for camera in self.opened_camera.values():
-            camera.begin()
-    
-    # internal api for starting record
+        self.camera_opener = CameraOpener(list(self.opening_camera.values()))
+        self.camera_opener.camera_opened_slot.connect(self.on_camera_opened)
+        self.camera_opener.finished.connect(self.on_cameras_opened)
+        self.camera_opener.start()
+
+    # a camera device is opened (or failed), starts its pipeline immediately
+    def on_camera_opened(self, id, success:bool, elapsed:float):
+        camera = self.opening_camera.pop(id, None)
+        if camera is None:
+            return
+        if not success:
+            print(f"[Warning] camera {id} is not connected ({elapsed:.2f} s)")
+            self.show_camera_state(id, "no device")
+            return
+
+        self.startup.mark(f"camera {id} opened")
+        self.opened_camera[id] = camera
+        camera.image_frame_slot.connect(self.update_frame)
+        if id in self.camera_labels:
+            camera.set_preview_size(self.camera_labels[id].width(), self.camera_labels[id].height())
+        self.show_camera_state(id, "waiting for frames...")
+        camera.keypoint_streamer = self.keypoint_streamer
+        camera.begin()
+        if self.session!=None:
+            camera.start_recording(self.session.path, self.session.t_start, self.session.t_start_wall) # requested while the camera was opening
+        else:
+            camera.prepare_recording(self.prepare_session().path)
+
+    def on_cameras_opened(self):
+        if not self.opened_camera:
+            QMessageBox.critical(self, "No Camera", "No Camera device connection")
+
+    # pose model is loaded and warmed up
+    def on_engine_ready(self, success:bool, elapsed:float):
+        if success:
+            self.startup.mark("pose model ready")
+            self.show_on_statusbar(f"Pose model is ready ({elapsed:.1f} s)")
+        else:
+            self.show_on_statusbar("Pose model loading failed (preview without keypoints)")
+
+    # readiness text on the camera label (until the first frame is shown)
+    def show_camera_state(self, id, state:str):
+        label = self.camera_labels.get(id)
+        if label != None:
+            label.setText(f"Camera #{id} : {state}")
+
+    # pre-allocated session of the next record trigger
+    def prepare_session(self) -> RecordingSession:
+        if self.next_session==None:
+            self.next_session = RecordingSession(self.data_root)
+        return self.next_session
+
+    # internal api for starting record (one session and one start timestamp for every camera)
     def _api_record_start(self):
+        if self.session!=None:
+            return
+        self.session = self.prepare_session()
+        self.next_session = None
+        self.session.start(list(self.opened_camera.keys()))
         for camera in self.opened_camera.values():
-            print(f"Recording start...({camera.camera_id})")
-            camera.start_recording()
-        self.show_on_statusbar("Start Recording...")
+            camera.start_recording(self.session.path, self.session.t_start, self.session.t_start_wall)
+        print(f"Recording start...({self.session})")
+        self.show_on_statusbar(f"Start Recording... ({self.session})")
     
-    # internal api for stopping record
+    # internal api for stopping record (writers of the next session are opened right away)
     def _api_record_stop(self):
+        if self.session==None:
+            return
         for camera in self.opened_camera.values():
-            print(f"Recording stop...({camera.camera_id})")
             camera.stop_recording()
+        print(f"Recording stop...({self.session})")
+        self.session = None
+        for camera in self.opened_camera.values():
+            camera.prepare_recording(self.prepare_session().path)
         self.show_on_statusbar("Stopped Recording...")
         
     # capture image
@@ -144,42 +275,129 @@ class CameraWindow(QMainWindow):
     # mapi : record stop
     def mapi_record_stop(self, payload):
         self._api_record_stop()
+
+    # mapi : capture image (after delay sec)
+    def mapi_capture(self, payload):
+        try:
+            delay = float(payload.get("delay", 0))
+        except (ValueError, TypeError):
+            print(f"[Warning] capture delay must be a number : {payload.get('delay')}")
+            return
+        self._api_capture_image(delay)
+
+    # mapi : metrics report on request
+    def mapi_request_metrics(self, payload):
+        if self.mq_client.is_connected():
+            self.mq_client.publish(mqtt_topic_metrics, json.dumps(self.metrics_report()), 0)
                 
     # show message on status bar
     def show_on_statusbar(self, text):
         self.statusBar().showMessage(text)
     
 
-    # update image frame on label area
+    # update image frame on label area (image is already downscaled to the label size by the camera thread)
     def update_frame(self, image):
         id = self.sender().camera_id
-        pixmap = QPixmap.fromImage(image)
-        #window = self.findChild(QLabel, camera_windows[id])
-        try:
-            window = self.findChild(QLabel, self.configure_param["camera_windows_map"][id])
-            window.setPixmap(pixmap.scaled(window.size(), Qt.AspectRatioMode.KeepAspectRatio))
-        except Exception as e:
-            print(e)
+        window = self.camera_labels.get(id)
+        if window != None:
+            window.setPixmap(QPixmap.fromImage(image))
+        if id not in self.first_frame_shown:
+            self.first_frame_shown.add(id)
+            self.startup.mark(f"camera {id} first frame")
+
+    # preview size follows the label size
+    def resizeEvent(self, event):
+        for id, label in self.camera_labels.items():
+            if id in self.opened_camera:
+                self.opened_camera[id].set_preview_size(label.width(), label.height())
+        return super().resizeEvent(event)
     
-    # gpu monitoring update
-    def gpu_monitor_update(self, status:dict):
+    # machine resource update (busiest gpu on the progress bars, every gpu on the tooltip)
+    def resource_monitor_update(self, status:dict):
+        self.resources = status
         gpu_usage_window = self.findChild(QProgressBar, "progress_gpu_usage")
         gpu_memory_usage_window = self.findChild(QProgressBar, "progress_gpu_mem_usage")
-        gpu_usage_window.setValue(status["gpu_usage"])
-        gpu_memory_usage_window.setValue(status["gpu_memory_usage"])
+        if status["gpu_usage"] is not None:
+            gpu_usage_window.setValue(status["gpu_usage"])
+            gpu_memory_usage_window.setValue(status["gpu_memory_usage"])
+            tooltip = "\n".join(f"GPU {gpu['gpu_id']} : {gpu['gpu_usage']}% (memory {gpu['gpu_memory_usage']}%)" for gpu in status["gpus"])
+            gpu_usage_window.setToolTip(tooltip)
+            gpu_memory_usage_window.setToolTip(tooltip)
+
+        if self.governor != None and self.opened_camera:
+            self.govern_quality(status)
+
+    # adjust quality of the cameras to the machine load
+    def govern_quality(self, status:dict):
+        loads = {id:camera.load_stats() for id, camera in self.opened_camera.items()}
+        engine_queue = self.hpe_engine.queue_depth() if self.hpe_engine != None else 0
+        for id, settings in self.governor.update(status, loads, engine_queue).items():
+            print(f"[Info] camera {id} quality level {self.governor.levels[id]} : {settings}")
+            self.opened_camera[id].set_quality(**settings)
+
+    # pipeline metrics report of every camera
+    def metrics_report(self) -> dict:
+        report = {"app":APP_NAME, "timestamp":datetime.now().isoformat(), "cameras":{}}
+        for id, camera in self.opened_camera.items():
+            report["cameras"][str(id)] = camera.report()
+        if self.governor!=None:
+            report["quality_levels"] = {str(id):level for id, level in self.governor.report().items()}
+        if self.resources:
+            report["machine"] = self.resources
+        if self.hpe_engine!=None:
+            report["inference"] = {"latency":self.hpe_engine.latency_stats(), "mean_batch_size":self.hpe_engine.mean_batch_size()}
+        if self.keypoint_streamer!=None:
+            report["keypoint_stream"] = self.keypoint_streamer.stats()
+        return report
+
+    # update metrics on status area and dump periodically (MQTT and/or json file)
+    def on_metrics_timer(self):
+        if not self.opened_camera:
+            return
+
+        metrics_window = self.findChild(QLabel, "label_pipeline_metrics")
+        if metrics_window != None:
+            lines = [camera.metrics_text() for camera in self.opened_camera.values()]
+            if self.resources:
+                lines.append(machine_text(self.resources))
+            metrics_window.setText("\n\n".join(lines))
+
+        if time.monotonic()-self.metrics_last_dump < self.metrics_interval:
+            return
+        self.metrics_last_dump = time.monotonic()
+        report = json.dumps(self.metrics_report())
+        if self.mq_client.is_connected():
+            self.mq_client.publish(mqtt_topic_metrics, report, 0)
+        if self.metrics_file:
+            with open(self.metrics_file, "w") as f:
+                f.write(report)
 
     # close event callback function by user
     def closeEvent(self, a0: QCloseEvent) -> None:
-        for device in self.opened_camera.values():
+        self.metrics_timer.stop()
+        if self.camera_opener is not None:
+            self.camera_opener.wait() # device opening can not be interrupted
+        for device in list(self.opened_camera.values()) + list(self.opening_camera.values()):
             device.close()
+        if self.next_session!=None:
+            self.next_session.discard()
+
+        if self.hpe_engine!=None:
+            self.hpe_engine.close()
+
+        if self.keypoint_streamer!=None:
+            self.keypoint_streamer.close()
 
         if self.machine_monitor!=None:
             self.machine_monitor.close()
 
+        if self.configure_param.get("startup_log", None):
+            self.startup.save(self.configure_param["startup_log"])
+
         return super().closeEvent(a0)
     
     # notification
-    def mapi_notify_active(self):
+    def mapi_notify_active(self, payload=None):
         if self.mq_client.is_connected():
             msg = {"app":APP_NAME, "active":True}
             self.mq_client.publish(mqtt_topic_manager, json.dumps(msg), 0)
@@ -200,21 +418,28 @@ class CameraWindow(QMainWindow):
     def on_mqtt_disconnect(self, mqttc, userdata, rc):
         self.show_on_statusbar("Disconnected to Broker({})".format(str(rc)))
     
-    # mqtt message receive callback function
+    # mqtt message receive callback function (called from the mqtt client thread, the api runs on the GUI thread)
     def on_mqtt_message(self, mqttc, userdata, msg):
         mapi = str(msg.topic)
         
         try:
             if mapi in self.message_api.keys():
                 payload = json.loads(msg.payload)
-                if "app" not in payload:
+                if not isinstance(payload, dict) or "app" not in payload:
                     print("Message payload does not contain the app")
                     return
                 
                 if payload["app"] != APP_NAME:
-                    self.message_api[mapi](payload)
+                    self.mapi_message_slot.emit(mapi, payload)
             else:
                 print("Unknown MAPI was called : {}".format(mapi))
         except json.JSONDecodeError as e:
             print("MAPI message payload connot be converted : {}".format(str(e)))
+
+    # message api call on the GUI thread (recording state is changed by this thread only)
+    def on_mapi_message(self, mapi:str, payload:dict):
+        try:
+            self.message_api[mapi](payload)
+        except (ValueError, TypeError) as e:
+            print(f"[Warning] MAPI {mapi} payload is invalid : {e}")
         
\ No newline at end of file
@@ -0,0 +1,300 @@
+'''
+Camera worker process (capture, inference and recording of a camera in its own process)
+preview frames reach the GUI process through a shared-memory ring, keypoints, status and control commands through a pipe
+@author bh.hwang@iae.re.kr
+'''
+
+import multiprocessing as mp
+import threading
+import time
+import numpy as np
+from PyQt6.QtCore import QCoreApplication, QThread, pyqtSignal
+from PyQt6.QtGui import QImage
+from framebuffer import SharedFrameRing
+from inference import PoseResult, NUM_KEYPOINTS
+from camera import CameraController
+from config import camera_profile
+
+# pre-defined options
+PREVIEW_SLOTS = 3
+PREVIEW_MAX_WIDTH = 1280 # largest preview of a worker (ring slot size) unless the camera profile gives a preview size
+PREVIEW_MAX_HEIGHT = 720
+WORKER_OPEN_TIMEOUT = 30.0 # sec
+WORKER_CLOSE_TIMEOUT = 10.0 # sec (remaining frames are flushed by the writers before exit)
+WORKER_STATS_INTERVAL = 1.0 # sec
+
+# worker -> GUI messages (tuples, the first item is the type)
+MSG_OPENED = "opened"   # (MSG_OPENED, success)
+MSG_FRAME = "frame"     # (MSG_FRAME, slot, seq) : preview in the shared-memory ring
+MSG_POSE = "pose"       # (MSG_POSE, frame index, t_mono, t_wall, flags, keypoints bytes, boxes bytes) : every processed frame
+MSG_STATS = "stats"     # (MSG_STATS, status dict)
+
+# GUI -> worker commands
+CMD_BEGIN = "begin"
+CMD_RECORD_PREPARE = "record_prepare"   # (CMD_RECORD_PREPARE, pending session path)
+CMD_RECORD_START = "record_start"       # (CMD_RECORD_START, session path, t_start (time.monotonic, system-wide), t_start_wall)
+CMD_RECORD_STOP = "record_stop"
+CMD_CAPTURE = "capture"             # (CMD_CAPTURE, delay sec)
+CMD_PREVIEW_SIZE = "preview_size"   # (CMD_PREVIEW_SIZE, width, height)
+CMD_QUALITY = "quality"             # (CMD_QUALITY, settings dict)
+CMD_CLOSE = "close"
+
+
+# keypoints with confidence as raw bytes ((n, 17, 3) float32 : x, y, conf)
+def pack_keypoints(pose:PoseResult) -> bytes:
+    packed = np.empty((len(pose), NUM_KEYPOINTS, 3), dtype=np.float32)
+    packed[:, :, :2] = pose.keypoints
+    packed[:, :, 2] = pose.keypoint_conf
+    return packed.tobytes()
+
+def unpack_keypoints(data:bytes) -> np.ndarray:
+    return np.frombuffer(data, dtype=np.float32).reshape(-1, NUM_KEYPOINTS, 3)
+
+# person boxes with confidence as raw bytes ((n, 5) float32 : x1, y1, x2, y2, conf)
+def pack_boxes(pose:PoseResult) -> bytes:
+    packed = np.empty((len(pose), 5), dtype=np.float32)
+    packed[:, :4] = pose.boxes
+    packed[:, 4] = pose.box_conf
+    return packed.tobytes()
+
+def unpack_pose(keypoints:bytes, boxes:bytes) -> PoseResult:
+    keypoints = unpack_keypoints(keypoints)
+    boxes = np.frombuffer(boxes, dtype=np.float32).reshape(-1, 5)
+    return PoseResult(keypoints[:, :, :2], keypoints[:, :, 2], boxes[:, :4], boxes[:, 4], {})
+
+# ring slot of the largest preview (RGB)
+def _slot_bytes(preview_max:tuple) -> int:
+    return int(preview_max[0])*int(preview_max[1])*3
+
+
+'''
+pipe end shared by the threads of a process (send is serialized)
+'''
+class _Channel:
+    def __init__(self, conn):
+        self.conn = conn
+        self.lock = threading.Lock()
+
+    def send(self, message:tuple) -> bool:
+        try:
+            with self.lock:
+                self.conn.send(message)
+            return True
+        except (OSError, EOFError, BrokenPipeError):
+            return False # other side is gone
+
+
+'''
+camera controller of the worker process (publishes to the GUI process instead of Qt signals)
+'''
+class _WorkerCameraController(CameraController):
+    def __init__(self, camera_id, config:dict, source, channel:_Channel, ring:SharedFrameRing, preview_max:tuple):
+        super().__init__(camera_id, engine=None, config=config, source=source) # own engine in this process
+        self.channel = channel
+        self.ring = ring
+        self.preview_max = preview_max # (width, height) fitting into a ring slot
+        self.set_preview_size(*self.preview_size)
+
+    def set_preview_size(self, width:int, height:int):
+        super().set_preview_size(min(width, self.preview_max[0]), min(height, self.preview_max[1]))
+
+    def publish_preview(self, preview:np.ndarray, frame_t):
+        written = self.ring.write(preview)
+        if written is not None:
+            self.channel.send((MSG_FRAME, *written))
+
+    def publish_pose(self, frame_t, pose:PoseResult, flags:int):
+        self.channel.send((MSG_POSE, frame_t.index, frame_t.t_mono, frame_t.t_wall, flags, pack_keypoints(pose), pack_boxes(pose)))
+
+    def status(self) -> dict:
+        return {"report":self.report(), "metrics_text":self.metrics_text(), "load":self.load_stats(), "frames":self.frame_stats()}
+
+
+# worker process entry (spawned)
+def _worker_main(camera_id, config:dict, source, conn, ring_name:str, ring_slots:int, preview_max:tuple):
+    app = QCoreApplication([]) # for the camera threads (no display in this process)
+    channel = _Channel(conn)
+    ring = SharedFrameRing(ring_slots, _slot_bytes(preview_max), name=ring_name)
+    camera = _WorkerCameraController(camera_id, config, source, channel, ring, preview_max)
+    if not camera.open():
+        channel.send((MSG_OPENED, False))
+        ring.close()
+        return
+    channel.send((MSG_OPENED, True))
+
+    commands = {
+        CMD_BEGIN : camera.begin,
+        CMD_RECORD_PREPARE : camera.prepare_recording,
+        CMD_RECORD_START : camera.start_recording,
+        CMD_RECORD_STOP : camera.stop_recording,
+        CMD_CAPTURE : camera.start_capturing,
+        CMD_PREVIEW_SIZE : camera.set_preview_size,
+        CMD_QUALITY : lambda settings: camera.set_quality(**settings),
+    }
+    last_stats = time.monotonic()
+    while True:
+        try:
+            if conn.poll(0.1):
+                command, *args = conn.recv()
+                if command == CMD_CLOSE:
+                    break
+                if command not in commands:
+                    print(f"[Warning] camera {camera_id} worker ignores unknown command : {command}")
+                else:
+                    try:
+                        commands[command](*args)
+                    except Exception as e: # a failed command does not end the camera
+                        print(f"[Error] camera {camera_id} worker command {command} failed : {e}")
+        except (EOFError, OSError):
+            break # GUI process is gone
+
+        if time.monotonic()-last_stats > WORKER_STATS_INTERVAL:
+            last_stats = time.monotonic()
+            channel.send((MSG_STATS, camera.status()))
+
+    camera.close()
+    ring.close()
+
+
+'''
+camera running in a worker process (same interface as CameraController for the window)
+'''
+class CameraWorkerProcess(QThread):
+    image_frame_slot = pyqtSignal(QImage)
+    frame_output_slot = pyqtSignal(int, float) # frame index, grab time (time.monotonic, system-wide) of a processed frame
+
+    def __init__(self, camera_id, engine=None, config:dict=None, source=None):
+        super().__init__()
+        self.setObjectName(f"cam-proxy-{camera_id}")
+
+        self.camera_id = camera_id
+        self.config = config if config is not None else {}
+        self.source = source if source is not None else camera_id # must be picklable (spec or unopened FrameSource)
+        self.process = None
+        self.channel = None
+        self.conn = None
+        self.ring = None
+        self.status = {} # latest status of the worker
+        self.latest_keypoints = None # (frame index, t_wall, flags, keypoints (n, 17, 3))
+        self.keypoint_streamer = None # keypoint telemetry of this process (set by the owner before begin)
+        if engine is not None:
+            print(f"[Warning] camera {camera_id} worker process loads its own pose model (shared engine is not used)")
+
+    # start the worker process and open the device (blocks until the worker answers)
+    def open(self) -> bool:
+        context = mp.get_context("spawn") # no forked Qt state in the worker
+        preview = camera_profile(self.config, self.camera_id)["preview"]
+        preview_max = (preview["width"] or PREVIEW_MAX_WIDTH, preview["height"] or PREVIEW_MAX_HEIGHT)
+        self.ring = SharedFrameRing(PREVIEW_SLOTS, _slot_bytes(preview_max))
+        self.conn, worker_conn = context.Pipe(duplex=True)
+        self.channel = _Channel(self.conn)
+        self.process = context.Process(target=_worker_main, name=f"cam-{self.camera_id}", daemon=True,
+                                       args=(self.camera_id, self.config, self.source, worker_conn,
+                                             self.ring.name, PREVIEW_SLOTS, preview_max))
+        self.process.start()
+        worker_conn.close()
+
+        success = False
+        if self.conn.poll(WORKER_OPEN_TIMEOUT):
+            try:
+                message = self.conn.recv()
+                success = message[0] == MSG_OPENED and message[1]
+            except EOFError:
+                pass
+        if not success:
+            self._shutdown()
+        return success
+
+    # receiver of the worker messages
+    def run(self):
+        while not self.isInterruptionRequested():
+            try:
+                if not self.conn.poll(0.1):
+                    continue
+                message = self.conn.recv()
+            except (EOFError, OSError):
+                print(f"[Warning] camera {self.camera_id} worker process is terminated")
+                break
+
+            kind = message[0]
+            if kind == MSG_FRAME:
+                preview = self.ring.read(message[1], message[2])
+                if preview is not None:
+                    _ph, _pw, _ch = preview.shape
+                    self.image_frame_slot.emit(QImage(preview.data, _pw, _ph, _ch*_pw, QImage.Format.Format_RGB888).copy())
+            elif kind == MSG_POSE:
+                _, index, t_mono, t_wall, flags, keypoints, boxes = message
+                self.latest_keypoints = (index, t_wall, flags, unpack_keypoints(keypoints))
+                if self.keypoint_streamer is not None:
+                    self.keypoint_streamer.submit(self.camera_id, index, t_wall, flags, unpack_pose(keypoints, boxes))
+                self.frame_output_slot.emit(index, t_mono)
+            elif kind == MSG_STATS:
+                self.status = message[1]
+
+    def begin(self):
+        self.channel.send((CMD_BEGIN,))
+        self.start()
+
+    def prepare_recording(self, pending_path):
+        self.channel.send((CMD_RECORD_PREPARE, pending_path))
+
+    def start_recording(self, session_path=None, t_start:float=None, t_start_wall:float=None):
+        self.channel.send((CMD_RECORD_START, session_path, t_start, t_start_wall))
+
+    def stop_recording(self):
+        self.channel.send((CMD_RECORD_STOP,))
+
+    def start_capturing(self, delay_sec:float=1.0):
+        self.channel.send((CMD_CAPTURE, delay_sec))
+
+    def set_preview_size(self, width:int, height:int):
+        self.channel.send((CMD_PREVIEW_SIZE, max(1, width), max(1, height)))
+
+    def set_quality(self, **settings):
+        self.channel.send((CMD_QUALITY, settings))
+
+    # status reported by the worker (up to WORKER_STATS_INTERVAL old)
+    def metrics_text(self) -> str:
+        return self.status.get("metrics_text", f"cam{self.camera_id} : -")
+
+    def report(self) -> dict:
+        report = dict(self.status.get("report", {}))
+        report["preview_overrun"] = self.ring.overrun if self.ring is not None else 0
+        return report
+
+    def load_stats(self) -> dict:
+        return self.status.get("load", {"writer_fill":0., "dropped":0})
+
+    def frame_stats(self) -> dict:
+        return self.status.get("frames", {"pushed":0, "consumed":0, "overwritten":0, "skipped":0, "dropped":0, "depth":0})
+
+    def recorder_stats(self) -> dict:
+        return self.status.get("report", {}).get("recorder", {})
+
+    # stop the worker (recording is flushed by the worker before it exits)
+    def close(self):
+        if self.channel is not None:
+            self.channel.send((CMD_CLOSE,))
+        self.requestInterruption()
+        self.quit()
+        self.wait(1000)
+        self._shutdown()
+        print(f"camera worker {self.camera_id} is terminated")
+
+    def _shutdown(self):
+        if self.process is not None:
+            self.process.join(WORKER_CLOSE_TIMEOUT)
+            if self.process.is_alive():
+                print(f"[Warning] camera {self.camera_id} worker process does not stop, terminated")
+                self.process.terminate()
+                self.process.join()
+            self.process = None
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+        if self.ring is not None:
+            self.ring.close()
+            self.ring = None
+
+    def __str__(self):
+        return str(self.camera_id)